@@ -0,0 +1,48 @@
+"""Exportação GeoJSON em streaming.
+
+A FeatureCollection é escrita feature a feature a partir de um cursor do
+MongoDB e enviada em pedaços: a memória usada não depende do número de
+features. A saída segue o RFC 7946 (WGS84, lng/lat) e abre direto no QGIS.
+"""
+import json
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+
+GEOJSON_MEDIA_TYPE = "application/geo+json"
+# Tamanho aproximado de cada pedaço enviado na resposta
+GEOJSON_CHUNK_SIZE = 64 * 1024
+
+_HEADER = '{"type":"FeatureCollection","features":['
+_FOOTER = ']}'
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Tipo não serializável em GeoJSON: {type(value).__name__}")
+
+
+def feature(geometry: Optional[dict], properties: dict) -> dict:
+    """Feature GeoJSON; ``geometry`` None vira uma feature sem geometria."""
+    return {"type": "Feature", "geometry": geometry, "properties": properties}
+
+
+async def feature_collection(
+    features: AsyncIterator[dict], chunk_size: int = GEOJSON_CHUNK_SIZE
+) -> AsyncIterator[bytes]:
+    """Pedaços (UTF-8) de uma FeatureCollection com as features recebidas."""
+    parts = [_HEADER]
+    size = len(_HEADER)
+    separator = ""
+    async for item in features:
+        text = separator + json.dumps(item, ensure_ascii=False, separators=(",", ":"), default=_encode_value)
+        separator = ","
+        parts.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            yield "".join(parts).encode()
+            parts = []
+            size = 0
+    parts.append(_FOOTER)
+    yield "".join(parts).encode()
@@ -0,0 +1,144 @@
+"""Geometrias das localizações KML e suas versões simplificadas.
+
+Linhas e polígonos são guardados uma vez na íntegra, junto de versões
+simplificadas (Douglas–Peucker) para alguns níveis de zoom do mapa. A tolerância
+de cada nível é o tamanho de um pixel naquele zoom: o que some na
+simplificação não apareceria na tela. O endpoint do mapa entrega o nível mais
+grosso que ainda é fiel ao zoom pedido.
+"""
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# Zooms para os quais há versão simplificada; acima do último vai a geometria inteira
+GEOMETRY_LEVEL_ZOOMS = (6, 10, 14)
+# Pixels por tile no Web Mercator
+TILE_SIZE = 256
+
+# Parte de uma geometria: ("Point" | "LineString" | "Polygon", anéis/linhas como arrays (n, 2))
+Part = Tuple[str, List[np.ndarray]]
+
+
+def pixel_size(zoom: int, latitude: float = 0.0) -> float:
+    """Tamanho de um pixel, em graus, no zoom dado (o menor entre longitude e latitude)."""
+    return 360 / (TILE_SIZE * 2 ** zoom) * math.cos(math.radians(latitude))
+
+
+def douglas_peucker(points: np.ndarray, tolerance: float, min_points: int = 2) -> np.ndarray:
+    """Simplifica a linha mantendo os vértices a mais de ``tolerance`` do traçado.
+
+    Mantém pelo menos ``min_points`` vértices (4 para anéis fechados).
+    """
+    count = len(points)
+    if count <= min_points:
+        return points
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    kept = 2
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        inner = points[start + 1:end]
+        origin = points[start]
+        segment = points[end] - origin
+        length = math.hypot(segment[0], segment[1])
+        offsets = inner - origin
+        if length:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        else:
+            # Anel fechado: início e fim coincidem
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance or kept < min_points:
+            index = start + 1 + farthest
+            keep[index] = True
+            kept += 1
+            stack.append((start, index))
+            stack.append((index, end))
+    return points[keep]
+
+
+def close_ring(ring: np.ndarray) -> Optional[np.ndarray]:
+    """Anel fechado (último vértice igual ao primeiro); None se tiver menos de 3 vértices distintos."""
+    if len(ring) and not np.array_equal(ring[0], ring[-1]):
+        ring = np.vstack([ring, ring[:1]])
+    return ring if len(ring) >= 4 else None
+
+
+def _simplify_part(part: Part, tolerance: float) -> Part:
+    kind, lines = part
+    if kind == "Point":
+        return part
+    min_points = 4 if kind == "Polygon" else 2
+    return kind, [douglas_peucker(line, tolerance, min_points) for line in lines]
+
+
+def _vertex_count(parts: Sequence[Part]) -> int:
+    return sum(len(line) for _, lines in parts for line in lines)
+
+
+def _positions(kind: str, lines: List[np.ndarray]):
+    if kind == "Point":
+        return lines[0][0].tolist()
+    if kind == "LineString":
+        return lines[0].tolist()
+    return [ring.tolist() for ring in lines]
+
+
+def geometry_type(parts: Sequence[Part]) -> str:
+    """Tipo GeoJSON das partes: o da própria parte, um Multi* ou GeometryCollection."""
+    kinds = {kind for kind, _ in parts}
+    if len(kinds) > 1:
+        return "GeometryCollection"
+    kind = kinds.pop()
+    return kind if len(parts) == 1 else f"Multi{kind}"
+
+
+def to_geojson(parts: Sequence[Part]) -> dict:
+    """Geometria GeoJSON das partes (ver geometry_type)."""
+    kind = geometry_type(parts)
+    if kind == "GeometryCollection":
+        return {"type": kind, "geometries": [to_geojson([part]) for part in parts]}
+    if len(parts) == 1:
+        part_kind, lines = parts[0]
+        return {"type": kind, "coordinates": _positions(part_kind, lines)}
+    return {"type": kind, "coordinates": [_positions(part_kind, lines) for part_kind, lines in parts]}
+
+
+def geometry_levels(parts: Sequence[Part], latitude: float) -> List[Optional[dict]]:
+    """Uma geometria por zoom de GEOMETRY_LEVEL_ZOOMS, mais a geometria inteira no fim.
+
+    Um nível que não remove nenhum vértice em relação ao próximo fica None: quem
+    lê usa o próximo nível preenchido, e a geometria não é guardada repetida.
+    """
+    levels = [to_geojson(parts)]
+    finer_count = _vertex_count(parts)
+    for zoom in reversed(GEOMETRY_LEVEL_ZOOMS):
+        simplified = [_simplify_part(part, pixel_size(zoom, latitude)) for part in parts]
+        count = _vertex_count(simplified)
+        if count < finer_count:
+            levels.append(to_geojson(simplified))
+            finer_count = count
+        else:
+            levels.append(None)
+    levels.reverse()
+    return levels
+
+
+def level_for_zoom(zoom: Optional[int]) -> int:
+    """Índice em geometry_levels do nível mais grosso que ainda serve ao zoom."""
+    if zoom is None:
+        return len(GEOMETRY_LEVEL_ZOOMS)
+    for index, level_zoom in enumerate(GEOMETRY_LEVEL_ZOOMS):
+        if zoom <= level_zoom:
+            return index
+    return len(GEOMETRY_LEVEL_ZOOMS)
+
+
+def pick_level(levels: Optional[Sequence[Optional[dict]]]) -> Optional[dict]:
+    """Primeira geometria preenchida de uma fatia de geometry_levels."""
+    return next((level for level in levels or () if level is not None), None)
@@ -0,0 +1,474 @@
+"""Leitura de arquivos KML em streaming.
+
+O arquivo é lido em pedaços e entregue a um parser incremental; os campos de
+cada ``Placemark`` são extraídos à medida que seus elementos terminam e cada
+elemento é descartado da árvore logo em seguida. A memória usada não depende do
+tamanho do arquivo. As localizações são entregues em lotes para que o chamador
+grave no banco aos poucos. Linhas e polígonos são guardados na íntegra, com
+versões simplificadas para o mapa (ver geometry).
+
+A leitura é síncrona: uploads são importados em um processo separado
+(ver kml_jobs), longe do event loop do servidor.
+"""
+import codecs
+import hashlib
+import os
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from geometry import Part, close_ring, geometry_levels, geometry_type
+from search_keys import search_terms
+
+
+KML_READ_CHUNK = 1024 * 1024
+KML_BATCH_SIZE = int(os.environ.get('KML_BATCH_SIZE', 1000))
+
+# '&' que não inicia uma entidade válida (comum em descrições exportadas à mão)
+_BARE_AMPERSAND = re.compile(r"&(?!(?:[A-Za-z][\w.-]*|#\d+|#x[0-9A-Fa-f]+);)")
+# Maior trecho que pode ficar pendente entre dois pedaços (uma entidade incompleta)
+_ENTITY_MAX_LENGTH = 16
+
+_COORDINATE = re.compile(r'^(-?\d+\.?\d*),(-?\d+\.?\d*)(?:,(-?\d+\.?\d*))?$')
+
+
+class InvalidKMLError(ValueError):
+    """Arquivo não pôde ser lido como KML."""
+
+
+def _latin1_fallback(error: UnicodeDecodeError):
+    # Bytes que não são UTF-8 válido são lidos como latin1
+    return error.object[error.start:error.end].decode('latin1'), error.end
+
+
+codecs.register_error("latin1_fallback", _latin1_fallback)
+
+
+class LenientDecoder:
+    """Decodifica os pedaços para texto corrigindo os problemas mais comuns de
+    arquivos exportados por outras ferramentas: bytes em latin1 misturados com
+    UTF-8, espaços antes da declaração XML e '&' sem escape."""
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="latin1_fallback")
+        self._pending = ""
+        self._started = False
+
+    def decode(self, data: bytes, final: bool = False) -> str:
+        text = self._pending + self._decoder.decode(data, final)
+        self._pending = ""
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        if not final:
+            # Uma entidade pode ter sido cortada no fim do pedaço
+            cut = text.rfind("&", max(0, len(text) - _ENTITY_MAX_LENGTH))
+            if cut != -1:
+                text, self._pending = text[:cut], text[cut:]
+        return _BARE_AMPERSAND.sub("&amp;", text)
+
+
+def local_name(tag: str) -> str:
+    # '{http://www.opengis.net/kml/2.2}Placemark' -> 'Placemark'
+    return tag.rsplit('}', 1)[-1]
+
+
+def _decode_coordinates_slow(coordinates: str) -> np.ndarray:
+    # Tuplas com dimensões misturadas ou tokens inválidos: uma a uma, ignorando as inválidas
+    rows = []
+    for part in coordinates.split():
+        # Formato: longitude,latitude[,altitude]
+        coord_match = _COORDINATE.match(part)
+        if coord_match:
+            rows.append([float(value) if value else 0.0 for value in coord_match.groups()])
+    return np.array(rows, dtype=np.float64).reshape(-1, 3)
+
+
+def decode_coordinates(coordinates: str) -> np.ndarray:
+    """Converte o texto de um <coordinates> em um array (n, 3) de lng, lat, alt,
+    descartando os vértices fora dos limites válidos."""
+    tuples = coordinates.split()
+    if not tuples:
+        return np.empty((0, 3))
+
+    dims = tuples[0].count(',') + 1
+    points = None
+    # Caso comum: todas as tuplas com o mesmo número de componentes
+    if dims in (2, 3) and coordinates.count(',') == len(tuples) * (dims - 1):
+        try:
+            values = np.array(coordinates.replace(',', ' ').split(), dtype=np.float64)
+            points = values.reshape(-1, dims)
+        except ValueError:
+            points = None
+    if points is None:
+        points = _decode_coordinates_slow(coordinates)
+    elif dims == 2:
+        points = np.column_stack((points, np.zeros(len(points))))
+
+    lng, lat = points[:, 0], points[:, 1]
+    valid = np.isfinite(points).all(axis=1) & (np.abs(lng) <= 180) & (np.abs(lat) <= 90)
+    return points if valid.all() else points[valid]
+
+
+def geo_point(longitude: float, latitude: float) -> dict:
+    """Ponto GeoJSON (indexado como 2dsphere no MongoDB)."""
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def summarize_coordinates(points: np.ndarray) -> dict:
+    """Campos de posição da localização: o ponto, ou o centro, a caixa
+    envolvente e a contagem de vértices de linhas e polígonos."""
+    if len(points) == 1:
+        return {'latitude': float(points[0, 1]), 'longitude': float(points[0, 0])}
+
+    lng_lat = points[:, :2]
+    center = lng_lat.mean(axis=0)
+    low = lng_lat.min(axis=0)
+    high = lng_lat.max(axis=0)
+    return {
+        'latitude': float(center[1]),
+        'longitude': float(center[0]),
+        'coordinate_count': len(points),
+        'bbox': [float(low[0]), float(low[1]), float(high[0]), float(high[1])],
+    }
+
+
+def geometry_key(parts: List[Part]) -> str:
+    """Tipo da geometria + hash de todas as coordenadas (6 casas decimais, ~0,1 m).
+
+    Um ponto, uma linha e um polígono com o mesmo nome e o mesmo primeiro vértice
+    têm chaves diferentes; duas geometrias só empatam se forem idênticas.
+    """
+    digest = hashlib.sha1()
+    for kind, lines in parts:
+        for line in lines:
+            digest.update(f"{kind}:{len(line)};".encode())
+            digest.update(np.round(line, 6).tobytes())
+    return f"{geometry_type(parts)}:{digest.hexdigest()}"
+
+
+def location_id(kml_id: str, key: str) -> str:
+    """Id estável da localização, derivado do arquivo e da identidade do Placemark."""
+    return hashlib.sha1(f"{kml_id}\n{key}".encode()).hexdigest()
+
+
+def legacy_location_id(kml_id: str, location: dict, seen: dict) -> str:
+    """Id das localizações gravadas antes do id estável (ver migrations.py).
+
+    Sem a geometria original, a identidade é nome + posição gravada; repetições
+    no mesmo arquivo (contadas em ``seen``, na ordem do arquivo) ganham um sufixo.
+    """
+    key = f"{location.get('name')}@{location['longitude']:.6f},{location['latitude']:.6f}"
+    seen[key] = seen.get(key, 0) + 1
+    if seen[key] > 1:
+        key = f"{key}#{seen[key]}"
+    return location_id(kml_id, key)
+
+
+def location_document(location: dict, kml_id: str) -> dict:
+    """Documento de kml_locations para uma localização lida do arquivo ``kml_id``."""
+    document = {key: value for key, value in location.items() if key != 'key'}
+    document['id'] = location_id(kml_id, location['key'])
+    document['kml_id'] = kml_id
+    return document
+
+
+def _decode_part(kind: str, rings: List[Tuple[str, bool]]) -> Optional[Part]:
+    """Parte da geometria (ver geometry.Part) a partir dos textos de <coordinates>."""
+    if kind == 'Polygon':
+        # Anel externo primeiro; anéis com menos de 3 vértices válidos são descartados
+        lines = []
+        for text, inner in sorted(rings, key=lambda ring: ring[1]):
+            ring = close_ring(decode_coordinates(text)[:, :2])
+            if ring is not None:
+                lines.append(ring)
+            elif not inner:
+                return None
+        return (kind, lines) if lines else None
+
+    points = decode_coordinates(rings[0][0])[:, :2] if rings else np.empty((0, 2))
+    if not len(points):
+        return None
+    if kind == 'Point' or len(points) == 1:
+        return 'Point', [points[:1]]
+    return 'LineString', [points]
+
+
+class _Placemark:
+    """Campos de um Placemark acumulados enquanto ele é lido."""
+    __slots__ = ("placemark_id", "name", "description", "extended_data", "data_name",
+                 "parts", "in_polygon", "inner_ring")
+
+    def __init__(self, placemark_id: Optional[str] = None):
+        self.placemark_id = placemark_id  # atributo id do <Placemark>, quando existe
+        self.name = None
+        self.description = None
+        self.extended_data = {}
+        self.data_name = None  # <Data name="..."> aberto no momento
+        self.parts = []  # [tipo, [(texto do <coordinates>, anel interno?)]] por geometria
+        self.in_polygon = False
+        self.inner_ring = False
+
+    def to_location(self) -> Optional[dict]:
+        """Localização do Placemark; None se não tiver coordenadas válidas."""
+        parts = [part for part in (_decode_part(kind, rings) for kind, rings in self.parts) if part]
+        if not parts:
+            return None
+        points = np.vstack([line for _, lines in parts for line in lines])
+
+        description = self.description or ''
+        # Dados estendidos são anexados à descrição
+        extra_info = [f"{key}: {value}" for key, value in self.extended_data.items() if value]
+        if extra_info:
+            description = "\n".join(([description] if description else []) + extra_info)
+
+        location = {'name': self.name or 'Unnamed Location', 'description': description}
+        # Identidade do Placemark no arquivo: o id do KML ou, sem ele, nome + geometria
+        if self.placemark_id:
+            location['key'] = f"#{self.placemark_id}"
+        else:
+            location['key'] = f"{location['name']}@{geometry_key(parts)}"
+        # Linhas e polígonos viram o centro dos vértices
+        location.update(summarize_coordinates(points))
+        location['point'] = geo_point(location['longitude'], location['latitude'])
+        location['search_terms'] = search_terms(location['name'], location['description'])
+        if len(points) > 1:
+            # Geometria inteira e simplificada; pontos simples ficam só em 'point'
+            location['geometry_levels'] = geometry_levels(parts, location['latitude'])
+        return location
+
+
+def _start_part(kind):
+    def handler(placemark, elem):
+        placemark.parts.append([kind, []])
+    return handler
+
+
+def _on_polygon_start(placemark, elem):
+    placemark.parts.append(['Polygon', []])
+    placemark.in_polygon = True
+
+
+def _on_linear_ring_start(placemark, elem):
+    # Fora de um <Polygon>, o anel é um polígono sem furos
+    if not placemark.in_polygon:
+        placemark.parts.append(['Polygon', []])
+
+
+def _on_data_start(placemark, elem):
+    placemark.data_name = elem.get('name', 'unknown')
+
+
+def _set_flag(attr, value):
+    def handler(placemark, elem):
+        setattr(placemark, attr, value)
+    return handler
+
+
+# Início de elementos dentro de um Placemark, pelo nome local da tag
+_START_HANDLERS = {
+    'Data': _on_data_start,
+    'Point': _start_part('Point'),
+    'LineString': _start_part('LineString'),
+    'Polygon': _on_polygon_start,
+    'LinearRing': _on_linear_ring_start,
+    'innerBoundaryIs': _set_flag('inner_ring', True),
+}
+
+
+def _on_coordinates(placemark, elem):
+    if not (elem.text and elem.text.strip()):
+        return
+    if not placemark.parts:
+        # <coordinates> fora de uma geometria conhecida: ponto ou linha, pelo conteúdo
+        placemark.parts.append(['LineString', []])
+    placemark.parts[-1][1].append((elem.text, placemark.inner_ring))
+
+
+def _first_text(attr):
+    # Guarda só o primeiro texto não vazio do campo (ex.: o <name> do Placemark,
+    # não o de um elemento aninhado depois dele)
+    def handler(placemark, elem):
+        if getattr(placemark, attr) is None and elem.text and elem.text.strip():
+            setattr(placemark, attr, elem.text.strip())
+    return handler
+
+
+def _on_simple_data(placemark, elem):
+    placemark.extended_data[elem.get('name', 'unknown')] = elem.text or ''
+
+
+def _on_value(placemark, elem):
+    # Só o primeiro <value> de cada <Data>
+    if placemark.data_name is not None:
+        placemark.extended_data[placemark.data_name] = elem.text or ''
+        placemark.data_name = None
+
+
+# Campos extraídos no fim de cada elemento, pelo nome local da tag
+_END_HANDLERS = {
+    'name': _first_text('name'),
+    'description': _first_text('description'),
+    'coordinates': _on_coordinates,
+    'Polygon': _set_flag('in_polygon', False),
+    'innerBoundaryIs': _set_flag('inner_ring', False),
+    'SimpleData': _on_simple_data,
+    'value': _on_value,
+}
+
+
+class PlacemarkStream:
+    """Parser incremental: recebe o arquivo em pedaços via feed() e devolve as
+    localizações dos Placemarks que terminaram naquele pedaço.
+
+    Cada elemento é visitado uma única vez: os campos são extraídos no evento
+    de fim do elemento, despachando pelo nome local da tag (resolvido uma vez
+    por tag distinta), e o elemento é descartado em seguida.
+    """
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._open = []  # elementos abertos, do root até o atual
+        self._local_names = {}  # tag completa -> nome local
+        self._placemark = None
+        self.placemarks = 0  # Placemarks lidos até agora
+        self.skipped = 0  # ...dos quais sem coordenadas válidas
+
+    def feed(self, data) -> List[dict]:
+        self._parser.feed(data)
+        return self._drain()
+
+    def close(self) -> List[dict]:
+        self._parser.close()
+        return self._drain()
+
+    def _local_name(self, tag: str) -> str:
+        name = self._local_names.get(tag)
+        if name is None:
+            name = self._local_names[tag] = local_name(tag)
+        return name
+
+    def _drain(self) -> List[dict]:
+        locations = []
+        for event, elem in self._parser.read_events():
+            tag = self._local_name(elem.tag)
+            if event == "start":
+                self._open.append(elem)
+                if tag == 'Placemark':
+                    self._placemark = _Placemark(elem.get('id'))
+                elif self._placemark is not None:
+                    handler = _START_HANDLERS.get(tag)
+                    if handler:
+                        handler(self._placemark, elem)
+                continue
+
+            self._open.pop()
+            placemark = self._placemark
+            if placemark is not None:
+                if tag == 'Placemark':
+                    location = placemark.to_location()
+                    self.placemarks += 1
+                    if location:
+                        locations.append(location)
+                    else:
+                        self.skipped += 1
+                    self._placemark = None
+                else:
+                    handler = _END_HANDLERS.get(tag)
+                    if handler:
+                        handler(placemark, elem)
+
+            # O conteúdo já foi aproveitado: libera o elemento
+            elem.clear()
+            if self._open:
+                self._open[-1].remove(elem)
+        return locations
+
+
+def parse_placemarks(chunks: Iterable) -> Iterator[dict]:
+    """Localizações de um KML entregue em pedaços (bytes ou texto), em ordem."""
+    stream = PlacemarkStream()
+    for chunk in chunks:
+        yield from stream.feed(chunk)
+    yield from stream.close()
+
+
+def kmz_main_entry(archive: zipfile.ZipFile) -> str:
+    """Nome do KML principal do KMZ: doc.kml na raiz ou, sem ele, o primeiro .kml."""
+    names = [info.filename for info in archive.infolist() if info.filename.lower().endswith('.kml')]
+    if not names:
+        raise InvalidKMLError("Arquivo KMZ não contém nenhum KML")
+    return 'doc.kml' if 'doc.kml' in names else names[0]
+
+
+class KmzReader:
+    """KML principal de um KMZ, descompactado sob demanda.
+
+    Tem a mesma interface (read/seek) de um arquivo, então os pedaços vão direto
+    do zip para o parser, sem gravar nem manter o KML descompactado.
+    """
+
+    def __init__(self, fileobj):
+        try:
+            self._archive = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile:
+            raise InvalidKMLError("Arquivo KMZ inválido ou corrompido")
+        self.entry = kmz_main_entry(self._archive)
+        self._stream = self._archive.open(self.entry)
+
+    def read(self, size: int = -1) -> bytes:
+        try:
+            return self._stream.read(size)
+        except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+            raise InvalidKMLError(f"Arquivo KMZ corrompido: {e}")
+
+    def seek(self, offset: int) -> None:
+        # Só volta ao início (nova leitura no modo tolerante)
+        self._stream.close()
+        self._stream = self._archive.open(self.entry)
+        if offset:
+            self._stream.read(offset)
+
+    def close(self) -> None:
+        self._stream.close()
+        self._archive.close()
+
+
+def read_location_batches(
+    source: BinaryIO,
+    stream: PlacemarkStream,
+    lenient: bool = False,
+    batch_size: int = KML_BATCH_SIZE,
+) -> Iterator[List[dict]]:
+    """Lê o arquivo (ou KmzReader) em pedaços e devolve as localizações em lotes
+    de até ``batch_size``. Os contadores de ``stream`` acompanham o progresso.
+
+    No modo ``lenient`` o conteúdo passa pelo LenientDecoder antes do parser.
+    """
+    decoder = LenientDecoder() if lenient else None
+    batch = []
+    try:
+        while True:
+            chunk = source.read(KML_READ_CHUNK)
+            final = not chunk
+            data = decoder.decode(chunk, final) if decoder else chunk
+            locations = stream.feed(data) if data else []
+            if final:
+                locations += stream.close()
+
+            for location in locations:
+                batch.append(location)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if final:
+                break
+    except ET.ParseError as e:
+        raise InvalidKMLError(str(e))
+
+    if batch:
+        yield batch
@@ -0,0 +1,581 @@
+"""Importação de arquivos KML em segundo plano.
+
+O upload só grava o arquivo em disco e cria um job em ``kml_jobs``; a leitura
+roda em um pool de processos, longe do event loop, e grava direto no banco com
+o pymongo síncrono. O worker atualiza o progresso (bytes lidos, Placemarks,
+erros e ETA) no documento do job, que o servidor apenas consulta.
+
+No modo de substituição (``replace``) o arquivo novo é aplicado sobre um
+arquivo já importado: as localizações são casadas pelo id estável (ou pelo id
+legado, das gravadas antes dele) e só as inseridas, alteradas ou removidas são
+gravadas.
+
+O conteúdo é resumido (SHA-256) enquanto é gravado em disco; um upload igual a
+um arquivo já importado não é lido de novo.
+
+Com vários workers do servidor, cada job pertence ao worker que o criou
+(``owner``), que renova ``heartbeat_at`` enquanto o job não termina. Um job só
+é dado como interrompido quando o heartbeat expira.
+"""
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+from pymongo import DeleteMany, InsertOne, MongoClient, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from kml_ingest import (
+    KML_READ_CHUNK,
+    InvalidKMLError,
+    KmzReader,
+    PlacemarkStream,
+    legacy_location_id,
+    location_document,
+    read_location_batches,
+)
+from location_search import mark_kml_changed
+
+
+logger = logging.getLogger(__name__)
+
+# Onde os uploads ficam até o worker terminar de lê-los
+KML_SPOOL_DIR = Path(os.environ.get('KML_SPOOL_DIR', Path(tempfile.gettempdir()) / 'kml_uploads'))
+KML_JOB_WORKERS = int(os.environ.get('KML_JOB_WORKERS', 2))
+# Intervalo mínimo, em segundos, entre duas gravações de progresso
+KML_PROGRESS_INTERVAL = 1.0
+
+# Ids de localizações removidas por operação DeleteMany
+KML_REMOVE_BATCH_SIZE = 1000
+
+# Campos do job que não vão na resposta da API
+KML_JOB_PROJECTION = {"_id": 0, "path": 0}
+
+# Status de job ainda não encerrado
+KML_JOB_UNFINISHED = ["queued", "running"]
+# Intervalo, em segundos, entre dois heartbeats do worker dono dos jobs
+KML_JOB_HEARTBEAT_INTERVAL = float(os.environ.get('KML_JOB_HEARTBEAT_INTERVAL', 30))
+# Sem heartbeat há mais que isso, o job é dado como interrompido
+KML_JOB_HEARTBEAT_TIMEOUT = float(os.environ.get('KML_JOB_HEARTBEAT_TIMEOUT', 120))
+
+
+class DuplicateKMLError(Exception):
+    """O conteúdo enviado é idêntico ao de um arquivo já importado (``kml_data``)."""
+
+    def __init__(self, kml_data: dict):
+        super().__init__(kml_data["id"])
+        self.kml_data = kml_data
+
+
+def save_locations(db, kml_id: str, locations: list) -> Tuple[int, int]:
+    """Grava um lote de localizações; devolve quantas foram inseridas e quantas eram repetidas."""
+    documents = [location_document(location, kml_id) for location in locations]
+    try:
+        return len(db.kml_locations.insert_many(documents, ordered=False).inserted_ids), 0
+    except BulkWriteError as e:
+        # Placemarks repetidos (mesmo id ou mesmo nome e geometria no arquivo) são
+        # gravados uma vez só e contados no job
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        return e.details["nInserted"], len(e.details["writeErrors"])
+
+
+def duplicates_message(duplicates: int) -> str:
+    return (
+        f"{duplicates} Placemark(s) repetido(s) ignorado(s): mesmo id, ou mesmo nome e "
+        "geometria, de outro Placemark do arquivo"
+    )
+
+
+class _JobProgress:
+    """Grava o progresso do job, no máximo uma vez por KML_PROGRESS_INTERVAL."""
+
+    def __init__(self, db, job: dict, raw):
+        self._db = db
+        self._job_id = job["id"]
+        self._size = job["size"]
+        self._raw = raw  # arquivo em disco: a posição dele mede o avanço (também no KMZ)
+        self._started = time.monotonic()
+        self._saved = 0.0
+
+    def update(self, stream: PlacemarkStream, counts: dict, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._saved < KML_PROGRESS_INTERVAL:
+            return
+        self._saved = now
+        position = min(self._raw.tell(), self._size)
+        eta = None
+        if position:
+            eta = round((now - self._started) * (self._size - position) / position, 1)
+        self._db.kml_jobs.update_one({"id": self._job_id}, {"$set": {
+            "bytes_read": position,
+            "placemarks": stream.placemarks,
+            "skipped": stream.skipped,
+            "eta_seconds": eta,
+            **counts,
+        }})
+
+
+class _NewFileWriter:
+    """Grava as localizações de um arquivo novo."""
+
+    def __init__(self, db, kml_id: str):
+        self._db = db
+        self._kml_id = kml_id
+        self.locations = 0
+        self.duplicates = 0
+
+    def restart(self) -> None:
+        # Nova leitura do zero (modo tolerante): descarta o que já foi gravado
+        self._db.kml_locations.delete_many({"kml_id": self._kml_id})
+        self.locations = 0
+        self.duplicates = 0
+
+    def write(self, locations: list) -> None:
+        inserted, duplicates = save_locations(self._db, self._kml_id, locations)
+        self.locations += inserted
+        self.duplicates += duplicates
+
+    def finish(self) -> None:
+        pass
+
+    def counts(self) -> dict:
+        return {"locations": self.locations, "duplicates": self.duplicates}
+
+
+class _ReplaceWriter:
+    """Aplica o arquivo novo sobre as localizações de um arquivo já importado.
+
+    Como os ids são derivados do arquivo e da identidade do Placemark, o mesmo
+    Placemark tem o mesmo id nas duas versões: cada lote é comparado com os
+    documentos atuais e só as diferenças vão para o bulk_write. Localizações
+    migradas de antes do id estável (legacy_location_id) são casadas pelo id
+    legado e regravadas com o id novo. No fim, os ids que não apareceram no
+    arquivo novo são removidos.
+    """
+
+    def __init__(self, db, kml_id: str):
+        self._db = db
+        self._kml_id = kml_id
+        self._seen = set()  # ids presentes no arquivo novo
+        self._legacy_seen = {}  # contagem de legacy_location_id, na ordem do arquivo
+        # O que este job já gravou (id -> "inserted"/"changed"): sobrevive ao restart
+        self._written = {}
+        self._reset_counts()
+
+    def _reset_counts(self) -> None:
+        self.inserted = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.duplicates = 0
+
+    @property
+    def locations(self) -> int:
+        return len(self._seen)
+
+    def restart(self) -> None:
+        # O que já foi gravado continua valendo: a nova leitura compara de novo e
+        # conta como na primeira o que este job já tinha inserido ou alterado
+        self._seen.clear()
+        self._legacy_seen.clear()
+        self._reset_counts()
+
+    def _count(self, location_id: str, operation: str) -> None:
+        operation = self._written.get(location_id, operation)
+        setattr(self, operation, getattr(self, operation) + 1)
+
+    def write(self, locations: list) -> None:
+        documents = {}
+        legacy_ids = {}  # id legado -> id novo
+        for location in locations:
+            document = location_document(location, self._kml_id)
+            # Avança a contagem dos ids legados também para os repetidos
+            legacy_id = legacy_location_id(self._kml_id, location, self._legacy_seen)
+            # Placemarks repetidos no arquivo: vale o primeiro, os outros são contados
+            if document["id"] in self._seen:
+                self.duplicates += 1
+            else:
+                self._seen.add(document["id"])
+                documents[document["id"]] = document
+                legacy_ids[legacy_id] = document["id"]
+
+        current = {
+            document["id"]: document
+            for document in self._db.kml_locations.find(
+                {"kml_id": self._kml_id, "id": {"$in": list(documents) + list(legacy_ids)}}, {"_id": 0}
+            )
+        }
+        legacy = {legacy_ids[legacy_id]: legacy_id for legacy_id in legacy_ids if legacy_id in current}
+        operations = []
+        for location_id, document in documents.items():
+            existing = current.get(location_id)
+            if existing is None and location_id in legacy:
+                # Gravada antes do id estável: regrava no lugar, já com o id novo
+                operations.append(ReplaceOne({"id": legacy[location_id]}, document))
+                self._written[location_id] = "changed"
+                self._count(location_id, "changed")
+            elif existing is None:
+                operations.append(InsertOne(document))
+                self._written[location_id] = "inserted"
+                self._count(location_id, "inserted")
+            elif existing != document:
+                operations.append(ReplaceOne({"id": location_id}, document))
+                self._written.setdefault(location_id, "changed")
+                self._count(location_id, "changed")
+            else:
+                self._count(location_id, "unchanged")
+        if operations:
+            self._db.kml_locations.bulk_write(operations, ordered=False)
+
+    def finish(self) -> None:
+        removed = []
+        operations = []
+        for document in self._db.kml_locations.find({"kml_id": self._kml_id}, {"_id": 0, "id": 1}):
+            if document["id"] not in self._seen:
+                removed.append(document["id"])
+                if len(removed) == KML_REMOVE_BATCH_SIZE:
+                    operations.append(DeleteMany({"id": {"$in": removed}}))
+                    removed = []
+        if removed:
+            operations.append(DeleteMany({"id": {"$in": removed}}))
+        if operations:
+            self.removed = self._db.kml_locations.bulk_write(operations, ordered=False).deleted_count
+
+    def counts(self) -> dict:
+        return {
+            "locations": self.locations,
+            "inserted": self.inserted,
+            "changed": self.changed,
+            "unchanged": self.unchanged,
+            "removed": self.removed,
+            "duplicates": self.duplicates,
+        }
+
+
+def _ingest(db, job: dict, raw, source, writer, lenient: bool) -> None:
+    progress = _JobProgress(db, job, raw)
+    stream = PlacemarkStream()
+    for batch in read_location_batches(source, stream, lenient):
+        writer.write(batch)
+        progress.update(stream, writer.counts())
+    progress.update(stream, writer.counts(), force=True)
+
+
+def ingest_kml_file(db, job: dict) -> dict:
+    """Lê o arquivo do job e grava as localizações; devolve os contadores finais."""
+    replace = job.get("mode") == "replace"
+    writer = (_ReplaceWriter if replace else _NewFileWriter)(db, job["kml_id"])
+    with open(job["path"], 'rb') as raw:
+        # KMZ: o KML interno é descompactado em pedaços direto para o parser
+        source = KmzReader(raw) if job["filename"].lower().endswith('.kmz') else raw
+        try:
+            try:
+                _ingest(db, job, raw, source, writer, lenient=False)
+            except InvalidKMLError as e:
+                # Try to fix common XML issues ('&' sem escape, latin1) lendo de novo
+                writer.restart()
+                db.kml_jobs.update_one(
+                    {"id": job["id"]},
+                    {"$push": {"errors": f"XML inválido ({e}); relendo no modo tolerante"}},
+                )
+                source.seek(0)
+                _ingest(db, job, raw, source, writer, lenient=True)
+
+            if not writer.locations:
+                source.seek(0)
+                debug_content = source.read(1000).decode('utf-8', errors='replace')
+                raise InvalidKMLError(
+                    "Nenhuma localização válida encontrada no arquivo KML. Verifique se o arquivo "
+                    f"contém elementos Placemark com coordenadas válidas. Debug: {debug_content}"
+                )
+        finally:
+            if source is not raw:
+                source.close()
+
+    # Remoções só depois do arquivo inteiro lido: um arquivo inválido não apaga nada
+    writer.finish()
+    return writer.counts()
+
+
+def _fail_job(db, job: dict, error: str) -> None:
+    if job.get("mode") == "replace":
+        # O arquivo antigo continua ativo; reenviar aplica de novo só o que faltou
+        error += " (alterações já gravadas foram mantidas; envie o arquivo novamente)"
+        mark_kml_changed(db)
+    else:
+        db.kml_locations.delete_many({"kml_id": job["kml_id"]})
+        db.kml_data.delete_one({"id": job["kml_id"]})
+    db.kml_jobs.update_one({"id": job["id"]}, {
+        "$set": {"status": "failed", "finished_at": datetime.now(timezone.utc), "eta_seconds": None},
+        "$push": {"errors": error},
+    })
+
+
+def _run_job(db, job_id: str) -> str:
+    job = db.kml_jobs.find_one_and_update(
+        {"id": job_id},
+        {"$set": {"status": "running", "started_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    try:
+        counts = ingest_kml_file(db, job)
+    except InvalidKMLError as e:
+        _fail_job(db, job, f"Arquivo KML inválido ou corrompido: {e}")
+        return "failed"
+    except Exception as e:
+        logger.exception("Falha na importação KML %s", job_id)
+        _fail_job(db, job, f"Erro ao processar arquivo KML: {e}")
+        return "failed"
+    finally:
+        Path(job["path"]).unlink(missing_ok=True)
+
+    # Só agora o arquivo novo aparece nas consultas; no replace ele já estava ativo
+    update = {"status": "active", "total_locations": counts["locations"]}
+    if job.get("mode") == "replace":
+        update.update(
+            filename=job["filename"],
+            uploaded_by=job["uploaded_by"],
+            uploaded_at=job["created_at"],
+            content_hash=job["content_hash"],
+        )
+    try:
+        db.kml_data.update_one({"id": job["kml_id"]}, {"$set": update})
+    except DuplicateKeyError:
+        # Outro arquivo com este mesmo conteúdo foi enviado durante o replace:
+        # o índice único fica com ele, e este arquivo segue sem hash
+        del update["content_hash"]
+        db.kml_data.update_one({"id": job["kml_id"]}, {"$set": update, "$unset": {"content_hash": ""}})
+    # Os índices de busca de todos os workers do servidor são reconstruídos
+    mark_kml_changed(db)
+    done = {"$set": {
+        "status": "done",
+        "eta_seconds": 0,
+        "finished_at": datetime.now(timezone.utc),
+        **counts,
+    }}
+    if counts["duplicates"]:
+        done["$push"] = {"errors": duplicates_message(counts["duplicates"])}
+    db.kml_jobs.update_one({"id": job_id}, done)
+    return "done"
+
+
+def run_kml_job(mongo_url: str, db_name: str, job_id: str) -> str:
+    """Executa o job no processo do pool. Devolve o status final."""
+    client = MongoClient(mongo_url)
+    try:
+        return _run_job(client[db_name], job_id)
+    finally:
+        client.close()
+
+
+def _spool(fileobj, path: Path) -> Tuple[int, str]:
+    """Copia o upload para ``path``; devolve o tamanho e o SHA-256 do conteúdo."""
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as spooled:
+        while True:
+            chunk = fileobj.read(KML_READ_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+            spooled.write(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class KmlJobs:
+    """Cria os jobs de importação e os executa no pool de processos."""
+
+    def __init__(self, db, mongo_url: str, db_name: str, on_done: Callable[[], None]):
+        self.db = db
+        self._mongo_url = mongo_url
+        self._db_name = db_name
+        self._on_done = on_done  # chamado quando um job termina com sucesso
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Identifica este worker do servidor como dono dos jobs que ele cria
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: o worker não herda o event loop nem as conexões do servidor
+            self._executor = ProcessPoolExecutor(
+                KML_JOB_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def submit(self, upload, uploaded_by: str, replace: Optional[str] = None) -> dict:
+        """Grava o upload em disco, cria o arquivo KML (em "processing") e o job.
+
+        Com ``replace`` (id de um arquivo ativo) o upload substitui aquele arquivo.
+        Levanta DuplicateKMLError se o conteúdo já tiver sido importado.
+        """
+        KML_SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+        job_id = str(uuid.uuid4())
+        path = KML_SPOOL_DIR / f"{job_id}{Path(upload.filename).suffix.lower()}"
+        size, content_hash = await asyncio.to_thread(_spool, upload.file, path)
+
+        duplicate = await self._duplicate(content_hash)
+        if duplicate:
+            path.unlink(missing_ok=True)
+            raise DuplicateKMLError(duplicate)
+
+        now = datetime.now(timezone.utc)
+        # kml_data guarda só os metadados; as localizações vão para kml_locations.
+        # O arquivo fica em "processing" (invisível nas consultas) até o job terminar
+        kml_data = {
+            "id": replace or str(uuid.uuid4()),
+            "filename": upload.filename,
+            "uploaded_by": uploaded_by,
+            "uploaded_at": now,
+            "total_locations": 0,
+            "content_hash": content_hash,
+            "status": "processing",
+        }
+        job = {
+            "id": job_id,
+            "kml_id": kml_data["id"],
+            "mode": "replace" if replace else "new",
+            "filename": upload.filename,
+            "uploaded_by": uploaded_by,
+            "status": "queued",
+            "path": str(path),
+            "size": size,
+            "content_hash": content_hash,
+            "bytes_read": 0,
+            "placemarks": 0,
+            "skipped": 0,
+            "locations": 0,
+            "duplicates": 0,
+            "errors": [],
+            "eta_seconds": None,
+            "created_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "owner": self.worker_id,
+            "heartbeat_at": now,
+        }
+        if not replace:
+            try:
+                await self.db.kml_data.insert_one(kml_data)
+            except DuplicateKeyError:
+                # Upload igual e simultâneo passou pela consulta acima antes deste;
+                # o índice único de content_hash barra o segundo
+                duplicate = await self._duplicate(content_hash)
+                if duplicate is None:
+                    raise
+                path.unlink(missing_ok=True)
+                raise DuplicateKMLError(duplicate)
+        await self.db.kml_jobs.insert_one(job)
+
+        future = self._pool().submit(run_kml_job, self._mongo_url, self._db_name, job_id)
+        asyncio.get_running_loop().create_task(self._wait(job, asyncio.wrap_future(future)))
+        return job
+
+    async def _duplicate(self, content_hash: str) -> Optional[dict]:
+        """Arquivo KML já importado (ou em importação) com o mesmo conteúdo"""
+        return await self.db.kml_data.find_one(
+            {"content_hash": content_hash, "status": {"$in": ["active", "processing"]}},
+            {"_id": 0, "id": 1, "filename": 1, "uploaded_by": 1, "uploaded_at": 1, "status": 1},
+        )
+
+    async def _wait(self, job: dict, future) -> None:
+        try:
+            status = await future
+        except Exception as e:
+            # O worker morreu (ou o pool quebrou): o job não se encerrou sozinho
+            logger.error("Importação KML %s interrompida: %s", job["id"], e)
+            await self._abandon(job, f"Falha no processo de importação: {e}")
+            return
+        if status == "done":
+            self._on_done()
+
+    async def _abandon(self, job: dict, error: str, claim: Optional[dict] = None) -> bool:
+        """Marca o job como falho e desfaz o arquivo novo; False se ele já tinha encerrado.
+
+        ``claim`` restringe a marcação (ex.: ao heartbeat visto), para que dois
+        workers não encerrem o mesmo job nem um job que voltou a dar sinal de vida.
+        """
+        result = await self.db.kml_jobs.update_one(
+            {"id": job["id"], "status": {"$in": KML_JOB_UNFINISHED}, **(claim or {})},
+            {
+                "$set": {"status": "failed", "finished_at": datetime.now(timezone.utc), "eta_seconds": None},
+                "$push": {"errors": error},
+            },
+        )
+        if not result.modified_count:
+            return False
+        if job.get("mode") == "replace":
+            await mark_kml_changed(self.db)
+        else:
+            await self.db.kml_locations.delete_many({"kml_id": job["kml_id"]})
+            await self.db.kml_data.delete_one({"id": job["kml_id"]})
+        Path(job["path"]).unlink(missing_ok=True)
+        return True
+
+    async def heartbeat(self) -> None:
+        """Renova o heartbeat dos jobs deste worker que ainda não terminaram."""
+        await self.db.kml_jobs.update_many(
+            {"owner": self.worker_id, "status": {"$in": KML_JOB_UNFINISHED}},
+            {"$set": {"heartbeat_at": datetime.now(timezone.utc)}},
+        )
+
+    async def recover(self) -> int:
+        """Encerra os jobs cujo worker parou de dar heartbeat (reiniciado ou morto).
+
+        Jobs de outros workers ainda vivos não são tocados.
+        """
+        expired = datetime.now(timezone.utc) - timedelta(seconds=KML_JOB_HEARTBEAT_TIMEOUT)
+        jobs = await self.db.kml_jobs.find({
+            "status": {"$in": KML_JOB_UNFINISHED},
+            "owner": {"$ne": self.worker_id},
+            "$or": [{"heartbeat_at": {"$lt": expired}}, {"heartbeat_at": {"$exists": False}}],
+        }).to_list(length=None)
+        abandoned = 0
+        for job in jobs:
+            claim = {"heartbeat_at": job.get("heartbeat_at")}
+            if await self._abandon(job, "Importação interrompida: o servidor foi reiniciado", claim):
+                abandoned += 1
+        return abandoned
+
+    async def _keep_alive(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.heartbeat()
+                abandoned = await self.recover()
+                if abandoned:
+                    logger.warning("Importações KML sem heartbeat encerradas: %d", abandoned)
+            except Exception as e:
+                logger.error("Falha no heartbeat dos jobs KML: %s", e)
+
+    async def start(self, interval: float = KML_JOB_HEARTBEAT_INTERVAL) -> int:
+        """Encerra os jobs interrompidos e inicia o heartbeat; devolve quantos foram encerrados."""
+        abandoned = await self.recover()
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.get_running_loop().create_task(self._keep_alive(interval))
+        return abandoned
+
+    async def running_for(self, kml_id: str) -> Optional[dict]:
+        """Job ainda não encerrado sobre o arquivo ``kml_id``, se houver."""
+        return await self.db.kml_jobs.find_one(
+            {"kml_id": kml_id, "status": {"$in": KML_JOB_UNFINISHED}}, KML_JOB_PROJECTION
+        )
+
+    def shutdown(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,233 @@
+"""Índice de busca em memória das localizações KML.
+
+A busca por nome/descrição usava um substring sobre todas as localizações a
+cada requisição. Aqui os textos são normalizados uma vez e indexados por
+trigramas: cada palavra da consulta intersecta as listas de postings dos seus
+trigramas (ou, para palavras de 1 ou 2 caracteres, une as listas dos trigramas
+que começam por elas), os candidatos das palavras são intersectados, o
+substring de cada palavra é confirmado e o resultado é ordenado pelo tipo de
+correspondência. A regra é a de search_keys.terms_query, usada enquanto o
+índice não está pronto. O índice é imutável; uploads e exclusões de arquivos
+reconstroem um novo em segundo plano e o trocam atomicamente.
+
+Cada worker do servidor tem o seu índice. Quem altera as localizações
+incrementa a geração em ``db.generations`` (mark_kml_changed); cada worker
+confere a geração periodicamente e reconstrói o índice quando ela muda.
+"""
+import asyncio
+import bisect
+import heapq
+import logging
+import os
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+from search_keys import fold, query_words
+
+
+logger = logging.getLogger(__name__)
+
+GRAM = 3
+# Marcador de fim de texto: garante que todo par de caracteres inicie um trigrama
+_END = "\0"
+
+# Documento de db.generations incrementado a cada alteração das localizações KML
+KML_GENERATION = {"_id": "kml_locations"}
+# Intervalo, em segundos, entre duas conferências da geração
+SEARCH_INDEX_CHECK_INTERVAL = float(os.environ.get('SEARCH_INDEX_CHECK_INTERVAL', 10))
+
+
+def mark_kml_changed(db):
+    """Incrementa a geração das localizações KML.
+
+    Serve ao motor (devolve o awaitable) e ao pymongo síncrono dos jobs.
+    """
+    return db.generations.update_one(KML_GENERATION, {"$inc": {"value": 1}}, upsert=True)
+
+
+def normalize(text: Optional[str]) -> str:
+    # Sem acento e em minúsculas: "estacao" encontra "Estação"
+    return fold(text)
+
+
+def grams(text: str) -> set:
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+class LocationSearchIndex:
+    """Índice de trigramas sobre (chave, nome, descrição) de cada localização."""
+
+    def __init__(self, entries: Iterable[Tuple[object, str, str]] = ()):
+        self.keys = []
+        self._names = []
+        self._descriptions = []
+        postings = {}
+        for key, name, description in entries:
+            doc = len(self.keys)
+            self.keys.append(key)
+            name = normalize(name)
+            description = normalize(description)
+            self._names.append(name)
+            self._descriptions.append(description)
+            for gram in grams(name + _END) | grams(description + _END):
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array('I')
+                posting.append(doc)
+        self._postings = postings
+        self._gram_keys = sorted(postings)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _candidates(self, query: str) -> Iterable[int]:
+        if len(query) < GRAM:
+            # Consulta curta: todos os trigramas que começam por ela
+            start = bisect.bisect_left(self._gram_keys, query)
+            docs = set()
+            for gram in self._gram_keys[start:]:
+                if not gram.startswith(query):
+                    break
+                docs.update(self._postings[gram])
+            return docs
+
+        lists = []
+        for gram in grams(query):
+            posting = self._postings.get(gram)
+            if posting is None:
+                return ()
+            lists.append(posting)
+        lists.sort(key=len)
+        # As duas menores listas já filtram quase tudo; o substring confirma o resto
+        docs = set(lists[0])
+        if len(lists) > 1:
+            docs.intersection_update(lists[1])
+        return docs
+
+    def _rank(self, doc: int, query: str, words: List[str]) -> Optional[tuple]:
+        name = self._names[doc]
+        description = self._descriptions[doc]
+        if not all(word in name or word in description for word in words):
+            return None
+        position = name.find(query)
+        if position == 0:
+            score = 0
+        elif position > 0:
+            # Início de palavra vale mais que o meio dela
+            score = 1 if not name[position - 1].isalnum() else 2
+        elif all(word in name for word in words):
+            score = 3
+        else:
+            score = 4
+        return score, len(name), name, doc
+
+    def search(self, query: str, limit: int) -> List[object]:
+        """Chaves das localizações em que cada palavra de ``query`` aparece, das mais relevantes às menos."""
+        words = query_words(query)
+        if not words:
+            return []
+        docs = None
+        # Palavras de 1 caractere não filtram candidatos (o último caractere do
+        # texto não inicia trigrama); o _rank confere todas as palavras
+        for word in sorted((word for word in words if len(word) > 1), key=len, reverse=True):
+            candidates = self._candidates(word)
+            docs = set(candidates) if docs is None else docs.intersection(candidates)
+            if not docs:
+                return []
+        if docs is None:
+            docs = range(len(self.keys))
+        query = normalize(query.strip())
+        ranked = (self._rank(doc, query, words) for doc in docs)
+        best = heapq.nsmallest(limit, (rank for rank in ranked if rank))
+        return [self.keys[rank[-1]] for rank in best]
+
+
+class LocationSearch:
+    """Mantém o índice das localizações dos arquivos KML ativos."""
+
+    def __init__(self, db):
+        self.db = db
+        self.index = LocationSearchIndex()
+        self.ready = False
+        self.generation = None  # geração das localizações usada no índice atual
+        self._lock = asyncio.Lock()
+        self._pending = False
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def rebuild(self) -> None:
+        # Pedidos que chegam durante uma reconstrução são atendidos por mais uma
+        # única passada ao final, não por uma passada cada
+        self._pending = True
+        if self._lock.locked():
+            return
+        async with self._lock:
+            while self._pending:
+                self._pending = False
+                await self._rebuild()
+
+    async def _generation(self) -> int:
+        marker = await self.db.generations.find_one(KML_GENERATION)
+        return marker["value"] if marker else 0
+
+    async def _rebuild(self) -> None:
+        # Lida antes dos dados: uma alteração durante a leitura dispara outra passada
+        generation = await self._generation()
+        active = await self.db.kml_data.distinct("id", {"status": "active"})
+        entries = []
+        cursor = self.db.kml_locations.find(
+            {"kml_id": {"$in": active}}, {"_id": 0, "id": 1, "name": 1, "description": 1}
+        )
+        async for location in cursor:
+            entries.append((location["id"], location.get("name"), location.get("description")))
+
+        # Construção só em Python: fora do event loop, para não travar as requisições
+        self.index = await asyncio.to_thread(LocationSearchIndex, entries)
+        self.generation = generation
+        self.ready = True
+        logger.info("Índice de busca de localizações reconstruído: %d localizações", len(self.index))
+
+    def schedule_rebuild(self) -> None:
+        task = asyncio.get_running_loop().create_task(self.rebuild())
+        task.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logger.error("Falha ao reconstruir o índice de busca: %s", task.exception())
+
+    async def changed(self) -> None:
+        """Registra uma alteração das localizações e reconstrói o índice deste worker."""
+        await mark_kml_changed(self.db)
+        self.schedule_rebuild()
+
+    async def refresh(self) -> bool:
+        """Reconstrói o índice se outro worker (ou um job) alterou as localizações."""
+        if self._lock.locked():
+            return False
+        # Sem geração o índice nunca foi construído (ex.: banco fora do ar na subida)
+        if self.generation is not None and await self._generation() == self.generation:
+            return False
+        await self.rebuild()
+        return True
+
+    async def _watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("Falha ao conferir a geração do índice de busca: %s", e)
+
+    def start(self, interval: float = SEARCH_INDEX_CHECK_INTERVAL) -> None:
+        """Constrói o índice e passa a conferir a geração a cada ``interval`` segundos."""
+        self.schedule_rebuild()
+        if self._watcher is None:
+            self._watcher = asyncio.get_running_loop().create_task(self._watch(interval))
+
+    def stop(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    def search(self, query: str, limit: int) -> List[object]:
+        return self.index.search(query, limit)
@@ -0,0 +1,271 @@
+"""Migrações de dados do backend.
+
+Uso (a partir da pasta backend, com o mesmo .env do servidor):
+
+    python migrations.py photos        # move fotos inline das pendências para o photo store
+    python migrations.py thumbnails    # gera miniaturas das fotos gravadas antes delas existirem
+    python migrations.py users         # completa usuários legados (também roda na inicialização)
+    python migrations.py kml           # move localizações embutidas em kml_data (também roda na inicialização)
+    python migrations.py kml-points    # cria o ponto GeoJSON das localizações antigas (também roda na inicialização)
+    python migrations.py search-terms  # calcula as chaves de busca sem acento (também roda na inicialização)
+    python migrations.py kml-ids       # atribui ids estáveis às localizações antigas (também roda na inicialização)
+"""
+import asyncio
+import io
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateMany, UpdateOne
+
+from kml_ingest import geo_point, legacy_location_id
+from photo_store import PhotoStore, InvalidPhotoError, thumbnail_id
+from search_keys import search_terms
+
+
+logger = logging.getLogger(__name__)
+
+# Campo inline legado -> campo de referência no photo store
+INLINE_PHOTO_FIELDS = {
+    "foto_base64": "foto_id",
+    "foto_fechamento_base64": "foto_fechamento_id",
+}
+
+
+async def migrate_inline_photos(db, photo_store: PhotoStore) -> dict:
+    query = {"$or": [
+        {field: {"$type": "string", "$ne": ""}} for field in INLINE_PHOTO_FIELDS
+    ]}
+    projection = {"_id": 0, "id": 1, **{field: 1 for field in INLINE_PHOTO_FIELDS}}
+
+    migrated = 0
+    failed = 0
+    async for pendencia in db.pendencias.find(query, projection):
+        update_set = {}
+        update_unset = {}
+        for inline_field, ref_field in INLINE_PHOTO_FIELDS.items():
+            value = pendencia.get(inline_field)
+            if not value:
+                continue
+            try:
+                update_set[ref_field] = await photo_store.put_base64(value)
+                update_unset[inline_field] = ""
+            except InvalidPhotoError:
+                failed += 1
+                logger.warning("Foto inválida em %s.%s, mantida inline", pendencia["id"], inline_field)
+
+        if update_set:
+            await db.pendencias.update_one(
+                {"id": pendencia["id"]},
+                {"$set": update_set, "$unset": update_unset}
+            )
+            migrated += 1
+
+    return {"migrated": migrated, "failed": failed}
+
+
+async def migrate_missing_thumbnails(db, photo_store: PhotoStore) -> dict:
+    generated = 0
+    originals = photo_store.files.find({"metadata.thumbnail_of": {"$exists": False}}, {"_id": 1})
+    async for photo in originals:
+        photo_id = photo["_id"]
+        if await photo_store.exists(thumbnail_id(photo_id, photo_store.sizes[0])):
+            continue
+        grid_out = await photo_store.open(photo_id)
+        await photo_store.ingest(photo_id, io.BytesIO(await grid_out.read()))
+        generated += 1
+    return {"generated": generated}
+
+
+# Versão do schema de users gravada em db.schema_versions após a migração
+USERS_SCHEMA_VERSION = 1
+
+
+async def migrate_legacy_users(db) -> dict:
+    """Completa status/role/token_version de usuários antigos em uma única escrita em lote."""
+    current = await db.schema_versions.find_one({"_id": "users"})
+    if current and current.get("version", 0) >= USERS_SCHEMA_VERSION:
+        return {"modified": 0, "version": current["version"]}
+
+    result = await db.users.bulk_write([
+        UpdateMany({"status": {"$exists": False}}, {"$set": {"status": "APPROVED"}}),
+        UpdateMany({"role": {"$exists": False}, "username": "admin"}, {"$set": {"role": "ADMIN"}}),
+        UpdateMany({"role": {"$exists": False}}, {"$set": {"role": "USER"}}),
+        UpdateMany({"token_version": {"$exists": False}}, {"$set": {"token_version": 0}}),
+    ], ordered=True)
+
+    await db.schema_versions.update_one(
+        {"_id": "users"},
+        {"$set": {"version": USERS_SCHEMA_VERSION, "migrated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return {"modified": result.modified_count, "version": USERS_SCHEMA_VERSION}
+
+
+KML_LOCATIONS_BATCH_SIZE = 1000
+
+
+async def migrate_embedded_kml_locations(db) -> dict:
+    """Move o array ``locations`` de cada kml_data para documentos em kml_locations."""
+    files = 0
+    locations = 0
+    async for kml_file in db.kml_data.find({"locations": {"$exists": True}}, {"_id": 0, "id": 1}):
+        kml_id = kml_file["id"]
+        # Recomeça do zero caso uma execução anterior tenha parado no meio
+        await db.kml_locations.delete_many({"kml_id": kml_id})
+        document = await db.kml_data.find_one({"id": kml_id}, {"_id": 0, "locations": 1})
+        embedded = document.get("locations") or []
+        seen = {}
+        for start in range(0, len(embedded), KML_LOCATIONS_BATCH_SIZE):
+            batch = embedded[start:start + KML_LOCATIONS_BATCH_SIZE]
+            await db.kml_locations.insert_many([
+                {
+                    **location,
+                    "id": legacy_location_id(kml_id, location, seen),
+                    "kml_id": kml_id,
+                    "point": geo_point(location["longitude"], location["latitude"]),
+                    "search_terms": search_terms(location.get("name"), location.get("description")),
+                }
+                for location in batch
+            ])
+        await db.kml_data.update_one(
+            {"id": kml_id},
+            {"$unset": {"locations": ""}, "$set": {"total_locations": len(embedded)}}
+        )
+        files += 1
+        locations += len(embedded)
+    return {"files": files, "locations": locations}
+
+
+KML_POINTS_SCHEMA_VERSION = 1
+
+
+async def migrate_kml_points(db) -> dict:
+    """Preenche o ponto GeoJSON das localizações gravadas só com latitude/longitude."""
+    current = await db.schema_versions.find_one({"_id": "kml_points"})
+    if current and current.get("version", 0) >= KML_POINTS_SCHEMA_VERSION:
+        return {"modified": 0, "version": current["version"]}
+
+    result = await db.kml_locations.update_many(
+        {"point": {"$exists": False}},
+        [{"$set": {"point": {"type": "Point", "coordinates": ["$longitude", "$latitude"]}}}]
+    )
+
+    await db.schema_versions.update_one(
+        {"_id": "kml_points"},
+        {"$set": {"version": KML_POINTS_SCHEMA_VERSION, "migrated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return {"modified": result.modified_count, "version": KML_POINTS_SCHEMA_VERSION}
+
+
+SEARCH_TERMS_SCHEMA_VERSION = 1
+SEARCH_TERMS_BATCH_SIZE = 1000
+
+# Campos de texto de cada coleção que compõem search_terms (os mesmos usados na escrita)
+SEARCH_TERMS_FIELDS = {
+    "pendencias": ("site", "observacoes", "usuario_criacao"),
+    "kml_locations": ("name", "description"),
+}
+
+
+async def migrate_search_terms(db) -> dict:
+    """Calcula search_terms dos documentos gravados antes das chaves de busca existirem."""
+    current = await db.schema_versions.find_one({"_id": "search_terms"})
+    if current and current.get("version", 0) >= SEARCH_TERMS_SCHEMA_VERSION:
+        return {"modified": 0, "version": current["version"]}
+
+    modified = 0
+    for collection, fields in SEARCH_TERMS_FIELDS.items():
+        projection = {field: 1 for field in fields}
+        batch = []
+        async for document in db[collection].find({"search_terms": {"$exists": False}}, projection):
+            terms = search_terms(*(document.get(field) for field in fields))
+            batch.append(UpdateOne({"_id": document["_id"]}, {"$set": {"search_terms": terms}}))
+            if len(batch) >= SEARCH_TERMS_BATCH_SIZE:
+                modified += (await db[collection].bulk_write(batch, ordered=False)).modified_count
+                batch = []
+        if batch:
+            modified += (await db[collection].bulk_write(batch, ordered=False)).modified_count
+
+    await db.schema_versions.update_one(
+        {"_id": "search_terms"},
+        {"$set": {"version": SEARCH_TERMS_SCHEMA_VERSION, "migrated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return {"modified": modified, "version": SEARCH_TERMS_SCHEMA_VERSION}
+
+
+KML_LOCATION_IDS_SCHEMA_VERSION = 1
+
+
+async def migrate_kml_location_ids(db) -> dict:
+    """Atribui o id estável às localizações gravadas antes dele existir."""
+    current = await db.schema_versions.find_one({"_id": "kml_location_ids"})
+    if current and current.get("version", 0) >= KML_LOCATION_IDS_SCHEMA_VERSION:
+        return {"modified": 0, "version": current["version"]}
+
+    modified = 0
+    current_kml_id = None
+    seen = {}
+    batch = []
+    # Ordenado por arquivo: só as chaves do arquivo atual ficam em memória
+    cursor = db.kml_locations.find(
+        {"id": {"$exists": False}}, {"_id": 1, "kml_id": 1, "name": 1, "latitude": 1, "longitude": 1}
+    ).sort("kml_id", 1)
+    async for location in cursor:
+        kml_id = location["kml_id"]
+        if kml_id != current_kml_id:
+            current_kml_id = kml_id
+            seen = {}
+        stable_id = legacy_location_id(kml_id, location, seen)
+        batch.append(UpdateOne({"_id": location["_id"]}, {"$set": {"id": stable_id}}))
+        if len(batch) >= KML_LOCATIONS_BATCH_SIZE:
+            modified += (await db.kml_locations.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        modified += (await db.kml_locations.bulk_write(batch, ordered=False)).modified_count
+
+    await db.schema_versions.update_one(
+        {"_id": "kml_location_ids"},
+        {"$set": {"version": KML_LOCATION_IDS_SCHEMA_VERSION, "migrated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return {"modified": modified, "version": KML_LOCATION_IDS_SCHEMA_VERSION}
+
+
+MIGRATIONS = {
+    "photos": lambda db: migrate_inline_photos(db, PhotoStore(db)),
+    "thumbnails": lambda db: migrate_missing_thumbnails(db, PhotoStore(db)),
+    "users": migrate_legacy_users,
+    "kml": migrate_embedded_kml_locations,
+    "kml-points": migrate_kml_points,
+    "search-terms": migrate_search_terms,
+    "kml-ids": migrate_kml_location_ids,
+}
+
+
+async def main(names):
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        for name in names:
+            result = await MIGRATIONS[name](db)
+            logger.info("Migração %s concluída: %s", name, result)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    names = sys.argv[1:]
+    unknown = [name for name in names if name not in MIGRATIONS]
+    if not names or unknown:
+        print(f"Uso: python migrations.py {{{'|'.join(MIGRATIONS)}}} [...]")
+        sys.exit(1)
+    asyncio.run(main(names))
@@ -0,0 +1,107 @@
+"""Hash de senhas com bcrypt, executado fora do event loop.
+
+Cada hash bcrypt custa centenas de milissegundos de CPU; rodar isso direto na
+coroutine travaria todas as outras requisições. O PasswordHasher executa o
+bcrypt em um pool de threads limitado, mantém uma fila com tamanho máximo e
+converte os hashes SHA-256 antigos na primeira validação bem-sucedida.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import bcrypt
+
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', 100))
+
+
+class PasswordHashQueueFull(Exception):
+    """Fila de hash cheia; a requisição deve ser recusada em vez de esperar."""
+
+
+def _prehash(password: str) -> bytes:
+    # bcrypt só usa os primeiros 72 bytes (e o bcrypt 5 recusa senhas maiores)
+    return base64.b64encode(hashlib.sha256(password.encode()).digest())
+
+
+def _bcrypt_hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(_prehash(password), bcrypt.gensalt(rounds)).decode()
+
+
+def _bcrypt_verify(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(_prehash(password), hashed.encode())
+
+
+def is_bcrypt_hash(hashed: str) -> bool:
+    return hashed.startswith("$2")
+
+
+def bcrypt_rounds(hashed: str) -> int:
+    # Formato: $2b$<custo>$<salt+hash>
+    return int(hashed.split("$")[2])
+
+
+class PasswordHasher:
+    def __init__(
+        self,
+        legacy_secret: str,
+        rounds: int = BCRYPT_ROUNDS,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+    ):
+        self.legacy_secret = legacy_secret
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.semaphore = asyncio.Semaphore(workers)
+        self.queued = 0
+        self.in_flight = 0
+
+    async def _run(self, func, *args):
+        if self.queued >= self.max_queue:
+            raise PasswordHashQueueFull()
+
+        self.queued += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    def _legacy_hash(self, password: str) -> str:
+        return hashlib.sha256((password + self.legacy_secret).encode()).hexdigest()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_bcrypt_hash, password, self.rounds)
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, bool]:
+        """Retorna (senha correta, hash precisa ser refeito)."""
+        if not is_bcrypt_hash(hashed):
+            # Hash SHA-256 legado: barato de conferir, mas deve virar bcrypt
+            return hmac.compare_digest(self._legacy_hash(password), hashed), True
+
+        valid = await self._run(_bcrypt_verify, password, hashed)
+        needs_rehash = valid and bcrypt_rounds(hashed) != self.rounds
+        return valid, needs_rehash
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queued,
+            "in_flight": self.in_flight,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+        }
@@ -0,0 +1,243 @@
+"""Armazenamento das fotos das pendências fora dos documentos (GridFS).
+
+Cada foto é gravada uma única vez no bucket ``photos`` e identificada pelo
+SHA-256 do seu conteúdo; as pendências guardam apenas esse id. Ao gravar uma
+foto nova são geradas miniaturas JPEG (``{id}_{tamanho}``) em um pool de
+threads, para que as listagens não precisem da imagem original.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from gridfs.errors import FileExists, NoFile
+from pymongo.errors import DuplicateKeyError
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+logger = logging.getLogger(__name__)
+
+PHOTO_BUCKET = "photos"
+PHOTO_CHUNK_SIZE = 255 * 1024
+
+# Lado maior (px) de cada miniatura gerada
+THUMBNAIL_SIZES = (160, 480)
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+# Resolução máxima aceita: acima disso decodificar a foto para as miniaturas
+# estouraria a memória (bomba de descompressão)
+MAX_PHOTO_PIXELS = int(os.environ.get('MAX_PHOTO_PIXELS', 50_000_000))
+
+
+class InvalidPhotoError(ValueError):
+    """Conteúdo recebido não é uma foto válida."""
+
+
+class PhotoTooLargeError(InvalidPhotoError):
+    """Foto maior que o limite configurado."""
+
+
+def guess_content_type(head: bytes) -> str:
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def decode_base64_photo(value: str) -> bytes:
+    # Aceita tanto o base64 puro quanto uma data URL (data:image/...;base64,)
+    value = value.strip()
+    if value.startswith("data:") and "," in value:
+        value = value.split(",", 1)[1]
+    try:
+        data = base64.b64decode(value, validate=False)
+    except (binascii.Error, ValueError):
+        raise InvalidPhotoError("Foto em base64 inválida")
+    if not data:
+        raise InvalidPhotoError("Foto vazia")
+    return data
+
+
+def thumbnail_id(photo_id: str, size: int) -> str:
+    return f"{photo_id}_{size}"
+
+
+def check_resolution(source, max_pixels: int = MAX_PHOTO_PIXELS) -> None:
+    """Recusa fotos acima de ``max_pixels`` lendo só o cabeçalho da imagem.
+
+    Roda antes de gravar a original, para que uma foto recusada não fique
+    órfã no GridFS. Conteúdo que o Pillow não reconhece passa (fica sem miniatura).
+    """
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise InvalidPhotoError("Resolução da foto acima do limite")
+    except (UnidentifiedImageError, OSError):
+        return
+    finally:
+        source.seek(0)
+    if width * height > max_pixels:
+        raise InvalidPhotoError("Resolução da foto acima do limite")
+
+
+def render_thumbnails(source, sizes: Iterable[int]) -> Dict[int, bytes]:
+    """Reduz a foto para cada tamanho e re-codifica em JPEG (roda fora do event loop)."""
+    sizes = sorted(sizes, reverse=True)
+    thumbnails = {}
+    with Image.open(source) as image:
+        # Para JPEG, decodifica já em escala reduzida
+        image.draft("RGB", (sizes[0] * 2, sizes[0] * 2))
+        current = ImageOps.exif_transpose(image).convert("RGB")
+        # Do maior para o menor, cada miniatura parte da anterior
+        for size in sizes:
+            current.thumbnail((size, size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            current.save(buffer, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            thumbnails[size] = buffer.getvalue()
+    return thumbnails
+
+
+class PhotoStore:
+    def __init__(self, db, bucket_name: str = PHOTO_BUCKET, sizes: Iterable[int] = THUMBNAIL_SIZES):
+        self.bucket = AsyncIOMotorGridFSBucket(
+            db, bucket_name=bucket_name, chunk_size_bytes=PHOTO_CHUNK_SIZE
+        )
+        self.files = db[f"{bucket_name}.files"]
+        self.sizes = tuple(sorted(sizes))
+        self.executor = ThreadPoolExecutor(
+            max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails"
+        )
+
+    async def exists(self, photo_id: str) -> bool:
+        return await self.files.count_documents({"_id": photo_id}, limit=1) > 0
+
+    async def put_bytes(self, data: bytes) -> str:
+        photo_id = hashlib.sha256(data).hexdigest()
+        if await self.exists(photo_id):
+            return photo_id
+        check_resolution(io.BytesIO(data))
+
+        try:
+            await self.bucket.upload_from_stream_with_id(
+                photo_id,
+                photo_id,
+                data,
+                metadata={"content_type": guess_content_type(data[:16])},
+            )
+        except (FileExists, DuplicateKeyError):
+            # Mesma foto enviada em paralelo: o outro upload já a gravou
+            return photo_id
+
+        await self.ingest(photo_id, io.BytesIO(data))
+        return photo_id
+
+    async def put_base64(self, value: str) -> str:
+        return await self.put_bytes(decode_base64_photo(value))
+
+    async def put_upload(self, upload, max_bytes: int) -> str:
+        """Grava um UploadFile em chunks, sem carregar a foto inteira na memória.
+
+        A primeira passada calcula o hash e interrompe assim que o limite é
+        ultrapassado; a segunda copia o arquivo (já em spool) para o GridFS.
+        """
+        digest = hashlib.sha256()
+        head = b""
+        size = 0
+        while True:
+            chunk = await upload.read(PHOTO_CHUNK_SIZE)
+            if not chunk:
+                break
+            if not head:
+                head = chunk[:16]
+            size += len(chunk)
+            if size > max_bytes:
+                raise PhotoTooLargeError(
+                    f"A foto deve ter no máximo {max_bytes // (1024 * 1024)}MB"
+                )
+            digest.update(chunk)
+        if size == 0:
+            raise InvalidPhotoError("Foto vazia")
+
+        photo_id = digest.hexdigest()
+        if await self.exists(photo_id):
+            return photo_id
+
+        await upload.seek(0)
+        check_resolution(upload.file)
+        grid_in = self.bucket.open_upload_stream_with_id(
+            photo_id, photo_id, metadata={"content_type": guess_content_type(head)}
+        )
+        try:
+            while True:
+                chunk = await upload.read(PHOTO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except (FileExists, DuplicateKeyError):
+            # Mesma foto enviada em paralelo: o outro upload já a gravou. O id é o
+            # hash do conteúdo, então nunca abort(): apagaria os chunks do outro
+            return photo_id
+
+        await upload.seek(0)
+        await self.ingest(photo_id, upload.file)
+        return photo_id
+
+    async def ingest(self, photo_id: str, source) -> None:
+        """Gera e grava as miniaturas de uma foto recém-armazenada."""
+        loop = asyncio.get_running_loop()
+        try:
+            thumbnails = await loop.run_in_executor(
+                self.executor, render_thumbnails, source, self.sizes
+            )
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+            # Sem miniatura a foto original continua sendo servida
+            logger.warning("Não foi possível gerar miniaturas de %s: %s", photo_id, e)
+            return
+
+        for size, data in thumbnails.items():
+            try:
+                await self.bucket.upload_from_stream_with_id(
+                    thumbnail_id(photo_id, size),
+                    thumbnail_id(photo_id, size),
+                    data,
+                    metadata={"content_type": "image/jpeg", "thumbnail_of": photo_id, "size": size},
+                )
+            except (FileExists, DuplicateKeyError):
+                pass
+
+    def thumbnail_size_for(self, size: int) -> int:
+        """Menor miniatura que atende ao tamanho pedido (ou a maior disponível)."""
+        for available in self.sizes:
+            if available >= size:
+                return available
+        return self.sizes[-1]
+
+    async def open(self, photo_id: str, size: Optional[int] = None):
+        """Abre a foto (ou a miniatura mais próxima de ``size``) para leitura em chunks.
+
+        Retorna (id do arquivo aberto, stream), ou None se a foto não existir;
+        sem miniatura, devolve a original.
+        """
+        file_ids = [thumbnail_id(photo_id, self.thumbnail_size_for(size))] if size else []
+        for file_id in file_ids + [photo_id]:
+            try:
+                return file_id, await self.bucket.open_download_stream(file_id)
+            except NoFile:
+                pass
+        return None
+
+    @staticmethod
+    def content_type(grid_out) -> str:
+        metadata: Optional[dict] = grid_out.metadata
+        return (metadata or {}).get("content_type", "image/jpeg")
@@ -0,0 +1,49 @@
+"""Chaves de busca normalizadas, calculadas na escrita.
+
+Nomes de sites e descrições vêm em português ("Iluminação", "Localizações
+CN19"); quem busca costuma digitar sem acento. Os textos são gravados também
+como ``search_terms``: as palavras sem acento e em minúsculas, em um array
+indexado (multikey).
+
+Regra de correspondência (a mesma no Mongo e no índice em memória de
+location_search): cada palavra da consulta, normalizada, é substring do texto
+normalizado. Como as palavras só têm caracteres \w, isso equivale a ser
+substring de algum termo de ``search_terms``, e o MongoDB confere o regex
+percorrendo as chaves do índice em vez dos documentos.
+"""
+import re
+import unicodedata
+from typing import List, Optional
+
+
+_WORD = re.compile(r"\w+")
+
+
+def fold(text: Optional[str]) -> str:
+    """Remove acentos e passa para minúsculas ('Iluminação' -> 'iluminacao')."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+def search_terms(*texts: Optional[str]) -> List[str]:
+    """Palavras distintas e normalizadas dos textos, para o campo ``search_terms``."""
+    terms = set()
+    for text in texts:
+        terms.update(_WORD.findall(fold(text)))
+    return sorted(terms)
+
+
+def query_words(query: Optional[str]) -> List[str]:
+    """Palavras normalizadas da consulta, na ordem em que foram digitadas."""
+    return _WORD.findall(fold(query))
+
+
+def terms_query(query: str, field: str = "search_terms") -> Optional[dict]:
+    """Filtro em que cada palavra da consulta é substring de algum termo do documento.
+
+    None se a consulta não tiver nenhuma palavra.
+    """
+    words = query_words(query)
+    if not words:
+        return None
+    return {"$and": [{field: {"$regex": re.escape(word)}} for word in words]}
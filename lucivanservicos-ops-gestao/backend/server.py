@@ -1,22 +1,42 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel, ReturnDocument
+from pymongo.errors import OperationFailure
 import os
+import re
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, computed_field
+from typing import List, Literal, Optional, Union
 import uuid
 from datetime import datetime, timezone, timedelta
-import hashlib
+import time
+from collections import OrderedDict
 from jose import JWTError, jwt
 import base64
+import json
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 from tempfile import NamedTemporaryFile
+from photo_store import PhotoStore, InvalidPhotoError, PhotoTooLargeError
+from migrations import (
+    migrate_legacy_users,
+    migrate_embedded_kml_locations,
+    migrate_kml_points,
+    migrate_search_terms,
+    migrate_kml_location_ids,
+)
+from password_hasher import PasswordHasher, PasswordHashQueueFull
+from kml_ingest import geo_point
+from geometry import GEOMETRY_LEVEL_ZOOMS, level_for_zoom, pick_level
+from kml_jobs import KmlJobs, KML_JOB_PROJECTION, DuplicateKMLError
+from location_search import LocationSearch
+from search_keys import search_terms, terms_query
+from geojson_export import GEOJSON_MEDIA_TYPE, feature, feature_collection
 
 
 ROOT_DIR = Path(__file__).parent
@@ -26,6 +46,72 @@ load_dotenv(ROOT_DIR / '.env')
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
+photo_store = PhotoStore(db)
+location_search = LocationSearch(db)
+kml_jobs = KmlJobs(db, mongo_url, os.environ['DB_NAME'], on_done=location_search.schedule_rebuild)
+
+# Índices garantidos na inicialização (create_indexes é idempotente)
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True, name="username_unique"),
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("status", ASCENDING)], name="status"),
+    ],
+    "pendencias": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("status", ASCENDING), ("site", ASCENDING), ("tipo", ASCENDING), ("created_at", DESCENDING)], name="filters_created_at"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("usuario_criacao", ASCENDING), ("created_at", DESCENDING)], name="usuario_criacao_created_at"),
+        IndexModel([("usuario_finalizacao", ASCENDING), ("data_finalizacao", DESCENDING)], name="usuario_finalizacao_data_finalizacao"),
+        IndexModel([("search_terms", ASCENDING), ("created_at", DESCENDING)], name="search_terms_created_at"),
+    ],
+    "location_observations": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("location_id", ASCENDING), ("created_at", DESCENDING)], name="location_id_created_at"),
+    ],
+    "kml_data": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("status", ASCENDING)], name="status"),
+        # Único: dois uploads simultâneos do mesmo arquivo não passam os dois
+        IndexModel(
+            [("content_hash", ASCENDING)], unique=True, name="content_hash_unique",
+            partialFilterExpression={"content_hash": {"$exists": True}},
+        ),
+    ],
+    "kml_locations": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("kml_id", ASCENDING)], name="kml_id"),
+        IndexModel([("point", GEOSPHERE), ("kml_id", ASCENDING)], name="point_2dsphere_kml_id"),
+        IndexModel([("longitude", ASCENDING), ("latitude", ASCENDING)], name="longitude_latitude"),
+        IndexModel([("search_terms", ASCENDING)], name="search_terms"),
+        # Localização do site de uma pendência (exportação GeoJSON)
+        IndexModel([("name", ASCENDING), ("kml_id", ASCENDING)], name="name_kml_id"),
+    ],
+    "kml_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("status", ASCENDING)], name="status"),
+        # Histórico de importações expira depois de 30 dias
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=30 * 24 * 3600, name="created_at_ttl"),
+    ],
+}
+
+# Índices substituídos por outros com a mesma chave (ex.: passaram a ser únicos)
+OBSOLETE_INDEXES = {
+    "kml_data": ["content_hash"],
+}
+
+async def ensure_indexes():
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = await db[collection].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection].drop_index(name)
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # Ex.: dados duplicados impedem um índice único; o servidor sobe mesmo assim
+            logger.error("Falha ao criar índices de %s: %s", collection, e)
 
 # Security setup
 security = HTTPBearer()
@@ -33,6 +119,56 @@ SECRET_KEY = "your-secret-key-here-change-in-production-very-long-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Limite das fotos enviadas em multipart
+MAX_PHOTO_BYTES = int(os.environ.get('MAX_PHOTO_BYTES', 10 * 1024 * 1024))
+# Rotas multipart com foto e a folga para os campos de texto do formulário
+PHOTO_UPLOAD_PATHS = re.compile(r"^/api/pendencias/(upload|[^/]+/finalize)$")
+MULTIPART_FORM_OVERHEAD = 1024 * 1024
+
+
+class UploadSizeLimitMiddleware:
+    """Recusa com 413 o corpo das rotas de foto que passa do limite.
+
+    O Starlette grava o multipart inteiro em spool antes do handler rodar; aqui
+    os bytes são contados à medida que chegam (e o Content-Length, quando
+    informado, é checado antes de ler qualquer coisa).
+    """
+
+    def __init__(self, app, max_bytes: int, paths):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+
+    def _too_large(self) -> HTTPException:
+        return HTTPException(
+            status_code=413, detail=f"A foto deve ter no máximo {MAX_PHOTO_BYTES // (1024 * 1024)}MB"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.paths.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            error = self._too_large()
+            await JSONResponse({"detail": error.detail}, status_code=error.status_code)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # O FastAPI repassa HTTPException levantada durante a leitura do corpo
+                    raise self._too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -40,15 +176,26 @@ app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 
+# Tamanho da miniatura usada nas listagens
+THUMBNAIL_LIST_SIZE = 160
+
+def photo_url(photo_id: Optional[str], size: Optional[int] = None) -> Optional[str]:
+    if not photo_id:
+        return None
+    url = f"/api/photos/{photo_id}"
+    return f"{url}?size={size}" if size else url
+
+
 # Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     username: str
-    hashed_password: str
+    hashed_password: Optional[str] = None  # Ausente quando o usuário vem das claims do token
     role: str = "USER"  # "USER" or "ADMIN"
     status: str = "PENDING"  # "PENDING", "APPROVED", "REJECTED"
     approved_by: Optional[str] = None
     approved_at: Optional[datetime] = None
+    token_version: int = 0  # Incrementado para revogar os tokens já emitidos
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class UserCreate(BaseModel):
@@ -75,18 +222,100 @@ class Pendencia(BaseModel):
     tipo: str  # "Energia" or "Arcon"
     subtipo: str  # Específico baseado no tipo
     observacoes: str
-    foto_base64: Optional[str] = None  # Opcional para compatibilidade com pendências legadas
+    foto_base64: Optional[str] = None  # Legado: fotos inline antes do photo store
+    foto_id: Optional[str] = None  # Referência para a foto em /api/photos/{id}
     status: str = "Pendente"  # "Pendente", "Finalizado", "Validado", "Rejeitado"
     usuario_criacao: str
     usuario_finalizacao: Optional[str] = None
     data_finalizacao: Optional[datetime] = None
     informacoes_fechamento: Optional[str] = None
-    foto_fechamento_base64: Optional[str] = None
+    foto_fechamento_base64: Optional[str] = None  # Legado
+    foto_fechamento_id: Optional[str] = None
     validation_status: Optional[str] = None  # "APPROVED", "REJECTED"
     validated_by: Optional[str] = None
     validated_at: Optional[datetime] = None
     validation_notes: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    
+    # URLs das fotos no photo store; calculadas, não são gravadas no banco
+    @computed_field
+    @property
+    def foto_url(self) -> Optional[str]:
+        return photo_url(self.foto_id)
+    
+    @computed_field
+    @property
+    def foto_thumb_url(self) -> Optional[str]:
+        return photo_url(self.foto_id, THUMBNAIL_LIST_SIZE)
+    
+    @computed_field
+    @property
+    def foto_fechamento_url(self) -> Optional[str]:
+        return photo_url(self.foto_fechamento_id)
+    
+    @computed_field
+    @property
+    def foto_fechamento_thumb_url(self) -> Optional[str]:
+        return photo_url(self.foto_fechamento_id, THUMBNAIL_LIST_SIZE)
+
+PHOTO_URL_FIELDS = {"foto_url", "foto_thumb_url", "foto_fechamento_url", "foto_fechamento_thumb_url"}
+
+def pendencia_search_terms(site: str, observacoes: str, usuario_criacao: str) -> List[str]:
+    # Mesmos campos de SEARCH_TERMS_FIELDS["pendencias"] na migração
+    return search_terms(site, observacoes, usuario_criacao)
+
+def pendencia_document(pendencia: Pendencia) -> dict:
+    """Documento gravado no banco: sem as URLs calculadas, com as chaves de busca"""
+    document = pendencia.dict(exclude=PHOTO_URL_FIELDS)
+    document["search_terms"] = pendencia_search_terms(
+        pendencia.site, pendencia.observacoes, pendencia.usuario_criacao
+    )
+    return document
+
+class PendenciaSummary(BaseModel):
+    """Versão enxuta da pendência para listagens (?view=summary): sem fotos inline (base64)"""
+    id: str
+    site: str
+    ami: Optional[str] = None
+    data_hora: datetime
+    tipo: str
+    subtipo: str
+    observacoes: str = ""
+    status: str
+    usuario_criacao: str
+    usuario_finalizacao: Optional[str] = None
+    data_finalizacao: Optional[datetime] = None
+    informacoes_fechamento: Optional[str] = None
+    validation_status: Optional[str] = None
+    validated_by: Optional[str] = None
+    validated_at: Optional[datetime] = None
+    created_at: datetime
+    foto_id: Optional[str] = None
+    foto_fechamento_id: Optional[str] = None
+    has_photo: bool = False
+    has_photo_fechamento: bool = False
+    
+    @computed_field
+    @property
+    def foto_thumb_url(self) -> Optional[str]:
+        return photo_url(self.foto_id, THUMBNAIL_LIST_SIZE)
+    
+    @computed_field
+    @property
+    def foto_fechamento_thumb_url(self) -> Optional[str]:
+        return photo_url(self.foto_fechamento_id, THUMBNAIL_LIST_SIZE)
+
+def has_field_expr(*fields):
+    # true se algum dos campos existir e não for null, calculado no próprio Mongo
+    return {"$or": [{"$gt": [f"${field}", None]} for field in fields]}
+
+# Projeção do modo summary: o Mongo não envia as fotos inline
+PENDENCIA_SUMMARY_PROJECTION = {
+    "_id": 0,
+    **{field: 1 for field in PendenciaSummary.model_fields if not field.startswith("has_")},
+    "has_photo": has_field_expr("foto_id", "foto_base64"),
+    "has_photo_fechamento": has_field_expr("foto_fechamento_id", "foto_fechamento_base64"),
+}
 
 class PendenciaCreate(BaseModel):
     site: str
@@ -125,7 +354,8 @@ class PendenciaEdit(BaseModel):
     tipo: str
     subtipo: str
     observacoes: str
-    foto_base64: Optional[str] = None
+    foto_base64: Optional[str] = None  # Foto nova; None mantém a atual
+    remove_photo: bool = False  # Tira a foto atual (ignorado se vier foto nova)
 
 class FormConfigUpdate(BaseModel):
     energia_options: List[str]
@@ -133,12 +363,81 @@ class FormConfigUpdate(BaseModel):
     foto_base64: Optional[str] = None
 
 
+class UserCache:
+    """Cache LRU com TTL dos usuários autenticados, indexado por username.
+    
+    Evita uma ida ao Mongo por requisição. Cada entrada guarda a geração dos
+    usuários (db.generations) em que foi lida e só vale enquanto ela for a
+    atual: toda alteração de status, senha ou exclusão chama mark_users_changed(),
+    e a mudança vale na hora em todos os workers, não só neste.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+    
+    def get(self, username: str, generation: int) -> Optional[User]:
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        expires_at, entry_generation, user = entry
+        if expires_at < time.monotonic() or entry_generation != generation:
+            del self._entries[username]
+            return None
+        self._entries.move_to_end(username)
+        return user
+    
+    def set(self, user: User, generation: int):
+        self._entries[user.username] = (time.monotonic() + self.ttl, generation, user)
+        self._entries.move_to_end(user.username)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, username: str):
+        self._entries.pop(username, None)
+
+user_cache = UserCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+)
+
+# Documento de db.generations incrementado a cada alteração de usuário
+USERS_GENERATION = {"_id": "users"}
+
+async def users_generation() -> int:
+    marker = await db.generations.find_one(USERS_GENERATION)
+    return marker["value"] if marker else 0
+
+async def mark_users_changed(username: str):
+    """Descarta o usuário do cache local e avisa os outros workers"""
+    user_cache.invalidate(username)
+    await db.generations.update_one(USERS_GENERATION, {"$inc": {"value": 1}}, upsert=True)
+
+
+# bcrypt em pool de threads; hashes SHA-256 antigos (salgados com a SECRET_KEY)
+# são aceitos e convertidos no próximo login
+password_hasher = PasswordHasher(legacy_secret=SECRET_KEY)
+
+password_busy_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Servidor ocupado, tente novamente em instantes",
+    headers={"Retry-After": "1"},
+)
+
+
 # Auth helpers
-def verify_password(plain_password, hashed_password):
-    return get_password_hash(plain_password) == hashed_password
+async def verify_password(plain_password, hashed_password):
+    """Retorna (senha correta, hash precisa ser refeito)"""
+    try:
+        return await password_hasher.verify(plain_password, hashed_password)
+    except PasswordHashQueueFull:
+        raise password_busy_exception
 
-def get_password_hash(password):
-    return hashlib.sha256((password + SECRET_KEY).encode()).hexdigest()
+async def get_password_hash(password):
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHashQueueFull:
+        raise password_busy_exception
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -150,6 +449,50 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_user_token(user_id: str, username: str, role: str, user_status: str, token_version: int):
+    # Role e status vão no token para autorizar sem consultar o banco
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return create_access_token(
+        data={
+            "sub": username,
+            "uid": user_id,
+            "role": role,
+            "status": user_status,
+            "tv": token_version
+        },
+        expires_delta=access_token_expires
+    )
+
+# Claims que create_user_token grava e get_current_user exige
+TOKEN_CLAIMS = ("sub", "uid", "role", "status", "tv")
+
+async def get_token_version(username: str) -> Optional[int]:
+    """Versão atual dos tokens do usuário (None se ele não existe mais)"""
+    # A geração é lida antes do usuário: uma alteração no meio do caminho
+    # deixa a entrada com a geração antiga, e ela é relida na próxima vez
+    generation = await users_generation()
+    user = user_cache.get(username, generation)
+    if user is None:
+        user_doc = await db.users.find_one({"username": username})
+        if user_doc is None:
+            return None
+        user = User(**user_doc)
+        user_cache.set(user, generation)
+    return user.token_version
+
+async def update_user(user_id: str, update: dict) -> Optional[dict]:
+    """Aplica uma alteração ao usuário e revoga os tokens já emitidos para ele.
+    
+    Role e status vão nas claims e get_current_user não consulta o banco, então
+    toda alteração de usuário passa por aqui: token_version sobe e o cache de
+    todos os workers é descartado. Devolve o usuário atualizado (None se não existe).
+    """
+    update = {**update, "$inc": {**update.get("$inc", {}), "token_version": 1}}
+    user = await db.users.find_one_and_update({"id": user_id}, update, return_document=ReturnDocument.AFTER)
+    if user is not None:
+        await mark_users_changed(user["username"])
+    return user
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -159,38 +502,28 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     try:
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        if username is None or any(claim not in payload for claim in TOKEN_CLAIMS):
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = await db.users.find_one({"username": username})
-    if user is None:
+    # Token revogado (usuário rejeitado, excluído ou com senha redefinida)
+    if await get_token_version(username) != payload["tv"]:
         raise credentials_exception
     
-    # Handle legacy users
-    user_status = user.get("status", "APPROVED")
-    user_role = user.get("role", "ADMIN" if user["username"] == "admin" else "USER")
-    
-    if user_status != "APPROVED":
+    if payload.get("status") != "APPROVED":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User account not approved"
         )
     
-    # Update legacy users
-    if "status" not in user or "role" not in user:
-        await db.users.update_one(
-            {"id": user["id"]},
-            {"$set": {
-                "status": user_status,
-                "role": user_role
-            }}
-        )
-        user["status"] = user_status
-        user["role"] = user_role
-    
-    return User(**user)
+    return User(
+        id=payload["uid"],
+        username=username,
+        role=payload["role"],
+        status=payload["status"],
+        token_version=payload["tv"]
+    )
 
 async def get_admin_user(current_user: User = Depends(get_current_user)):
     if current_user.role != "ADMIN":
@@ -210,6 +543,22 @@ def to_brasilia_time(utc_dt: datetime) -> datetime:
         from datetime import timedelta
         return utc_dt - timedelta(hours=3)  # UTC-3 para horário de Brasília
 
+async def store_base64_photo(foto_base64: str) -> str:
+    try:
+        return await photo_store.put_base64(foto_base64)
+    except InvalidPhotoError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def store_upload_photo(foto: UploadFile) -> str:
+    if foto.content_type and not foto.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Apenas arquivos de imagem são aceitos")
+    try:
+        return await photo_store.put_upload(foto, MAX_PHOTO_BYTES)
+    except PhotoTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidPhotoError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 
 # Routes
 @api_router.post("/register")
@@ -226,7 +575,7 @@ async def register(user_data: UserCreate):
     user_count = await db.users.count_documents({})
     
     # Create new user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash(user_data.password)
     user = User(
         username=user_data.username,
         hashed_password=hashed_password,
@@ -237,10 +586,7 @@ async def register(user_data: UserCreate):
     await db.users.insert_one(user.dict())
     
     # Create access token even for pending users (they need to see pending screen)
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    access_token = create_user_token(user.id, user.username, user.role, user.status, user.token_version)
     
     return Token(
         access_token=access_token,
@@ -254,16 +600,29 @@ async def register(user_data: UserCreate):
 @api_router.post("/login", response_model=Token)
 async def login(user_data: UserLogin):
     user = await db.users.find_one({"username": user_data.username})
-    if not user or not verify_password(user_data.password, user["hashed_password"]):
+    password_ok, needs_rehash = await verify_password(user_data.password, user["hashed_password"]) if user else (False, False)
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Handle legacy users without status field
-    user_status = user.get("status", "APPROVED")  # Default to APPROVED for existing users
-    user_role = user.get("role", "ADMIN" if user["username"] == "admin" else "USER")  # Make admin user admin
+    # Hash legado (SHA-256) ou com custo antigo: regravar com o bcrypt atual
+    # (com a fila cheia o login segue e a conversão fica para a próxima vez).
+    # A senha é a mesma, então não passa por update_user nem revoga tokens
+    if needs_rehash:
+        try:
+            await db.users.update_one(
+                {"id": user["id"]},
+                {"$set": {"hashed_password": await password_hasher.hash(user_data.password)}}
+            )
+        except PasswordHashQueueFull:
+            pass
+    
+    # Usuários legados já foram completados por migrate_legacy_users na inicialização
+    user_status = user["status"]
+    user_role = user["role"]
     
     if user_status == "PENDING":
         raise HTTPException(
@@ -277,19 +636,8 @@ async def login(user_data: UserLogin):
             detail="Account access denied"
         )
     
-    # Update legacy users
-    if "status" not in user or "role" not in user:
-        await db.users.update_one(
-            {"id": user["id"]},
-            {"$set": {
-                "status": user_status,
-                "role": user_role
-            }}
-        )
-    
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user["username"]}, expires_delta=access_token_expires
+    access_token = create_user_token(
+        user["id"], user["username"], user_role, user_status, user["token_version"]
     )
     
     return Token(
@@ -301,9 +649,13 @@ async def login(user_data: UserLogin):
         status=user_status
     )
 
-@api_router.get("/me", response_model=User)
+@api_router.get("/me", response_model=User, response_model_exclude={"hashed_password"})
 async def read_users_me(current_user: User = Depends(get_current_user)):
-    return current_user
+    # Perfil completo vem do banco; o usuário do token só tem as claims
+    user = await db.users.find_one({"id": current_user.id})
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return User(**user)
 
 @api_router.post("/pendencias", response_model=Pendencia)
 async def create_pendencia(pendencia_data: PendenciaCreate, current_user: User = Depends(get_current_user)):
@@ -311,24 +663,98 @@ async def create_pendencia(pendencia_data: PendenciaCreate, current_user: User =
     if not pendencia_data.foto_base64 or not pendencia_data.foto_base64.strip():
         raise HTTPException(status_code=400, detail="Foto é obrigatória para criar uma pendência")
     
+    foto_id = await store_base64_photo(pendencia_data.foto_base64)
+    
     pendencia = Pendencia(
         site=pendencia_data.site,
         tipo=pendencia_data.tipo,
         subtipo=pendencia_data.subtipo,
         observacoes=pendencia_data.observacoes,
-        foto_base64=pendencia_data.foto_base64,
+        foto_id=foto_id,
         usuario_criacao=current_user.username,
         data_hora=datetime.now(timezone.utc)
     )
     
-    await db.pendencias.insert_one(pendencia.dict())
+    await db.pendencias.insert_one(pendencia_document(pendencia))
     return pendencia
 
-@api_router.get("/pendencias", response_model=List[Pendencia])
+@api_router.post("/pendencias/upload", response_model=Pendencia)
+async def create_pendencia_upload(
+    site: str = Form(...),
+    tipo: str = Form(...),
+    subtipo: str = Form(...),
+    observacoes: str = Form(...),
+    ami: Optional[str] = Form(None),
+    foto: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    """Cria a pendência recebendo a foto como arquivo binário (multipart)"""
+    foto_id = await store_upload_photo(foto)
+    
+    pendencia = Pendencia(
+        site=site,
+        ami=ami,
+        tipo=tipo,
+        subtipo=subtipo,
+        observacoes=observacoes,
+        foto_id=foto_id,
+        usuario_criacao=current_user.username,
+        data_hora=datetime.now(timezone.utc)
+    )
+    
+    await db.pendencias.insert_one(pendencia_document(pendencia))
+    return pendencia
+
+# Paginação por keyset em (created_at, id): o cursor é a posição do último item
+# da página, então qualquer página custa o mesmo que a primeira
+PENDENCIA_PAGE_SORT = [("created_at", -1), ("id", -1)]
+MAX_PAGE_SIZE = 1000
+# ?view das listagens: "full" (Pendencia) ou "summary" (PendenciaSummary)
+PendenciaView = Literal["full", "summary"]
+
+def encode_cursor(pendencia: dict) -> str:
+    raw = json.dumps({"c": pendencia["created_at"].isoformat(), "i": pendencia["id"]})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def cursor_query(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        created_at = datetime.fromisoformat(data["c"])
+        last_id = str(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "id": {"$lt": last_id}}
+    ]}
+
+async def list_pendencias(query: dict, view: PendenciaView, limit: int, cursor: Optional[str], response: Response):
+    """Uma página de pendências; o cursor da próxima vai no header X-Next-Cursor"""
+    if cursor:
+        query = {"$and": [query, cursor_query(cursor)]}
+    
+    projection = PENDENCIA_SUMMARY_PROJECTION if view == "summary" else None
+    # Busca um item a mais só para saber se existe próxima página
+    pendencias = await db.pendencias.find(query, projection).sort(PENDENCIA_PAGE_SORT).limit(limit + 1).to_list(limit + 1)
+    if len(pendencias) > limit:
+        pendencias = pendencias[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(pendencias[-1])
+    
+    if view == "summary":
+        return [PendenciaSummary(**pendencia) for pendencia in pendencias]
+    return [Pendencia(**pendencia) for pendencia in pendencias]
+
+@api_router.get("/pendencias", response_model=Union[List[Pendencia], List[PendenciaSummary]])
 async def get_pendencias(
+    response: Response,
     site: Optional[str] = None,
     tipo: Optional[str] = None,
     status: Optional[str] = None,
+    q: Optional[str] = None,
+    view: PendenciaView = "full",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
     query = {}
@@ -338,9 +764,38 @@ async def get_pendencias(
         query["tipo"] = tipo
     if status:
         query["status"] = status
-    
-    pendencias = await db.pendencias.find(query).sort("created_at", -1).to_list(1000)
-    return [Pendencia(**pendencia) for pendencia in pendencias]
+    # Busca por palavras (substring, sem acento) em site, observações e criador
+    search = terms_query(q) if q else None
+    if search:
+        query.update(search)
+    
+    return await list_pendencias(query, view, limit, cursor, response)
+
+@api_router.get("/photos/{photo_id}")
+async def get_photo(photo_id: str, size: Optional[int] = None, current_user: User = Depends(get_current_user)):
+    """Foto original, ou a miniatura mais próxima quando `size` é informado"""
+    opened = await photo_store.open(photo_id, size)
+    if opened is None:
+        raise HTTPException(status_code=404, detail="Foto não encontrada")
+    file_id, grid_out = opened
+    
+    async def iter_chunks():
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            yield chunk
+    
+    # O id é o hash do conteúdo, então a resposta nunca muda
+    return StreamingResponse(
+        iter_chunks(),
+        media_type=PhotoStore.content_type(grid_out),
+        headers={
+            "Content-Length": str(grid_out.length),
+            "Cache-Control": "private, max-age=31536000, immutable",
+            "ETag": f'"{file_id}"'
+        }
+    )
 
 @api_router.get("/sites")
 async def get_sites(current_user: User = Depends(get_current_user)):
@@ -370,9 +825,43 @@ async def update_pendencia(
         if not pendencia_update.foto_fechamento_base64 or not pendencia_update.foto_fechamento_base64.strip():
             raise HTTPException(status_code=400, detail="Foto de fechamento é obrigatória")
     
+    update_ops = {"$set": update_data}
+    foto_fechamento = update_data.pop("foto_fechamento_base64", None)
+    if foto_fechamento:
+        update_data["foto_fechamento_id"] = await store_base64_photo(foto_fechamento)
+        update_ops["$unset"] = {"foto_fechamento_base64": ""}
+    
+    await db.pendencias.update_one({"id": pendencia_id}, update_ops)
+    
+    updated_pendencia = await db.pendencias.find_one({"id": pendencia_id})
+    return Pendencia(**updated_pendencia)
+
+@api_router.put("/pendencias/{pendencia_id}/finalize", response_model=Pendencia)
+async def finalize_pendencia_upload(
+    pendencia_id: str,
+    informacoes_fechamento: str = Form(...),
+    foto_fechamento: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    """Finaliza a pendência recebendo a foto de fechamento como arquivo binário (multipart)"""
+    pendencia = await db.pendencias.find_one({"id": pendencia_id})
+    if not pendencia:
+        raise HTTPException(status_code=404, detail="Pendência not found")
+    
+    if not informacoes_fechamento.strip():
+        raise HTTPException(status_code=400, detail="Informações de fechamento são obrigatórias")
+    
+    update_data = {
+        "status": "Finalizado",
+        "informacoes_fechamento": informacoes_fechamento,
+        "usuario_finalizacao": current_user.username,
+        "data_finalizacao": datetime.now(timezone.utc),
+        "foto_fechamento_id": await store_upload_photo(foto_fechamento)
+    }
+    
     await db.pendencias.update_one(
         {"id": pendencia_id},
-        {"$set": update_data}
+        {"$set": update_data, "$unset": {"foto_fechamento_base64": ""}}
     )
     
     updated_pendencia = await db.pendencias.find_one({"id": pendencia_id})
@@ -399,12 +888,26 @@ async def edit_pendencia(
         pass
     
     update_data = pendencia_edit.dict()
+    update_ops = {"$set": update_data}
     
-    await db.pendencias.update_one(
-        {"id": pendencia_id},
-        {"$set": update_data}
+    update_data["search_terms"] = pendencia_search_terms(
+        update_data["site"], update_data["observacoes"], pendencia["usuario_criacao"]
     )
     
+    # Sem foto nova, a foto atual é mantida, a não ser que remove_photo peça para tirá-la.
+    # O arquivo no photo store fica: as fotos são endereçadas pelo conteúdo e podem
+    # ser compartilhadas com outras pendências
+    foto = update_data.pop("foto_base64", None)
+    remove_photo = update_data.pop("remove_photo")
+    if foto:
+        update_data["foto_id"] = await store_base64_photo(foto)
+        update_ops["$unset"] = {"foto_base64": ""}
+    elif remove_photo:
+        update_data["foto_id"] = None
+        update_ops["$unset"] = {"foto_base64": ""}
+    
+    await db.pendencias.update_one({"id": pendencia_id}, update_ops)
+    
     updated_pendencia = await db.pendencias.find_one({"id": pendencia_id})
     return Pendencia(**updated_pendencia)
 
@@ -465,6 +968,7 @@ async def delete_user(user_id: str, admin_user: User = Depends(get_admin_user)):
     
     # Excluir usuário
     result = await db.users.delete_one({"id": user_id})
+    await mark_users_changed(user["username"])
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
@@ -482,11 +986,8 @@ async def reset_password(user_id: str, password_reset: PasswordReset, admin_user
         raise HTTPException(status_code=400, detail="Password must be at least 4 characters")
     
     # Atualizar senha
-    hashed_password = get_password_hash(password_reset.new_password)
-    await db.users.update_one(
-        {"id": user_id},
-        {"$set": {"hashed_password": hashed_password}}
-    )
+    hashed_password = await get_password_hash(password_reset.new_password)
+    await update_user(user_id, {"$set": {"hashed_password": hashed_password}})
     
     return {"message": "Password reset successfully"}
 
@@ -505,13 +1006,20 @@ async def approve_user(user_id: str, approval: UserApproval, admin_user: User =
         "approved_at": datetime.now(timezone.utc)
     }
     
-    await db.users.update_one({"id": user_id}, {"$set": update_data})
+    await update_user(user_id, {"$set": update_data})
     return {"message": f"User {approval.status.lower()} successfully"}
 
-@api_router.get("/admin/pendencias")
-async def get_all_pendencias_admin(admin_user: User = Depends(get_admin_user)):
-    pendencias = await db.pendencias.find().sort("created_at", -1).to_list(1000)
-    return [Pendencia(**pendencia) for pendencia in pendencias]
+@api_router.get("/admin/pendencias", response_model=Union[List[Pendencia], List[PendenciaSummary]])
+async def get_all_pendencias_admin(
+    response: Response,
+    q: Optional[str] = None,
+    view: PendenciaView = "full",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    admin_user: User = Depends(get_admin_user)
+):
+    search = terms_query(q) if q else None
+    return await list_pendencias(search or {}, view, limit, cursor, response)
 
 @api_router.put("/admin/validate-pendencia/{pendencia_id}")
 async def validate_pendencia(
@@ -551,6 +1059,24 @@ async def delete_pendencia(pendencia_id: str, admin_user: User = Depends(get_adm
     
     return {"message": "Pendência excluída com sucesso"}
 
+@api_router.get("/admin/index-stats")
+async def get_index_stats(admin_user: User = Depends(get_admin_user)):
+    """Uso de cada índice (desde o último restart do Mongo), por coleção"""
+    stats = {}
+    for collection in INDEXES:
+        results = await db[collection].aggregate([{"$indexStats": {}}]).to_list(None)
+        stats[collection] = [{
+            "name": result["name"],
+            "key": result["key"],
+            "ops": result["accesses"]["ops"],
+            "since": result["accesses"]["since"]
+        } for result in results]
+    return stats
+
+@api_router.get("/admin/metrics")
+async def get_metrics(admin_user: User = Depends(get_admin_user)):
+    return {"password_hash": password_hasher.metrics()}
+
 # Endpoints para configuração do formulário
 @api_router.get("/admin/form-config")
 async def get_form_config(admin_user: User = Depends(get_admin_user)):
@@ -598,241 +1124,289 @@ async def update_form_config(config: FormConfigUpdate, admin_user: User = Depend
     return {"message": "Configuração do formulário atualizada com sucesso"}
 
 # Endpoints para análise de arquivos KML
-@api_router.post("/admin/upload-kml")
+@api_router.post("/admin/upload-kml", status_code=status.HTTP_202_ACCEPTED)
 async def upload_kml_file(
+    response: Response,
     file: UploadFile = File(...),
+    replace_kml_id: Optional[str] = Form(None),
     admin_user: User = Depends(get_admin_user)
 ):
-    import xml.etree.ElementTree as ET
-    import re
-    
     # Validate file extension
-    if not file.filename.lower().endswith('.kml'):
-        raise HTTPException(status_code=400, detail="Apenas arquivos KML são aceitos")
+    if not file.filename.lower().endswith(('.kml', '.kmz')):
+        raise HTTPException(status_code=400, detail="Apenas arquivos KML ou KMZ são aceitos")
     
+    if replace_kml_id:
+        # Nova versão de um arquivo já importado: só as diferenças são gravadas
+        if not await db.kml_data.find_one({"id": replace_kml_id, "status": "active"}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Arquivo KML não encontrado")
+        if await kml_jobs.running_for(replace_kml_id):
+            raise HTTPException(status_code=409, detail="Este arquivo KML já está sendo atualizado")
+    
+    # A leitura roda em segundo plano; o andamento fica em /admin/kml-jobs/{job_id}
     try:
-        # Read file content
-        content = await file.read()
-        
-        # Try different encodings
-        try:
-            content_str = content.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                content_str = content.decode('utf-8-sig')  # BOM
-            except UnicodeDecodeError:
-                content_str = content.decode('latin1')
-        
-        # Clean content - remove BOM and extra whitespace
-        content_str = content_str.strip()
-        if content_str.startswith('\ufeff'):
-            content_str = content_str[1:]
-        
-        # Parse KML with multiple namespace handling
-        try:
-            root = ET.fromstring(content_str)
-        except ET.ParseError as e:
-            # Try to fix common XML issues
-            content_str = content_str.replace('&', '&amp;')
-            root = ET.fromstring(content_str)
-        
-        # Get the default namespace from root
-        namespace = ""
-        if root.tag.startswith('{'):
-            namespace = root.tag[1:root.tag.find('}')]
-        
-        # Define possible namespaces
-        namespaces = {
-            '': namespace if namespace else 'http://www.opengis.net/kml/2.2',
-            'kml': 'http://www.opengis.net/kml/2.2'
-        }
-        
-        locations = []
-        
-        # Try multiple ways to find placemarks
-        placemarks = []
-        
-        # Method 1: With namespace
-        for ns_prefix, ns_uri in namespaces.items():
-            if ns_prefix:
-                placemarks.extend(root.findall(f'.//{{{ns_uri}}}Placemark'))
-            else:
-                # No namespace
-                placemarks.extend(root.findall('.//Placemark'))
-        
-        # Method 2: Search without namespace if nothing found
-        if not placemarks:
-            for elem in root.iter():
-                if elem.tag.endswith('Placemark') or elem.tag == 'Placemark':
-                    placemarks.append(elem)
-        
-        for placemark in placemarks:
-            location_data = {}
-            
-            # Extract name - try multiple methods
-            name = None
-            for elem in placemark.iter():
-                if elem.tag.endswith('name') or elem.tag == 'name':
-                    if elem.text and elem.text.strip():
-                        name = elem.text.strip()
-                        break
-            
-            location_data['name'] = name or 'Unnamed Location'
-            
-            # Extract description
-            description = None
-            for elem in placemark.iter():
-                if elem.tag.endswith('description') or elem.tag == 'description':
-                    if elem.text and elem.text.strip():
-                        description = elem.text.strip()
-                        break
-            
-            location_data['description'] = description or ''
-            
-            # Extract extended data
-            extended_data = {}
-            for elem in placemark.iter():
-                if elem.tag.endswith('ExtendedData') or elem.tag == 'ExtendedData':
-                    # Look for SimpleData elements
-                    for data_elem in elem.iter():
-                        if data_elem.tag.endswith('SimpleData') or data_elem.tag == 'SimpleData':
-                            key = data_elem.get('name', 'unknown')
-                            value = data_elem.text or ''
-                            extended_data[key] = value
-                        elif data_elem.tag.endswith('Data') or data_elem.tag == 'Data':
-                            key = data_elem.get('name', 'unknown')
-                            # Look for value element inside Data
-                            for value_elem in data_elem.iter():
-                                if value_elem.tag.endswith('value') or value_elem.tag == 'value':
-                                    extended_data[key] = value_elem.text or ''
-                                    break
-            
-            # Add extended data to description if available
-            if extended_data:
-                extra_info = []
-                for key, value in extended_data.items():
-                    if value:
-                        extra_info.append(f"{key}: {value}")
-                if extra_info:
-                    if location_data['description']:
-                        location_data['description'] += "\n" + "\n".join(extra_info)
-                    else:
-                        location_data['description'] = "\n".join(extra_info)
-            
-            # Extract coordinates - comprehensive search
-            coordinates = None
-            coord_elements = []
-            
-            # Search for all coordinate elements
-            for elem in placemark.iter():
-                if elem.tag.endswith('coordinates') or elem.tag == 'coordinates':
-                    if elem.text and elem.text.strip():
-                        coord_elements.append(elem.text.strip())
-            
-            # Use first valid coordinates found
-            for coord_text in coord_elements:
-                coordinates = coord_text
-                break
-            
-            if coordinates:
-                # Parse coordinates (longitude,latitude,altitude format in KML)
-                coord_pairs = []
-                
-                # Clean coordinate string
-                coordinates = re.sub(r'\s+', ' ', coordinates.strip())
-                
-                # Split by various delimiters
-                coordinate_parts = re.split(r'[\s\n\r\t]+', coordinates)
-                
-                for part in coordinate_parts:
-                    part = part.strip()
-                    if not part:
-                        continue
-                    
-                    # Match coordinate patterns
-                    # Format: longitude,latitude[,altitude]
-                    coord_match = re.match(r'^(-?\d+\.?\d*),(-?\d+\.?\d*)(?:,(-?\d+\.?\d*))?$', part)
-                    if coord_match:
-                        try:
-                            lng = float(coord_match.group(1))
-                            lat = float(coord_match.group(2))
-                            
-                            # Validate coordinates
-                            if -180 <= lng <= 180 and -90 <= lat <= 90:
-                                coord_pairs.append({'lat': lat, 'lng': lng})
-                        except (ValueError, TypeError):
-                            continue
-                
-                if coord_pairs:
-                    # For multiple coordinates, take the first or center
-                    if len(coord_pairs) == 1:
-                        location_data['latitude'] = coord_pairs[0]['lat']
-                        location_data['longitude'] = coord_pairs[0]['lng']
-                    else:
-                        # Calculate center for multiple points
-                        avg_lat = sum(p['lat'] for p in coord_pairs) / len(coord_pairs)
-                        avg_lng = sum(p['lng'] for p in coord_pairs) / len(coord_pairs)
-                        location_data['latitude'] = avg_lat
-                        location_data['longitude'] = avg_lng
-                        location_data['coordinate_count'] = len(coord_pairs)
-                    
-                    locations.append(location_data)
-        
-        if not locations:
-            # Log the raw content for debugging (first 1000 chars)
-            debug_content = content_str[:1000] if len(content_str) > 1000 else content_str
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Nenhuma localização válida encontrada no arquivo KML. Verifique se o arquivo contém elementos Placemark com coordenadas válidas. Debug: {debug_content}"
-            )
-        
-        # Save to database
-        kml_data = {
-            "id": str(uuid.uuid4()),
-            "filename": file.filename,
-            "uploaded_by": admin_user.username,
-            "uploaded_at": datetime.now(timezone.utc),
-            "locations": locations,
-            "total_locations": len(locations),
-            "status": "active"
-        }
-        
-        await db.kml_data.insert_one(kml_data)
-        
+        job = await kml_jobs.submit(file, admin_user.username, replace=replace_kml_id)
+    except DuplicateKMLError as e:
+        # Mesmo conteúdo já importado: nada é lido nem gravado de novo
+        existing = e.kml_data
+        running = await kml_jobs.running_for(existing["id"]) if existing["status"] == "processing" else None
+        response.status_code = status.HTTP_200_OK
         return {
-            "message": f"Arquivo KML processado com sucesso! {len(locations)} localizações encontradas.",
-            "kml_id": kml_data["id"],
-            "total_locations": len(locations),
-            "locations": locations[:10]  # Return first 10 as preview
+            "message": f"Este arquivo já foi importado como {existing['filename']}.",
+            "duplicate": True,
+            "kml_id": existing["id"],
+            "filename": existing["filename"],
+            "uploaded_by": existing["uploaded_by"],
+            "uploaded_at": existing["uploaded_at"],
+            "status": existing["status"],
+            "job_id": running["id"] if running else None
         }
+    
+    return {
+        "message": "Arquivo recebido! A importação continua em segundo plano.",
+        "job_id": job["id"],
+        "kml_id": job["kml_id"],
+        "mode": job["mode"],
+        "duplicate": False,
+        "status": job["status"]
+    }
+
+@api_router.get("/admin/kml-files")
+async def get_kml_files(admin_user: User = Depends(get_admin_user)):
+    return await db.kml_data.find(
+        {"status": "active"},
+        {"_id": 0, "id": 1, "filename": 1, "uploaded_by": 1, "uploaded_at": 1, "total_locations": 1}
+    ).sort("uploaded_at", DESCENDING).to_list(length=None)
+
+@api_router.get("/admin/kml-jobs/{job_id}")
+async def get_kml_job(job_id: str, admin_user: User = Depends(get_admin_user)):
+    job = await db.kml_jobs.find_one({"id": job_id}, KML_JOB_PROJECTION)
+    if not job:
+        raise HTTPException(status_code=404, detail="Importação não encontrada")
+    return job
+
+async def get_active_kml_files() -> dict:
+    """Metadados dos arquivos KML ativos, por id"""
+    kml_files = await db.kml_data.find(
+        {"status": "active"}, {"_id": 0, "id": 1, "filename": 1, "uploaded_by": 1}
+    ).to_list(length=None)
+    return {kml_file["id"]: kml_file for kml_file in kml_files}
+
+async def delete_kml_file(kml_id: str) -> bool:
+    await db.kml_locations.delete_many({"kml_id": kml_id})
+    result = await db.kml_data.delete_one({"id": kml_id})
+    return result.deleted_count > 0
+
+# Campos internos (geo e busca) e as geometrias não vão nas respostas
+KML_LOCATION_PROJECTION = {"_id": 0, "point": 0, "search_terms": 0, "geometry_levels": 0}
+
+# Raio máximo da busca por proximidade
+MAX_NEARBY_RADIUS_M = 50_000
+
+# Viewport do mapa: abaixo deste zoom os pontos são agrupados em células de grade
+KML_CLUSTER_MAX_ZOOM = 13
+# Células por tile de 256px no zoom atual (células de ~64px na tela)
+KML_CLUSTER_CELLS_PER_TILE = 4
+# Máximo de células por eixo do bbox: um bbox grande (ex.: o mundo) aumenta a célula
+KML_CLUSTER_MAX_CELLS_PER_AXIS = 40
+# Máximo de pontos soltos (ou de clusters + pontos) devolvidos para um viewport
+MAX_VIEWPORT_LOCATIONS = 2000
+
+def attach_kml_source(location: dict, kml_files: dict) -> dict:
+    kml_file = kml_files[location["kml_id"]]
+    location["source_file"] = kml_file["filename"]
+    location["uploaded_by"] = kml_file["uploaded_by"]
+    return location
+
+def parse_bbox(bbox: str):
+    """'minLng,minLat,maxLng,maxLat' -> tupla de floats"""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox inválido: use minLng,minLat,maxLng,maxLat")
+    if not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise HTTPException(status_code=400, detail="bbox fora dos limites de latitude/longitude")
+    return min_lng, min_lat, max_lng, max_lat
+
+def bbox_query(min_lng: float, min_lat: float, max_lng: float, max_lat: float) -> dict:
+    query = {"latitude": {"$gte": min_lat, "$lte": max_lat}}
+    if min_lng <= max_lng:
+        query["longitude"] = {"$gte": min_lng, "$lte": max_lng}
+    else:
+        # Viewport cruzando o antimeridiano
+        query["$or"] = [{"longitude": {"$gte": min_lng}}, {"longitude": {"$lte": max_lng}}]
+    return query
+
+def viewport_location(location: dict, kml_files: dict, levels: Optional[list]) -> dict:
+    # Linhas e polígonos levam a geometria no nível de detalhe do zoom
+    geometry = pick_level(levels)
+    if geometry:
+        location["geometry"] = geometry
+    return attach_kml_source(location, kml_files)
+
+def bbox_span(min_lng: float, min_lat: float, max_lng: float, max_lat: float) -> float:
+    """Maior lado do bbox em graus (longitude considerando o antimeridiano)"""
+    lng_span = max_lng - min_lng if min_lng <= max_lng else max_lng - min_lng + 360
+    return max(lng_span, max_lat - min_lat)
+
+def viewport_projection(level: int) -> dict:
+    # Só os níveis a partir do pedido: o primeiro preenchido é o que vai na resposta
+    return {
+        **KML_LOCATION_PROJECTION,
+        "geometry_levels": {"$slice": [level, len(GEOMETRY_LEVEL_ZOOMS) + 1 - level]},
+    }
+
+async def get_viewport_locations(kml_files: dict, bbox: str, zoom: Optional[int]) -> dict:
+    bounds = parse_bbox(bbox)
+    query = {"kml_id": {"$in": list(kml_files)}, **bbox_query(*bounds)}
+    level = level_for_zoom(zoom)
+    
+    if zoom is not None and zoom < KML_CLUSTER_MAX_ZOOM:
+        # Agrupa no banco por célula de grade; células com um ponto só voltam como localização.
+        # A célula cresce com o bbox para limitar o número de grupos
+        cell = max(
+            360 / (2 ** zoom * KML_CLUSTER_CELLS_PER_TILE),
+            bbox_span(*bounds) / KML_CLUSTER_MAX_CELLS_PER_AXIS,
+        )
+        pipeline = [
+            {"$match": query},
+            # Só o necessário entra no $group (sem geometrias, descrição ou termos de busca)
+            {"$project": {"_id": 0, "id": 1, "latitude": 1, "longitude": 1}},
+            {"$group": {
+                "_id": {
+                    "x": {"$floor": {"$divide": ["$longitude", cell]}},
+                    "y": {"$floor": {"$divide": ["$latitude", cell]}},
+                },
+                "count": {"$sum": 1},
+                "latitude": {"$avg": "$latitude"},
+                "longitude": {"$avg": "$longitude"},
+                "id": {"$first": "$id"},
+            }},
+            # Se passar do limite, ficam os maiores clusters
+            {"$sort": {"count": -1, "_id.x": 1, "_id.y": 1}},
+            {"$limit": MAX_VIEWPORT_LOCATIONS + 1},
+        ]
+        groups = await db.kml_locations.aggregate(pipeline).to_list(length=None)
+        truncated = len(groups) > MAX_VIEWPORT_LOCATIONS
+        groups = groups[:MAX_VIEWPORT_LOCATIONS]
         
-    except ET.ParseError as e:
-        raise HTTPException(status_code=400, detail=f"Arquivo KML inválido ou corrompido: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro ao processar arquivo KML: {str(e)}")
+        clusters = [
+            {"latitude": group["latitude"], "longitude": group["longitude"], "count": group["count"]}
+            for group in groups if group["count"] > 1
+        ]
+        single_ids = [group["id"] for group in groups if group["count"] == 1]
+        locations = []
+        if single_ids:
+            cursor = db.kml_locations.find({"id": {"$in": single_ids}}, viewport_projection(level))
+            async for location in cursor:
+                locations.append(viewport_location(location, kml_files, location.pop("geometry_levels", None)))
+        return {"zoom": zoom, "clusters": clusters, "locations": locations, "truncated": truncated}
+    
+    locations = await db.kml_locations.find(query, viewport_projection(level)).limit(
+        MAX_VIEWPORT_LOCATIONS + 1
+    ).to_list(length=None)
+    return {
+        "zoom": zoom,
+        "clusters": [],
+        "locations": [
+            viewport_location(location, kml_files, location.pop("geometry_levels", None))
+            for location in locations[:MAX_VIEWPORT_LOCATIONS]
+        ],
+        "truncated": len(locations) > MAX_VIEWPORT_LOCATIONS,
+    }
 
 @api_router.get("/kml/locations")
-async def get_kml_locations(current_user: User = Depends(get_current_user)):
-    kml_files = await db.kml_data.find({"status": "active"}).to_list(length=None)
+async def get_kml_locations(
+    bbox: Optional[str] = None,
+    zoom: Optional[int] = Query(None, ge=0, le=22),
+    current_user: User = Depends(get_current_user)
+):
+    """Todas as localizações ativas, ou só as do viewport com ?bbox=minLng,minLat,maxLng,maxLat.
+    
+    No modo bbox, com ?zoom abaixo de KML_CLUSTER_MAX_ZOOM os pontos vêm agrupados em clusters,
+    e linhas e polígonos trazem ``geometry`` simplificada para o zoom (inteira sem ?zoom).
+    """
+    kml_files = await get_active_kml_files()
+    
+    if bbox:
+        return await get_viewport_locations(kml_files, bbox, zoom)
     
     all_locations = []
-    for kml_file in kml_files:
-        for location in kml_file.get("locations", []):
-            location["source_file"] = kml_file["filename"]
-            location["uploaded_by"] = kml_file["uploaded_by"]
-            all_locations.append(location)
+    cursor = db.kml_locations.find({"kml_id": {"$in": list(kml_files)}}, KML_LOCATION_PROJECTION)
+    async for location in cursor:
+        all_locations.append(attach_kml_source(location, kml_files))
     
     return all_locations
 
+@api_router.get("/kml/nearby")
+async def get_nearby_kml_locations(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_m: float = Query(5000, gt=0, le=MAX_NEARBY_RADIUS_M),
+    limit: int = Query(20, ge=1, le=200),
+    current_user: User = Depends(get_current_user)
+):
+    """Localizações mais próximas de (lat, lng), ordenadas pela distância em metros"""
+    kml_files = await get_active_kml_files()
+    
+    pipeline = [
+        {"$geoNear": {
+            "near": geo_point(lng, lat),
+            "key": "point",
+            "distanceField": "distance_m",
+            "maxDistance": radius_m,
+            "spherical": True,
+            "query": {"kml_id": {"$in": list(kml_files)}},
+        }},
+        {"$limit": limit},
+        {"$project": KML_LOCATION_PROJECTION},
+    ]
+    
+    locations = []
+    async for location in db.kml_locations.aggregate(pipeline):
+        location["distance_m"] = round(location["distance_m"], 1)
+        locations.append(attach_kml_source(location, kml_files))
+    
+    return locations
+
 @api_router.delete("/admin/kml/{kml_id}")
 async def delete_kml_data(kml_id: str, admin_user: User = Depends(get_admin_user)):
-    result = await db.kml_data.delete_one({"id": kml_id})
-    
-    if result.deleted_count == 0:
+    if not await delete_kml_file(kml_id):
         raise HTTPException(status_code=404, detail="Dados KML não encontrados")
+    await location_search.changed()
     
     return {"message": "Dados KML excluídos com sucesso"}
 
+# Documentos lidos do banco por vez nas exportações em streaming
+EXPORT_BATCH_SIZE = 500
+
+def geojson_response(features, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        feature_collection(features),
+        media_type=GEOJSON_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.get("/kml/export.geojson")
+async def export_kml_geojson(current_user: User = Depends(get_current_user)):
+    """Localizações ativas como GeoJSON, com a geometria inteira de linhas e polígonos."""
+    kml_files = await get_active_kml_files()
+    # Da lista de níveis só a última posição (a geometria inteira)
+    projection = {"_id": 0, "search_terms": 0, "geometry_levels": {"$slice": -1}}
+    
+    async def features():
+        cursor = db.kml_locations.find({"kml_id": {"$in": list(kml_files)}}, projection)
+        async for location in cursor.batch_size(EXPORT_BATCH_SIZE):
+            kml_file = kml_files[location["kml_id"]]
+            yield feature(pick_level(location.get("geometry_levels")) or location["point"], {
+                "id": location["id"],
+                "name": location["name"],
+                "description": location.get("description", ""),
+                "source_file": kml_file["filename"],
+                "uploaded_by": kml_file["uploaded_by"],
+            })
+    
+    return geojson_response(features(), "localizacoes.geojson")
+
 @api_router.get("/kml/search")
 async def search_kml_locations(
     query: str,
@@ -843,35 +1417,36 @@ async def search_kml_locations(
     if not query or len(query.strip()) < 2:
         raise HTTPException(status_code=400, detail="Query deve ter pelo menos 2 caracteres")
     
-    query_lower = query.strip().lower()
+    kml_files = await get_active_kml_files()
+    projection = {"_id": 0, "id": 1, "kml_id": 1, "name": 1, "description": 1, "latitude": 1, "longitude": 1}
     
-    # Get all KML files
-    kml_files = await db.kml_data.find({"status": "active"}).to_list(length=None)
+    if location_search.ready:
+        # Índice em memória devolve os ids já ordenados por relevância
+        keys = location_search.search(query, limit)
+        found = {
+            location["id"]: location
+            async for location in db.kml_locations.find({"id": {"$in": keys}}, projection)
+        }
+        locations = [found[key] for key in keys if key in found and found[key]["kml_id"] in kml_files]
+    else:
+        # Índice ainda sendo construído (logo após a inicialização): mesma regra pelos search_terms
+        search = terms_query(query)
+        locations = await db.kml_locations.find(
+            {"kml_id": {"$in": list(kml_files)}, **search}, projection
+        ).limit(limit).to_list(length=None) if search else []
     
     matching_locations = []
-    for kml_file in kml_files:
-        for location in kml_file.get("locations", []):
-            # Search in name and description
-            name_match = query_lower in location.get("name", "").lower()
-            desc_match = query_lower in location.get("description", "").lower()
-            
-            if name_match or desc_match:
-                location_data = {
-                    "id": f"{kml_file['id']}_{len(matching_locations)}",
-                    "name": location.get("name"),
-                    "description": location.get("description"),
-                    "latitude": location.get("latitude"),
-                    "longitude": location.get("longitude"),
-                    "source_file": kml_file["filename"],
-                    "uploaded_by": kml_file["uploaded_by"]
-                }
-                matching_locations.append(location_data)
-                
-                if len(matching_locations) >= limit:
-                    break
-        
-        if len(matching_locations) >= limit:
-            break
+    for location in locations:
+        kml_file = kml_files[location["kml_id"]]
+        matching_locations.append({
+            "id": location["id"],
+            "name": location.get("name"),
+            "description": location.get("description"),
+            "latitude": location.get("latitude"),
+            "longitude": location.get("longitude"),
+            "source_file": kml_file["filename"],
+            "uploaded_by": kml_file["uploaded_by"]
+        })
     
     return {
         "query": query,
@@ -942,8 +1517,10 @@ async def delete_observation(
 # Endpoints para perfil do usuário
 @api_router.put("/user/change-password")
 async def change_user_password(password_change: PasswordChange, current_user: User = Depends(get_current_user)):
-    # Verificar senha atual
-    if not verify_password(password_change.current_password, current_user.hashed_password):
+    # Verificar senha atual (o usuário do token não carrega o hash)
+    user = await db.users.find_one({"id": current_user.id})
+    password_ok, _ = await verify_password(password_change.current_password, user["hashed_password"]) if user else (False, False)
+    if not password_ok:
         raise HTTPException(status_code=400, detail="Current password is incorrect")
     
     # Validar nova senha
@@ -951,13 +1528,14 @@ async def change_user_password(password_change: PasswordChange, current_user: Us
         raise HTTPException(status_code=400, detail="New password must be at least 4 characters")
     
     # Atualizar senha
-    hashed_password = get_password_hash(password_change.new_password)
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$set": {"hashed_password": hashed_password}}
-    )
+    hashed_password = await get_password_hash(password_change.new_password)
+    user = await update_user(current_user.id, {"$set": {"hashed_password": hashed_password}})
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    return {"message": "Password changed successfully"}
+    # As outras sessões caem; esta segue com um token da nova versão
+    access_token = create_user_token(user["id"], user["username"], user["role"], user["status"], user["token_version"])
+    return {"message": "Password changed successfully", "access_token": access_token}
 
 @api_router.get("/reports/timeline")
 async def get_timeline_report(
@@ -1269,8 +1847,15 @@ async def export_pendencias(
     if status:
         query["status"] = status
     
-    # Get data
-    pendencias = await db.pendencias.find(query).sort("created_at", -1).to_list(1000)
+    # Get data - só os campos da planilha, sem as fotos
+    projection = {
+        "_id": 0,
+        "id": 1, "site": 1, "data_hora": 1, "tipo": 1, "subtipo": 1, "observacoes": 1,
+        "status": 1, "usuario_criacao": 1, "usuario_finalizacao": 1, "data_finalizacao": 1,
+        "informacoes_fechamento": 1,
+        "has_photo_fechamento": has_field_expr("foto_fechamento_id", "foto_fechamento_base64")
+    }
+    pendencias = await db.pendencias.find(query, projection).sort("created_at", -1).to_list(1000)
     
     # Create Excel workbook
     wb = Workbook()
@@ -1308,7 +1893,7 @@ async def export_pendencias(
         ws.cell(row=row, column=9, value=pendencia.get("usuario_finalizacao", ""))
         ws.cell(row=row, column=10, value=pendencia["data_finalizacao"].strftime("%d/%m/%Y %H:%M") if pendencia.get("data_finalizacao") else "")
         ws.cell(row=row, column=11, value=pendencia.get("informacoes_fechamento", ""))
-        ws.cell(row=row, column=12, value="Sim" if pendencia.get("foto_fechamento_base64") else "Não")
+        ws.cell(row=row, column=12, value="Sim" if pendencia.get("has_photo_fechamento") else "Não")
     
     # Auto-adjust column width
     for column in ws.columns:
@@ -1332,16 +1917,87 @@ async def export_pendencias(
             filename="pendencias.xlsx"
         )
 
+async def site_points(sites: set, kml_ids: list) -> dict:
+    """Ponto da localização KML com o mesmo nome de cada site"""
+    points = {}
+    cursor = db.kml_locations.find(
+        {"name": {"$in": list(sites)}, "kml_id": {"$in": kml_ids}}, {"_id": 0, "name": 1, "point": 1}
+    )
+    async for location in cursor:
+        points.setdefault(location["name"], location["point"])
+    return points
+
+@api_router.get("/pendencias/export.geojson")
+async def export_pendencias_geojson(
+    site: Optional[str] = None,
+    tipo: Optional[str] = None,
+    status: Optional[str] = None,
+    admin_user: User = Depends(get_admin_user)
+):
+    """Pendências como GeoJSON, no ponto da localização KML do site (sem geometria se não houver)."""
+    query = {}
+    if site:
+        query["site"] = site
+    if tipo:
+        query["tipo"] = tipo
+    if status:
+        query["status"] = status
+    
+    kml_ids = list(await get_active_kml_files())
+    projection = {
+        "_id": 0,
+        "id": 1, "site": 1, "ami": 1, "data_hora": 1, "tipo": 1, "subtipo": 1, "observacoes": 1,
+        "status": 1, "usuario_criacao": 1, "usuario_finalizacao": 1, "data_finalizacao": 1,
+        "informacoes_fechamento": 1, "created_at": 1
+    }
+    
+    async def located(batch):
+        # Um lote de pendências por vez: uma consulta às localizações por lote
+        points = await site_points({pendencia["site"] for pendencia in batch}, kml_ids)
+        for pendencia in batch:
+            yield feature(points.get(pendencia["site"]), pendencia)
+    
+    async def features():
+        batch = []
+        cursor = db.pendencias.find(query, projection).sort("created_at", -1)
+        async for pendencia in cursor.batch_size(EXPORT_BATCH_SIZE):
+            batch.append(pendencia)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                async for item in located(batch):
+                    yield item
+                batch = []
+        if batch:
+            async for item in located(batch):
+                yield item
+    
+    return geojson_response(features(), "pendencias.geojson")
+
+# Definida depois das exportações para não capturar /pendencias/export
+@api_router.get("/pendencias/{pendencia_id}", response_model=Pendencia)
+async def get_pendencia(pendencia_id: str, current_user: User = Depends(get_current_user)):
+    """Pendência completa, usada pela listagem summary para abrir fotos antigas em base64"""
+    pendencia = await db.pendencias.find_one({"id": pendencia_id}, {"_id": 0})
+    if not pendencia:
+        raise HTTPException(status_code=404, detail="Pendência não encontrada")
+    return Pendencia(**pendencia)
+
 
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=MAX_PHOTO_BYTES + MULTIPART_FORM_OVERHEAD,
+    paths=PHOTO_UPLOAD_PATHS,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Configure logging
@@ -1351,6 +2007,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def prepare_database():
+    result = await migrate_legacy_users(db)
+    if result["modified"]:
+        logger.info("Usuários legados migrados: %s", result)
+    result = await migrate_embedded_kml_locations(db)
+    if result["files"]:
+        logger.info("Localizações KML movidas para kml_locations: %s", result)
+    result = await migrate_kml_points(db)
+    if result["modified"]:
+        logger.info("Pontos GeoJSON criados em kml_locations: %s", result)
+    result = await migrate_search_terms(db)
+    if result["modified"]:
+        logger.info("Chaves de busca calculadas: %s", result)
+    result = await migrate_kml_location_ids(db)
+    if result["modified"]:
+        logger.info("Ids estáveis atribuídos a localizações KML: %s", result)
+    # Depois das migrações: alguns índices únicos dependem dos campos que elas preenchem
+    await ensure_indexes()
+    abandoned = await kml_jobs.start()
+    if abandoned:
+        logger.warning("Importações KML interrompidas pelo reinício: %d", abandoned)
+    # Até o índice ficar pronto a busca usa a consulta direta no banco
+    location_search.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    kml_jobs.shutdown()
+    location_search.stop()
     client.close()
\ No newline at end of file
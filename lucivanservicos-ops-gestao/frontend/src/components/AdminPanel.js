@@ -2,11 +2,14 @@ import React, { useState, useEffect } from 'react';
 import { useAuth } from '../contexts/AuthContext';
 import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
+import { fetchLegacyPhoto, openPhoto } from '../lib/photos';
+import PhotoThumbnail from './PhotoThumbnail';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from './ui/card';
 import { Button } from './ui/button';
 import { Badge } from './ui/badge';
 import { Input } from './ui/input';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from './ui/tabs';
+import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from './ui/select';
 import { 
   Users, 
   CheckCircle2, 
@@ -39,6 +42,8 @@ export default function AdminPanel() {
   const [pendingUsers, setPendingUsers] = useState([]);
   const [allUsers, setAllUsers] = useState([]);
   const [allPendencias, setAllPendencias] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [monthlyStats, setMonthlyStats] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
@@ -67,6 +72,9 @@ export default function AdminPanel() {
   const [kmlLocations, setKmlLocations] = useState([]);
   const [kmlUploading, setKmlUploading] = useState(false);
   const [kmlFile, setKmlFile] = useState(null);
+  const [kmlJob, setKmlJob] = useState(null);
+  const [kmlFiles, setKmlFiles] = useState([]);
+  const [kmlReplaceId, setKmlReplaceId] = useState('new');
 
   // Redirect if not admin
   useEffect(() => {
@@ -83,6 +91,7 @@ export default function AdminPanel() {
       loadMonthlyStats();
       loadFormConfig();
       loadKmlLocations();
+      loadKmlFiles();
     }
   }, [isAdmin]);
 
@@ -104,14 +113,21 @@ export default function AdminPanel() {
     }
   };
 
-  const loadAllPendencias = async () => {
+  // Sem cursor recarrega a lista; com cursor acrescenta a próxima página
+  const loadAllPendencias = async (cursor = null) => {
     try {
-      const response = await axios.get(`${API_BASE}/admin/pendencias`);
-      setAllPendencias(response.data);
+      if (cursor) setLoadingMore(true);
+      const params = new URLSearchParams({ view: 'summary' });
+      if (cursor) params.append('cursor', cursor);
+      
+      const response = await axios.get(`${API_BASE}/admin/pendencias?${params.toString()}`);
+      setAllPendencias(prev => cursor ? [...prev, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (err) {
       console.error('Error loading pendencias:', err);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
@@ -247,16 +263,44 @@ export default function AdminPanel() {
     }
   };
 
+  const loadKmlFiles = async () => {
+    try {
+      const response = await axios.get(`${API_BASE}/admin/kml-files`);
+      setKmlFiles(response.data);
+    } catch (err) {
+      console.error('Error loading KML files:', err);
+    }
+  };
+
   const handleKmlFileChange = (event) => {
     const file = event.target.files[0];
-    if (file && file.name.toLowerCase().endsWith('.kml')) {
+    const name = file?.name.toLowerCase() || '';
+    if (name.endsWith('.kml') || name.endsWith('.kmz')) {
       setKmlFile(file);
     } else {
-      setError('Por favor, selecione um arquivo KML válido');
+      setError('Por favor, selecione um arquivo KML ou KMZ válido');
       setTimeout(() => setError(''), 3000);
     }
   };
 
+  // A importação roda em segundo plano: acompanha o job até terminar
+  const waitKmlJob = async (jobId) => {
+    while (true) {
+      const { data: job } = await axios.get(`${API_BASE}/admin/kml-jobs/${jobId}`);
+      setKmlJob(job);
+      if (job.status === 'done' || job.status === 'failed') {
+        return job;
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+  };
+
+  const formatEta = (seconds) => {
+    if (seconds === null || seconds === undefined) return '';
+    if (seconds < 60) return `~${Math.ceil(seconds)}s restantes`;
+    return `~${Math.ceil(seconds / 60)} min restantes`;
+  };
+
   const handleKmlUpload = async () => {
     if (!kmlFile) {
       setError('Selecione um arquivo KML para enviar');
@@ -267,6 +311,9 @@ export default function AdminPanel() {
     setKmlUploading(true);
     const formData = new FormData();
     formData.append('file', kmlFile);
+    if (kmlReplaceId !== 'new') {
+      formData.append('replace_kml_id', kmlReplaceId);
+    }
 
     try {
       const response = await axios.post(`${API_BASE}/admin/upload-kml`, formData, {
@@ -275,21 +322,39 @@ export default function AdminPanel() {
         },
       });
 
-      setSuccess(`${response.data.message}`);
-      setTimeout(() => setSuccess(''), 5000);
       setKmlFile(null);
       
       // Reset file input
       const fileInput = document.getElementById('kml-file-input');
       if (fileInput) fileInput.value = '';
       
-      // Reload locations
-      loadKmlLocations();
+      if (response.data.duplicate && !response.data.job_id) {
+        // Conteúdo idêntico a um arquivo já importado: nada foi processado
+        setError(`${response.data.message} Enviado por ${response.data.uploaded_by} em ${new Date(response.data.uploaded_at).toLocaleString('pt-BR')}.`);
+        setTimeout(() => setError(''), 5000);
+        return;
+      }
+
+      const job = await waitKmlJob(response.data.job_id);
+      if (job.status === 'done') {
+        setSuccess(job.mode === 'replace'
+          ? `Arquivo KML atualizado! ${job.inserted} novas, ${job.changed} alteradas, ${job.removed} removidas (${job.unchanged} sem mudança).`
+          : `Arquivo KML processado com sucesso! ${job.locations} localizações encontradas.`);
+        setTimeout(() => setSuccess(''), 5000);
+        setKmlReplaceId('new');
+        // Reload locations
+        loadKmlLocations();
+        loadKmlFiles();
+      } else {
+        setError(job.errors[job.errors.length - 1] || 'Erro ao processar arquivo KML');
+        setTimeout(() => setError(''), 5000);
+      }
     } catch (err) {
       setError(err.response?.data?.detail || 'Erro ao processar arquivo KML');
       setTimeout(() => setError(''), 5000);
     } finally {
       setKmlUploading(false);
+      setKmlJob(null);
     }
   };
 
@@ -542,44 +607,36 @@ export default function AdminPanel() {
                         
                         <div className="flex items-center justify-between">
                           <div className="flex space-x-2">
-                            {pendencia.foto_base64 && (
+                            {pendencia.has_photo && (
                               <Button
                                 variant="outline"
                                 size="sm"
-                                onClick={() => {
-                                  const newWindow = window.open();
-                                  newWindow.document.write(`
-                                    <html>
-                                      <head><title>Foto da Abertura</title></head>
-                                      <body style="margin: 0; display: flex; justify-content: center; align-items: center; min-height: 100vh; background: #f5f5f5;">
-                                        <img src="data:image/jpeg;base64,${pendencia.foto_base64}" style="max-width: 90%; max-height: 90%; object-fit: contain;" />
-                                      </body>
-                                    </html>
-                                  `);
-                                }}
+                                onClick={() => openPhoto({
+                                  photoId: pendencia.foto_id,
+                                  load: () => fetchLegacyPhoto(pendencia.id, 'foto_base64'),
+                                  title: 'Foto da Abertura'
+                                })}
                               >
-                                <Eye className="w-4 h-4 mr-1" />
+                                {pendencia.foto_thumb_url
+                                  ? <PhotoThumbnail url={pendencia.foto_thumb_url} className="w-6 h-6 mr-2" />
+                                  : <Eye className="w-4 h-4 mr-1" />}
                                 Ver Foto Abertura
                               </Button>
                             )}
                             
-                            {pendencia.foto_fechamento_base64 && (
+                            {pendencia.has_photo_fechamento && (
                               <Button
                                 variant="outline"
                                 size="sm"
-                                onClick={() => {
-                                  const newWindow = window.open();
-                                  newWindow.document.write(`
-                                    <html>
-                                      <head><title>Foto do Fechamento</title></head>
-                                      <body style="margin: 0; display: flex; justify-content: center; align-items: center; min-height: 100vh; background: #f5f5f5;">
-                                        <img src="data:image/jpeg;base64,${pendencia.foto_fechamento_base64}" style="max-width: 90%; max-height: 90%; object-fit: contain;" />
-                                      </body>
-                                    </html>
-                                  `);
-                                }}
+                                onClick={() => openPhoto({
+                                  photoId: pendencia.foto_fechamento_id,
+                                  load: () => fetchLegacyPhoto(pendencia.id, 'foto_fechamento_base64'),
+                                  title: 'Foto do Fechamento'
+                                })}
                               >
-                                <Eye className="w-4 h-4 mr-1" />
+                                {pendencia.foto_fechamento_thumb_url
+                                  ? <PhotoThumbnail url={pendencia.foto_fechamento_thumb_url} className="w-6 h-6 mr-2" />
+                                  : <Eye className="w-4 h-4 mr-1" />}
                                 Ver Foto Fechamento
                               </Button>
                             )}
@@ -612,6 +669,19 @@ export default function AdminPanel() {
                   </Card>
                 ))
             )}
+            
+            {nextCursor && (
+              <div className="flex justify-center">
+                <Button
+                  variant="outline"
+                  onClick={() => loadAllPendencias(nextCursor)}
+                  disabled={loadingMore}
+                  data-testid="admin-load-more-btn"
+                >
+                  {loadingMore ? 'Carregando...' : 'Carregar mais'}
+                </Button>
+              </div>
+            )}
           </TabsContent>
 
           {/* Configurar Formulário */}
@@ -767,15 +837,29 @@ export default function AdminPanel() {
                     <div>
                       <h3 className="text-lg font-semibold mb-2">Importar Arquivo KML</h3>
                       <p className="text-sm text-slate-600 dark:text-slate-400 mb-4">
-                        Selecione um arquivo KML contendo dados de localização
+                        Selecione um arquivo KML ou KMZ contendo dados de localização
                       </p>
                     </div>
                     
                     <div className="flex flex-col sm:flex-row items-center gap-3 justify-center">
+                      <Select value={kmlReplaceId} onValueChange={setKmlReplaceId} disabled={kmlUploading}>
+                        <SelectTrigger className="w-full sm:w-64">
+                          <SelectValue placeholder="Importar como novo arquivo" />
+                        </SelectTrigger>
+                        <SelectContent>
+                          <SelectItem value="new">Importar como novo arquivo</SelectItem>
+                          {kmlFiles.map((kmlFileItem) => (
+                            <SelectItem key={kmlFileItem.id} value={kmlFileItem.id}>
+                              Substituir {kmlFileItem.filename}
+                            </SelectItem>
+                          ))}
+                        </SelectContent>
+                      </Select>
+
                       <input
                         id="kml-file-input"
                         type="file"
-                        accept=".kml"
+                        accept=".kml,.kmz"
                         onChange={handleKmlFileChange}
                         className="block text-sm text-slate-500 file:mr-4 file:py-2 file:px-4 file:rounded-md file:border-0 file:text-sm file:font-semibold file:bg-blue-50 file:text-blue-700 hover:file:bg-blue-100"
                       />
@@ -804,6 +888,25 @@ export default function AdminPanel() {
                         Arquivo selecionado: <span className="font-medium">{kmlFile.name}</span>
                       </div>
                     )}
+
+                    {kmlJob && (
+                      <div className="max-w-md mx-auto space-y-2">
+                        <div className="h-2 bg-slate-200 dark:bg-slate-700 rounded-full overflow-hidden">
+                          <div
+                            className="h-full bg-emerald-500 transition-all"
+                            style={{ width: `${kmlJob.size ? Math.round((kmlJob.bytes_read / kmlJob.size) * 100) : 0}%` }}
+                          ></div>
+                        </div>
+                        <div className="text-sm text-slate-600 dark:text-slate-400">
+                          {kmlJob.status === 'queued'
+                            ? 'Na fila de importação...'
+                            : `${kmlJob.placemarks} placemarks lidos, ${kmlJob.locations} localizações gravadas`}
+                          {kmlJob.skipped > 0 && ` (${kmlJob.skipped} sem coordenadas)`}
+                          {kmlJob.duplicates > 0 && ` (${kmlJob.duplicates} repetidos ignorados)`}
+                          {kmlJob.status === 'running' && kmlJob.eta_seconds !== null && ` · ${formatEta(kmlJob.eta_seconds)}`}
+                        </div>
+                      </div>
+                    )}
                   </div>
                 </div>
 
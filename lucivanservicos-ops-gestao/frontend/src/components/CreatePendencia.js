@@ -78,21 +78,8 @@ export default function CreatePendencia() {
     loadFormOptions();
   }, []);
 
-  // Função para converter arquivo para base64
-  const fileToBase64 = (file) => {
-    return new Promise((resolve, reject) => {
-      const reader = new FileReader();
-      reader.readAsDataURL(file);
-      reader.onload = () => {
-        const base64 = reader.result.split(',')[1]; // Remove o prefixo data:image/...;base64,
-        resolve(base64);
-      };
-      reader.onerror = reject;
-    });
-  };
-
   // Dropzone para upload de imagem
-  const onDrop = useCallback(async (acceptedFiles) => {
+  const onDrop = useCallback((acceptedFiles) => {
     const file = acceptedFiles[0];
     if (file) {
       // Verifica se é uma imagem
@@ -107,14 +94,10 @@ export default function CreatePendencia() {
         return;
       }
       
-      try {
-        const base64 = await fileToBase64(file);
-        setPhoto(base64);
-        setPhotoPreview(URL.createObjectURL(file));
-        setError('');
-      } catch (err) {
-        setError('Erro ao processar a imagem');
-      }
+      // O arquivo é enviado como binário (multipart), sem conversão para base64
+      setPhoto(file);
+      setPhotoPreview(URL.createObjectURL(file));
+      setError('');
     }
   }, []);
 
@@ -166,15 +149,14 @@ export default function CreatePendencia() {
         return;
       }
       
-      const payload = {
-        site: formData.site.trim(),
-        tipo: formData.tipo,
-        subtipo: formData.subtipo,
-        observacoes: formData.observacoes.trim(),
-        foto_base64: photo
-      };
+      const payload = new FormData();
+      payload.append('site', formData.site.trim());
+      payload.append('tipo', formData.tipo);
+      payload.append('subtipo', formData.subtipo);
+      payload.append('observacoes', formData.observacoes.trim());
+      payload.append('foto', photo);
       
-      await axios.post(`${API_BASE}/pendencias`, payload);
+      await axios.post(`${API_BASE}/pendencias/upload`, payload);
       
       setSuccess('Pendência criada com sucesso!');
       
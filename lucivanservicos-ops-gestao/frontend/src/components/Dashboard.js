@@ -1,7 +1,9 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useAuth } from '../contexts/AuthContext';
 import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
+import { fetchLegacyPhoto, openPhoto } from '../lib/photos';
+import PhotoThumbnail from './PhotoThumbnail';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from './ui/card';
 import { Button } from './ui/button';
 import { Input } from './ui/input';
@@ -39,6 +41,8 @@ export default function Dashboard() {
   const [pendencias, setPendencias] = useState([]);
   const [sites, setSites] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [error, setError] = useState('');
   const [success, setSuccess] = useState('');
   
@@ -68,30 +72,47 @@ export default function Dashboard() {
 
   // Load data on mount
   useEffect(() => {
-    loadPendencias();
     loadSites();
   }, []);
 
-  // Reload when filters change
+  // Carga inicial e recarga quando os filtros mudam
   useEffect(() => {
     loadPendencias();
   }, [filters.site, filters.tipo, filters.status]);
 
-  const loadPendencias = async () => {
+  // A busca roda no servidor; espera o usuário parar de digitar.
+  // Na montagem a carga inicial já vem do efeito acima
+  const searchMounted = useRef(false);
+  useEffect(() => {
+    if (!searchMounted.current) {
+      searchMounted.current = true;
+      return;
+    }
+    const timeout = setTimeout(() => loadPendencias(), 300);
+    return () => clearTimeout(timeout);
+  }, [filters.search]);
+
+  // Sem cursor recarrega a lista; com cursor acrescenta a próxima página
+  const loadPendencias = async (cursor = null) => {
     try {
-      setLoading(true);
+      cursor ? setLoadingMore(true) : setLoading(true);
       const params = new URLSearchParams();
       if (filters.site) params.append('site', filters.site);
       if (filters.tipo) params.append('tipo', filters.tipo);
       if (filters.status) params.append('status', filters.status);
+      if (filters.search.trim()) params.append('q', filters.search.trim());
+      if (cursor) params.append('cursor', cursor);
+      params.append('view', 'summary');
       
       const response = await axios.get(`${API_BASE}/pendencias?${params.toString()}`);
-      setPendencias(response.data);
+      setPendencias(prev => cursor ? [...prev, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (err) {
       console.error('Error loading pendencias:', err);
       setError('Erro ao carregar pendências');
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
@@ -166,21 +187,23 @@ export default function Dashboard() {
     loadPendencias();
   };
 
-  const handleExport = async () => {
+  // Excel ou GeoJSON (para abrir no QGIS), com os mesmos filtros
+  const handleExport = async (format = 'xlsx') => {
     try {
       const params = new URLSearchParams();
       if (filters.site) params.append('site', filters.site);
       if (filters.tipo) params.append('tipo', filters.tipo);
       if (filters.status) params.append('status', filters.status);
       
-      const response = await axios.get(`${API_BASE}/pendencias/export?${params.toString()}`, {
+      const path = format === 'geojson' ? 'export.geojson' : 'export';
+      const response = await axios.get(`${API_BASE}/pendencias/${path}?${params.toString()}`, {
         responseType: 'blob'
       });
       
       const url = window.URL.createObjectURL(new Blob([response.data]));
       const link = document.createElement('a');
       link.href = url;
-      link.setAttribute('download', 'pendencias.xlsx');
+      link.setAttribute('download', `pendencias.${format}`);
       document.body.appendChild(link);
       link.click();
       document.body.removeChild(link);
@@ -195,16 +218,6 @@ export default function Dashboard() {
     }
   };
 
-  const filteredPendencias = pendencias.filter(pendencia => {
-    if (!filters.search) return true;
-    const searchLower = filters.search.toLowerCase();
-    return (
-      pendencia.site.toLowerCase().includes(searchLower) ||
-      pendencia.observacoes.toLowerCase().includes(searchLower) ||
-      pendencia.usuario_criacao.toLowerCase().includes(searchLower)
-    );
-  });
-
   const stats = {
     total: pendencias.length,
     pendente: pendencias.filter(p => p.status === 'Pendente').length,
@@ -424,9 +437,18 @@ export default function Dashboard() {
             </div>
             
             {isAdmin && (
-              <div className="flex justify-end mt-4">
+              <div className="flex justify-end gap-2 mt-4">
                 <Button
-                  onClick={handleExport}
+                  onClick={() => handleExport('geojson')}
+                  variant="outline"
+                  data-testid="export-geojson-btn"
+                  className="btn-hover"
+                >
+                  <Download className="w-4 h-4 mr-2" />
+                  Exportar GeoJSON
+                </Button>
+                <Button
+                  onClick={() => handleExport()}
                   variant="outline"
                   data-testid="export-btn"
                   className="btn-hover"
@@ -441,7 +463,7 @@ export default function Dashboard() {
 
         {/* Pendências List */}
         <div className="space-y-4">
-          {filteredPendencias.length === 0 ? (
+          {pendencias.length === 0 ? (
             <Card className="glass">
               <CardContent className="p-12 text-center">
                 <AlertCircle className="w-12 h-12 text-slate-400 mx-auto mb-4" />
@@ -457,7 +479,7 @@ export default function Dashboard() {
               </CardContent>
             </Card>
           ) : (
-            filteredPendencias.map((pendencia) => (
+            pendencias.map((pendencia) => (
               <Card key={pendencia.id} className="card-hover glass" data-testid="pendencia-card">
                 <CardContent className="p-6">
                   <div className="flex flex-col lg:flex-row lg:items-center lg:justify-between space-y-4 lg:space-y-0">
@@ -539,47 +561,39 @@ export default function Dashboard() {
                     
                     {/* Actions */}
                     <div className="flex items-center space-x-3 flex-wrap gap-y-2">
-                      {pendencia.foto_base64 && (
+                      {pendencia.has_photo && (
                         <Button
                           variant="outline"
                           size="sm"
-                          onClick={() => {
-                            const newWindow = window.open();
-                            newWindow.document.write(`
-                              <html>
-                                <head><title>Foto da Pendência</title></head>
-                                <body style="margin: 0; display: flex; justify-content: center; align-items: center; min-height: 100vh; background: #f5f5f5;">
-                                  <img src="data:image/jpeg;base64,${pendencia.foto_base64}" style="max-width: 90%; max-height: 90%; object-fit: contain;" />
-                                </body>
-                              </html>
-                            `);
-                          }}
+                          onClick={() => openPhoto({
+                            photoId: pendencia.foto_id,
+                            load: () => fetchLegacyPhoto(pendencia.id, 'foto_base64'),
+                            title: 'Foto da Pendência'
+                          })}
                           data-testid="view-photo-btn"
                         >
-                          <Eye className="w-4 h-4 mr-1" />
+                          {pendencia.foto_thumb_url
+                            ? <PhotoThumbnail url={pendencia.foto_thumb_url} className="w-6 h-6 mr-2" />
+                            : <Eye className="w-4 h-4 mr-1" />}
                           Ver Foto Abertura
                         </Button>
                       )}
                       
-                      {pendencia.foto_fechamento_base64 && (
+                      {pendencia.has_photo_fechamento && (
                         <Button
                           variant="outline"
                           size="sm"
-                          onClick={() => {
-                            const newWindow = window.open();
-                            newWindow.document.write(`
-                              <html>
-                                <head><title>Foto do Fechamento</title></head>
-                                <body style="margin: 0; display: flex; justify-content: center; align-items: center; min-height: 100vh; background: #f5f5f5;">
-                                  <img src="data:image/jpeg;base64,${pendencia.foto_fechamento_base64}" style="max-width: 90%; max-height: 90%; object-fit: contain;" />
-                                </body>
-                              </html>
-                            `);
-                          }}
+                          onClick={() => openPhoto({
+                            photoId: pendencia.foto_fechamento_id,
+                            load: () => fetchLegacyPhoto(pendencia.id, 'foto_fechamento_base64'),
+                            title: 'Foto do Fechamento'
+                          })}
                           data-testid="view-close-photo-btn"
                           className="border-emerald-200 text-emerald-700 hover:bg-emerald-50"
                         >
-                          <Eye className="w-4 h-4 mr-1" />
+                          {pendencia.foto_fechamento_thumb_url
+                            ? <PhotoThumbnail url={pendencia.foto_fechamento_thumb_url} className="w-6 h-6 mr-2" />
+                            : <Eye className="w-4 h-4 mr-1" />}
                           Ver Foto Fechamento
                         </Button>
                       )}
@@ -641,6 +655,19 @@ export default function Dashboard() {
               </Card>
             ))
           )}
+          
+          {nextCursor && (
+            <div className="flex justify-center">
+              <Button
+                variant="outline"
+                onClick={() => loadPendencias(nextCursor)}
+                disabled={loadingMore}
+                data-testid="load-more-btn"
+              >
+                {loadingMore ? 'Carregando...' : 'Carregar mais'}
+              </Button>
+            </div>
+          )}
         </div>
 
         {/* Modals */}
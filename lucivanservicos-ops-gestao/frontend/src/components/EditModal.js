@@ -1,6 +1,7 @@
 import React, { useState, useCallback, useEffect } from 'react';
 import { useDropzone } from 'react-dropzone';
 import axios from 'axios';
+import { fetchLegacyPhoto, fetchPhotoUrl } from '../lib/photos';
 import {
   Dialog,
   DialogContent,
@@ -77,6 +78,8 @@ export default function EditModal({
   
   const [photo, setPhoto] = useState(null);
   const [photoPreview, setPhotoPreview] = useState(null);
+  // Usuário tirou a foto atual sem escolher outra
+  const [photoRemoved, setPhotoRemoved] = useState(false);
 
   // Initialize form when modal opens
   useEffect(() => {
@@ -88,12 +91,23 @@ export default function EditModal({
         observacoes: pendencia.observacoes || ''
       });
       
-      // Set existing photo if available
-      if (pendencia.foto_base64) {
-        setPhoto(pendencia.foto_base64);
+      // Foto atual só para preview; só é reenviada se o usuário escolher outra
+      setPhoto(null);
+      setPhotoRemoved(false);
+      if (pendencia.foto_id) {
+        setPhotoPreview(null);
+        fetchPhotoUrl(pendencia.foto_id, 160)
+          .then(setPhotoPreview)
+          .catch((err) => console.error('Error loading photo:', err));
+      } else if (pendencia.foto_base64) {
         setPhotoPreview(`data:image/jpeg;base64,${pendencia.foto_base64}`);
+      } else if (pendencia.has_photo) {
+        // Vindo da listagem summary: o base64 legado é buscado só para o preview
+        setPhotoPreview(null);
+        fetchLegacyPhoto(pendencia.id, 'foto_base64')
+          .then((base64) => setPhotoPreview(`data:image/jpeg;base64,${base64}`))
+          .catch((err) => console.error('Error loading photo:', err));
       } else {
-        setPhoto(null);
         setPhotoPreview(null);
       }
       
@@ -133,6 +147,7 @@ export default function EditModal({
       try {
         const base64 = await fileToBase64(file);
         setPhoto(base64);
+        setPhotoRemoved(false);
         setPhotoPreview(URL.createObjectURL(file));
         setError('');
       } catch (err) {
@@ -151,6 +166,7 @@ export default function EditModal({
 
   const removePhoto = () => {
     setPhoto(null);
+    setPhotoRemoved(true);
     if (photoPreview && !photoPreview.startsWith('data:image/jpeg;base64,')) {
       URL.revokeObjectURL(photoPreview);
     }
@@ -190,7 +206,8 @@ export default function EditModal({
         tipo: formData.tipo,
         subtipo: formData.subtipo,
         observacoes: formData.observacoes.trim(),
-        foto_base64: photo || null
+        foto_base64: photo || null,
+        remove_photo: photoRemoved
       };
 
       await axios.put(`${API_BASE}/pendencias/${pendencia.id}/edit`, payload);
@@ -305,7 +322,7 @@ export default function EditModal({
           <div className="space-y-2">
             <Label className="text-sm font-medium text-slate-700">Foto (Opcional)</Label>
             
-            {!photo ? (
+            {!photoPreview ? (
               <div
                 {...getRootProps()}
                 className={`upload-area border-2 border-dashed rounded-lg p-6 text-center cursor-pointer transition-all duration-200 ${
@@ -47,21 +47,8 @@ export default function FinalizeModal({
     }
   }, [isOpen]);
 
-  // Função para converter arquivo para base64
-  const fileToBase64 = (file) => {
-    return new Promise((resolve, reject) => {
-      const reader = new FileReader();
-      reader.readAsDataURL(file);
-      reader.onload = () => {
-        const base64 = reader.result.split(',')[1]; // Remove o prefixo data:image/...;base64,
-        resolve(base64);
-      };
-      reader.onerror = reject;
-    });
-  };
-
   // Dropzone para upload de imagem
-  const onDrop = useCallback(async (acceptedFiles) => {
+  const onDrop = useCallback((acceptedFiles) => {
     const file = acceptedFiles[0];
     if (file) {
       // Verifica se é uma imagem
@@ -76,14 +63,10 @@ export default function FinalizeModal({
         return;
       }
       
-      try {
-        const base64 = await fileToBase64(file);
-        setPhoto(base64);
-        setPhotoPreview(URL.createObjectURL(file));
-        setError('');
-      } catch (err) {
-        setError('Erro ao processar a imagem');
-      }
+      // O arquivo é enviado como binário (multipart), sem conversão para base64
+      setPhoto(file);
+      setPhotoPreview(URL.createObjectURL(file));
+      setError('');
     }
   }, []);
 
@@ -120,11 +103,11 @@ export default function FinalizeModal({
     setIsLoading(true);
 
     try {
-      await axios.put(`${API_BASE}/pendencias/${pendencia.id}`, {
-        status: 'Finalizado',
-        informacoes_fechamento: informacoesFechamento.trim(),
-        foto_fechamento_base64: photo
-      });
+      const payload = new FormData();
+      payload.append('informacoes_fechamento', informacoesFechamento.trim());
+      payload.append('foto_fechamento', photo);
+
+      await axios.put(`${API_BASE}/pendencias/${pendencia.id}/finalize`, payload);
 
       onSuccess();
       onClose();
@@ -16,7 +16,8 @@ import {
   MessageSquare,
   Plus,
   Trash2,
-  User
+  User,
+  Navigation
 } from 'lucide-react';
 import { Alert, AlertDescription } from './ui/alert';
 
@@ -65,6 +66,44 @@ export default function LocationsMap() {
     }
   };
 
+  // Localizações mais próximas da posição atual do aparelho
+  const searchNearby = () => {
+    if (!navigator.geolocation) {
+      setError('Geolocalização não disponível neste navegador');
+      return;
+    }
+
+    setSearching(true);
+    setError('');
+    navigator.geolocation.getCurrentPosition(
+      async (position) => {
+        try {
+          const response = await axios.get(`${API_BASE}/kml/nearby`, {
+            params: {
+              lat: position.coords.latitude,
+              lng: position.coords.longitude,
+              radius_m: 20000,
+              limit: 20
+            }
+          });
+          setLocations(response.data);
+          setSearchTerm('');
+          setSearchPerformed(true);
+        } catch (err) {
+          console.error('Error searching nearby locations:', err);
+          setError('Erro ao buscar localizações próximas');
+          setLocations([]);
+        } finally {
+          setSearching(false);
+        }
+      },
+      () => {
+        setError('Não foi possível obter sua localização');
+        setSearching(false);
+      }
+    );
+  };
+
   const handleSearchKeyPress = (e) => {
     if (e.key === 'Enter') {
       searchLocations();
@@ -233,6 +272,10 @@ export default function LocationsMap() {
                   )}
                 </Button>
                 
+                <Button onClick={searchNearby} disabled={searching} variant="outline" title="Perto de mim">
+                  <Navigation className="w-4 h-4" />
+                </Button>
+                
                 {searchPerformed && (
                   <Button onClick={clearSearch} variant="outline">
                     Limpar
@@ -327,7 +370,11 @@ export default function LocationsMap() {
                   <div className="bg-slate-50 dark:bg-slate-800 rounded-lg p-3 space-y-2">
                     <div className="flex justify-between items-center text-xs">
                       <span className="text-slate-500">Coordenadas:</span>
-                      <span className="text-slate-600 dark:text-slate-400">GPS</span>
+                      <span className="text-slate-600 dark:text-slate-400">
+                        {location.distance_m != null
+                          ? `${(location.distance_m / 1000).toFixed(1)} km`
+                          : 'GPS'}
+                      </span>
                     </div>
                     <div className="space-y-1 text-xs font-mono">
                       <div className="flex justify-between">
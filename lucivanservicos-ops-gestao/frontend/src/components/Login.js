@@ -9,7 +9,7 @@ import { AlertCircle, Loader2, ClipboardList } from 'lucide-react';
 import { Alert, AlertDescription } from './ui/alert';
 
 export default function Login() {
-  const { login, register } = useAuth();
+  const { login, register, notice } = useAuth();
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState('');
   const [activeTab, setActiveTab] = useState('login');
@@ -118,6 +118,13 @@ export default function Login() {
                   <AlertDescription>{error}</AlertDescription>
                 </Alert>
               )}
+
+              {notice && !error && (
+                <Alert className="mb-4">
+                  <AlertCircle className="h-4 w-4" />
+                  <AlertDescription>{notice}</AlertDescription>
+                </Alert>
+              )}
               
               <TabsContent value="login" className="space-y-4">
                 <form onSubmit={handleLogin} className="space-y-4">
@@ -19,6 +19,9 @@ export default function PendingApproval() {
     const updatedUser = await checkUserStatus();
     if (updatedUser?.status === 'APPROVED') {
       navigate('/dashboard');
+    } else if (!localStorage.getItem('token')) {
+      // Conta aprovada ou rejeitada: o token antigo não vale mais
+      navigate('/login');
     }
   };
 
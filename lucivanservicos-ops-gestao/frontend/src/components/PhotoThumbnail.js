@@ -0,0 +1,31 @@
+import React, { useEffect, useState } from 'react';
+import { fetchPhotoFromUrl } from '../lib/photos';
+
+// Miniatura pré-gerada no backend (foto_thumb_url); a foto inteira só é buscada ao abrir
+export default function PhotoThumbnail({ url, className = 'w-6 h-6' }) {
+  const [src, setSrc] = useState(null);
+
+  useEffect(() => {
+    let objectUrl = null;
+    let cancelled = false;
+    fetchPhotoFromUrl(url)
+      .then((loaded) => {
+        if (cancelled) {
+          URL.revokeObjectURL(loaded);
+        } else {
+          objectUrl = loaded;
+          setSrc(loaded);
+        }
+      })
+      .catch((err) => console.error('Error loading thumbnail:', err));
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [url]);
+
+  if (!src) {
+    return <span className={`${className} inline-block rounded bg-slate-200 dark:bg-slate-700 animate-pulse`} />;
+  }
+  return <img src={src} alt="" loading="lazy" className={`${className} rounded object-cover`} />;
+}
@@ -25,7 +25,7 @@ import { Alert, AlertDescription } from './ui/alert';
 const API_BASE = process.env.REACT_APP_BACKEND_URL + '/api';
 
 export default function UserProfile() {
-  const { user, logout } = useAuth();
+  const { user, logout, updateToken } = useAuth();
   const navigate = useNavigate();
   
   const [userStats, setUserStats] = useState(null);
@@ -75,10 +75,12 @@ export default function UserProfile() {
 
     setPasswordLoading(true);
     try {
-      await axios.put(`${API_BASE}/user/change-password`, {
+      const response = await axios.put(`${API_BASE}/user/change-password`, {
         current_password: passwordForm.currentPassword,
         new_password: passwordForm.newPassword
       });
+      // A troca de senha revoga os tokens antigos; o backend devolve um novo
+      updateToken(response.data.access_token);
       
       setSuccess('Senha alterada com sucesso!');
       setPasswordForm({
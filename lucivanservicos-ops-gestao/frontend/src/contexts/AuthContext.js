@@ -18,6 +18,8 @@ export function AuthProvider({ children }) {
   const [loading, setLoading] = useState(true);
   const [token, setToken] = useState(localStorage.getItem('token'));
   const [isAdmin, setIsAdmin] = useState(false);
+  // Aviso exibido na tela de login depois de uma saída forçada
+  const [notice, setNotice] = useState('');
 
   // Configure axios defaults
   useEffect(() => {
@@ -61,6 +63,7 @@ export function AuthProvider({ children }) {
       
       localStorage.setItem('token', access_token);
       setToken(access_token);
+      setNotice('');
       setUser({ id: user_id, username: userName, role });
       setIsAdmin(role === 'ADMIN');
       
@@ -106,10 +109,23 @@ export function AuthProvider({ children }) {
       return response.data;
     } catch (error) {
       console.error('Status check failed:', error);
+      // 401: o token de cadastro foi revogado porque o administrador aprovou ou
+      // rejeitou a conta; é preciso entrar de novo para receber um token novo
+      if (error.response?.status === 401) {
+        logout();
+        setNotice('Seu cadastro foi analisado pelo administrador. Entre novamente com seu usuário e senha.');
+      }
       return null;
     }
   };
 
+  // Troca o token da sessão atual (ex.: o backend revogou o anterior ao trocar a senha)
+  const updateToken = (accessToken) => {
+    localStorage.setItem('token', accessToken);
+    axios.defaults.headers.common['Authorization'] = `Bearer ${accessToken}`;
+    setToken(accessToken);
+  };
+
   const logout = () => {
     localStorage.removeItem('token');
     setToken(null);
@@ -126,7 +142,9 @@ export function AuthProvider({ children }) {
     loading,
     token,
     isAdmin,
-    checkUserStatus
+    checkUserStatus,
+    updateToken,
+    notice
   };
 
   return (
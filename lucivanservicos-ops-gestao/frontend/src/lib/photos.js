@@ -0,0 +1,45 @@
+import axios from 'axios';
+
+const API_BASE = process.env.REACT_APP_BACKEND_URL + '/api';
+
+// Busca a foto no backend (com o token de autenticação) e devolve uma URL local.
+// Com `size`, o backend devolve a miniatura pré-gerada mais próxima.
+export async function fetchPhotoUrl(photoId, size) {
+  const response = await axios.get(`${API_BASE}/photos/${photoId}`, {
+    params: size ? { size } : undefined,
+    responseType: 'blob'
+  });
+  return URL.createObjectURL(response.data);
+}
+
+// Abre a foto em uma nova janela; aceita a referência nova (id), o base64 legado
+// ou `load`, que busca o base64 legado depois (listagens em ?view=summary)
+export async function openPhoto({ photoId, base64, load, title }) {
+  const newWindow = window.open();
+  let src;
+  if (photoId) {
+    src = await fetchPhotoUrl(photoId);
+  } else {
+    src = `data:image/jpeg;base64,${base64 || await load()}`;
+  }
+  newWindow.document.write(`
+    <html>
+      <head><title>${title}</title></head>
+      <body style="margin: 0; display: flex; justify-content: center; align-items: center; min-height: 100vh; background: #f5f5f5;">
+        <img src="${src}" style="max-width: 90%; max-height: 90%; object-fit: contain;" />
+      </body>
+    </html>
+  `);
+}
+
+// Mesma busca a partir de uma URL já montada pelo backend (ex.: foto_thumb_url)
+export async function fetchPhotoFromUrl(url) {
+  const response = await axios.get(`${process.env.REACT_APP_BACKEND_URL}${url}`, { responseType: 'blob' });
+  return URL.createObjectURL(response.data);
+}
+
+// Base64 legado de uma pendência listada em ?view=summary (a listagem não traz as fotos inline)
+export async function fetchLegacyPhoto(pendenciaId, field) {
+  const response = await axios.get(`${API_BASE}/pendencias/${pendenciaId}`);
+  return response.data[field];
+}
@@ -8,11 +8,15 @@ import requests
 import json
 import sys
 from datetime import datetime
-import hashlib
 import os
+from pathlib import Path
 from motor.motor_asyncio import AsyncIOMotorClient
 import asyncio
 
+# Mesmo hash de senhas do backend (bcrypt; SHA-256 só nos hashes legados)
+sys.path.insert(0, str(Path(__file__).resolve().parent / "backend"))
+from password_hasher import PasswordHasher
+
 # Configuration
 BASE_URL = "https://pendency-hub.preview.emergentagent.com/api"
 ADMIN_USERNAME = "admin"
@@ -25,10 +29,12 @@ class DeepPasswordTester:
         self.admin_token = None
         self.mongo_client = None
         self.db = None
+        self.password_hasher = PasswordHasher(legacy_secret=SECRET_KEY)
         
-    def get_password_hash(self, password):
-        """Replicate the backend password hashing logic"""
-        return hashlib.sha256((password + SECRET_KEY).encode()).hexdigest()
+    async def password_matches(self, password, hashed_password):
+        """bcrypt usa salt aleatório: o hash é conferido, não recalculado"""
+        matches, _ = await self.password_hasher.verify(password, hashed_password)
+        return matches
     
     async def connect_to_db(self):
         """Connect to MongoDB"""
@@ -125,12 +131,11 @@ class DeepPasswordTester:
             
             user_id = user_data["id"]
             original_hash = user_data["hashed_password"]
-            expected_original_hash = self.get_password_hash(original_password)
+            original_hash_ok = await self.password_matches(original_password, original_hash)
             
             print(f"User ID: {user_id}")
             print(f"Original hash in DB: {original_hash}")
-            print(f"Expected hash: {expected_original_hash}")
-            print(f"Hash matches expected: {'✅ YES' if original_hash == expected_original_hash else '❌ NO'}")
+            print(f"Hash matches password: {'✅ YES' if original_hash_ok else '❌ NO'}")
             
             # Approve user
             approve_response = requests.put(
@@ -185,14 +190,15 @@ class DeepPasswordTester:
                 return False
             
             new_hash = user_data_after["hashed_password"]
-            expected_new_hash = self.get_password_hash(new_password)
+            new_hash_ok = await self.password_matches(new_password, new_hash)
+            old_password_in_new_hash = await self.password_matches(original_password, new_hash)
             
             print(f"\nPassword Hash Analysis:")
             print(f"Original hash: {original_hash}")
             print(f"New hash in DB: {new_hash}")
-            print(f"Expected new hash: {expected_new_hash}")
             print(f"Hash actually changed: {'✅ YES' if original_hash != new_hash else '🚨 NO (BUG!)'}")
-            print(f"New hash is correct: {'✅ YES' if new_hash == expected_new_hash else '❌ NO'}")
+            print(f"New hash matches new password: {'✅ YES' if new_hash_ok else '❌ NO'}")
+            print(f"New hash rejects old password: {'✅ YES' if not old_password_in_new_hash else '❌ NO'}")
             
             if original_hash == new_hash:
                 print("\n🚨 CRITICAL BUG DETECTED!")
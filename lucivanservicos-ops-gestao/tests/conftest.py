@@ -0,0 +1,50 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# Os módulos do backend são importados como no servidor (uvicorn roda dentro de backend/)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# server.py exige a configuração do Mongo; o cliente só conecta no primeiro comando
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+
+# O motor prende o cliente ao event loop corrente na criação; server.py cria os
+# seus na importação, então ela acontece aqui, antes de qualquer asyncio.run
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Banco em memória (mongomock) no lugar do Mongo do servidor, com cache de usuários vazio."""
+    from mongomock_motor import AsyncMongoMockClient
+
+    database = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server.location_search, "db", database)
+    monkeypatch.setattr(server.kml_jobs, "db", database)
+    monkeypatch.setattr(server, "user_cache", server.UserCache(maxsize=1024, ttl=60))
+    return database
+
+
+@pytest.fixture
+def api(db):
+    """Cliente HTTP do app sem os eventos de startup (migrações, jobs)."""
+    from fastapi.testclient import TestClient
+
+    yield TestClient(server.app)
+    server.app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def login(api):
+    """Autentica as requisições do ``api`` como um usuário aprovado (ADMIN ou USER)."""
+
+    def login_as(role="USER", username="ana"):
+        user = server.User(username=username, hashed_password="x", role=role, status="APPROVED")
+        server.app.dependency_overrides[server.get_current_user] = lambda: user
+        return user
+
+    return login_as
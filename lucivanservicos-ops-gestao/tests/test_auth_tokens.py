@@ -0,0 +1,187 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import server
+from server import User, create_access_token, create_user_token
+
+
+def seed_user(db, username, role="USER", status="APPROVED", token_version=0):
+    user = User(username=username, hashed_password="x", role=role, status=status, token_version=token_version)
+    asyncio.run(db.users.insert_one(user.dict()))
+    return user
+
+
+def token_for(user):
+    return create_user_token(user.id, user.username, user.role, user.status, user.token_version)
+
+
+def get_me(api, token):
+    return api.get("/api/pendencias", headers={"Authorization": f"Bearer {token}"})
+
+
+def test_valid_token_authorizes_from_claims(db, api):
+    user = seed_user(db, "ana")
+
+    assert get_me(api, token_for(user)).status_code == 200
+
+
+def test_pending_user_is_forbidden(db, api):
+    user = seed_user(db, "ana", status="PENDING")
+
+    response = get_me(api, token_for(user))
+    assert response.status_code == 403
+    assert response.json()["detail"] == "User account not approved"
+
+
+def test_token_issued_before_approval_is_revoked(db, api):
+    admin = seed_user(db, "admin", role="ADMIN")
+    pending = seed_user(db, "ana", status="PENDING")
+    old_token = token_for(pending)
+    # Token antigo passa pela versão e só esbarra no status: já está no cache
+    assert get_me(api, old_token).status_code == 403
+    assert server.user_cache.get("ana", 0) is not None
+
+    response = api.put(
+        f"/api/admin/approve-user/{pending.id}",
+        json={"status": "APPROVED"},
+        headers={"Authorization": f"Bearer {token_for(admin)}"},
+    )
+    assert response.status_code == 200
+    # A aprovação invalida o cache; o token com status PENDING deixa de valer
+    assert server.user_cache.get("ana", 0) is None
+    assert get_me(api, old_token).status_code == 401
+
+    approved = User(**{**pending.dict(), "status": "APPROVED", "token_version": 1})
+    assert get_me(api, token_for(approved)).status_code == 200
+
+
+def test_register_approve_then_login_again(db, api):
+    admin = seed_user(db, "admin", role="ADMIN")
+    registered = api.post("/api/register", json={"username": "ana", "password": "senha"}).json()
+    assert registered["status"] == "PENDING"
+    old_token = {"Authorization": f"Bearer {registered['access_token']}"}
+    assert api.get("/api/me", headers=old_token).status_code == 403
+
+    api.put(
+        f"/api/admin/approve-user/{registered['user_id']}",
+        json={"status": "APPROVED"},
+        headers={"Authorization": f"Bearer {token_for(admin)}"},
+    )
+    # O token do cadastro foi revogado; o front (PendingApproval) manda de volta ao login
+    assert api.get("/api/me", headers=old_token).status_code == 401
+
+    logged = api.post("/api/login", json={"username": "ana", "password": "senha"}).json()
+    me = api.get("/api/me", headers={"Authorization": f"Bearer {logged['access_token']}"})
+    assert me.status_code == 200
+    assert me.json()["status"] == "APPROVED"
+
+
+def test_token_is_revoked_by_password_reset(db, api):
+    admin = seed_user(db, "admin", role="ADMIN")
+    user = seed_user(db, "ana")
+    old_token = token_for(user)
+    assert get_me(api, old_token).status_code == 200
+
+    response = api.put(
+        f"/api/admin/reset-password/{user.id}",
+        json={"new_password": "nova-senha"},
+        headers={"Authorization": f"Bearer {token_for(admin)}"},
+    )
+    assert response.status_code == 200
+    assert get_me(api, old_token).status_code == 401
+
+
+def test_token_is_revoked_by_role_change(db, api):
+    admin = seed_user(db, "admin", role="ADMIN")
+    admin_token = token_for(admin)
+    assert api.get("/api/admin/pendencias", headers={"Authorization": f"Bearer {admin_token}"}).status_code == 200
+
+    # Rebaixar um admin passa pelo mesmo helper das outras alterações de usuário
+    asyncio.run(server.update_user(admin.id, {"$set": {"role": "USER"}}))
+
+    assert api.get("/api/admin/pendencias", headers={"Authorization": f"Bearer {admin_token}"}).status_code == 401
+
+
+def test_token_is_revoked_by_status_change(db, api):
+    user = seed_user(db, "ana")
+    token = token_for(user)
+    assert get_me(api, token).status_code == 200
+
+    updated = asyncio.run(server.update_user(user.id, {"$set": {"status": "REJECTED"}}))
+
+    assert updated["token_version"] == 1
+    assert get_me(api, token).status_code == 401
+    assert asyncio.run(server.update_user("nao-existe", {"$set": {"status": "REJECTED"}})) is None
+
+
+def test_password_change_returns_a_new_token_and_revokes_the_old(db, api):
+    api.post("/api/register", json={"username": "admin", "password": "senha"})
+    old_token = api.post("/api/login", json={"username": "admin", "password": "senha"}).json()["access_token"]
+
+    response = api.put(
+        "/api/user/change-password",
+        json={"current_password": "senha", "new_password": "nova-senha"},
+        headers={"Authorization": f"Bearer {old_token}"},
+    )
+    assert response.status_code == 200
+    assert get_me(api, old_token).status_code == 401
+    assert get_me(api, response.json()["access_token"]).status_code == 200
+
+
+def test_deleted_user_token_is_rejected(db, api):
+    user = seed_user(db, "ana")
+    token = token_for(user)
+    asyncio.run(db.users.delete_one({"id": user.id}))
+
+    assert get_me(api, token).status_code == 401
+
+
+@pytest.mark.parametrize("missing", ["sub", "uid", "role", "status", "tv"])
+def test_token_missing_a_claim_is_rejected(db, api, missing):
+    user = seed_user(db, "ana")
+    claims = {"sub": user.username, "uid": user.id, "role": user.role, "status": user.status, "tv": 0}
+    del claims[missing]
+
+    assert get_me(api, create_access_token(claims)).status_code == 401
+
+
+def test_tampered_token_is_rejected(db, api):
+    user = seed_user(db, "ana")
+    header, payload, signature = token_for(user).split(".")
+    forged = create_access_token({"sub": "ana", "uid": user.id, "role": "ADMIN", "status": "APPROVED", "tv": 0})
+    # Payload de outro token (role ADMIN) com a assinatura do original
+    tampered = ".".join([header, forged.split(".")[1], signature])
+
+    assert get_me(api, tampered).status_code == 401
+
+
+def test_expired_token_is_rejected(db, api):
+    user = seed_user(db, "ana")
+    claims = {"sub": user.username, "uid": user.id, "role": user.role, "status": user.status, "tv": 0}
+
+    assert get_me(api, create_access_token(claims, expires_delta=timedelta(minutes=-1))).status_code == 401
+
+
+def test_token_version_is_cached_until_invalidated(db):
+    user = seed_user(db, "ana", token_version=3)
+
+    assert asyncio.run(server.get_token_version("ana")) == 3
+    asyncio.run(db.users.update_one({"id": user.id}, {"$inc": {"token_version": 1}}))
+    assert asyncio.run(server.get_token_version("ana")) == 3
+    asyncio.run(server.mark_users_changed("ana"))
+    assert asyncio.run(server.get_token_version("ana")) == 4
+    assert asyncio.run(server.get_token_version("ninguem")) is None
+
+
+def test_change_on_another_worker_skips_the_local_cache(db):
+    user = seed_user(db, "ana")
+    assert asyncio.run(server.get_token_version("ana")) == 0
+
+    # Outro worker revoga o token: o cache deste não é tocado, só a geração muda
+    asyncio.run(db.users.update_one({"id": user.id}, {"$inc": {"token_version": 1}}))
+    asyncio.run(db.generations.update_one(server.USERS_GENERATION, {"$inc": {"value": 1}}, upsert=True))
+
+    assert server.user_cache.get("ana", 0) is not None
+    assert asyncio.run(server.get_token_version("ana")) == 1
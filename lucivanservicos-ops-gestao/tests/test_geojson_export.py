@@ -0,0 +1,36 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+from geojson_export import feature, feature_collection
+
+
+async def as_async(items):
+    for item in items:
+        yield item
+
+
+def collect(features, chunk_size):
+    async def run():
+        return [chunk async for chunk in feature_collection(as_async(features), chunk_size)]
+
+    return asyncio.run(run())
+
+
+def test_feature_collection_is_streamed_in_chunks():
+    features = [feature({"type": "Point", "coordinates": [i, -3.7]}, {"name": f"Estação {i}"}) for i in range(50)]
+
+    chunks = collect(features, chunk_size=200)
+
+    assert len(chunks) > 1
+    collection = json.loads(b"".join(chunks))
+    assert collection["type"] == "FeatureCollection"
+    assert [item["properties"]["name"] for item in collection["features"]] == [f"Estação {i}" for i in range(50)]
+
+
+def test_empty_collection_and_values_without_geometry():
+    assert json.loads(b"".join(collect([], chunk_size=10))) == {"type": "FeatureCollection", "features": []}
+
+    created = datetime(2025, 1, 2, 3, 4, tzinfo=timezone.utc)
+    [item] = json.loads(b"".join(collect([feature(None, {"created_at": created})], chunk_size=10)))["features"]
+    assert item == {"type": "Feature", "geometry": None, "properties": {"created_at": "2025-01-02T03:04:00+00:00"}}
@@ -0,0 +1,33 @@
+import numpy as np
+
+from geometry import GEOMETRY_LEVEL_ZOOMS, douglas_peucker, level_for_zoom, pick_level, pixel_size
+
+
+def test_douglas_peucker_drops_vertices_within_tolerance():
+    line = np.array([[0, 0], [1, 0.05], [2, -0.05], [3, 5], [4, 6], [5, 7]], dtype=float)
+
+    np.testing.assert_array_equal(douglas_peucker(line, 0.1), [[0, 0], [2, -0.05], [3, 5], [5, 7]])
+    np.testing.assert_array_equal(douglas_peucker(line, 10), [[0, 0], [5, 7]])
+
+
+def test_douglas_peucker_keeps_closed_rings_valid():
+    ring = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]], dtype=float)
+
+    simplified = douglas_peucker(ring, 10, min_points=4)
+
+    assert len(simplified) == 4
+    np.testing.assert_array_equal(simplified[0], simplified[-1])
+
+
+def test_level_for_zoom_never_serves_coarser_than_a_pixel():
+    zooms = list(GEOMETRY_LEVEL_ZOOMS)
+    assert [level_for_zoom(zoom) for zoom in (0, zooms[0], zooms[0] + 1, zooms[-1], zooms[-1] + 1)] == [
+        0, 0, 1, len(zooms) - 1, len(zooms)
+    ]
+    assert level_for_zoom(None) == len(zooms)
+    assert pixel_size(1) == 2 * pixel_size(2)
+
+
+def test_pick_level_skips_empty_levels():
+    assert pick_level([None, {"type": "Point"}, {"type": "LineString"}]) == {"type": "Point"}
+    assert pick_level(None) is None
@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+
+SINCE = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+class IndexStatsCursor:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def to_list(self, length):
+        indexes = await self.collection.index_information()
+        return [
+            {"name": name, "key": dict(index["key"]), "accesses": {"ops": 7, "since": SINCE}}
+            for name, index in indexes.items()
+        ]
+
+
+class IndexStatsCollection:
+    """Coleção com o estágio $indexStats emulado (o mongomock não o implementa).
+
+    Só cobre o que o endpoint usa: o pipeline [{"$indexStats": {}}] seguido de to_list.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def aggregate(self, pipeline):
+        assert pipeline == [{"$indexStats": {}}]
+        return IndexStatsCursor(self.collection)
+
+
+class IndexStatsDatabase:
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return IndexStatsCollection(self.db[name])
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+@pytest.fixture
+def stats_db(db, monkeypatch):
+    asyncio.run(db.users.create_index("username", unique=True, name="username_unique"))
+    monkeypatch.setattr(server, "db", IndexStatsDatabase(db))
+    return db
+
+
+def test_index_stats_lists_every_declared_collection(stats_db, api, login):
+    login(role="ADMIN")
+
+    response = api.get("/api/admin/index-stats")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert set(body) == set(server.INDEXES)
+    username = next(index for index in body["users"] if index["name"] == "username_unique")
+    assert username == {"name": "username_unique", "key": {"username": 1}, "ops": 7, "since": SINCE.isoformat()}
+
+
+def test_index_stats_requires_admin(stats_db, api, login):
+    login(role="USER")
+
+    response = api.get("/api/admin/index-stats")
+
+    assert response.status_code == 403
+    assert response.json()["detail"] == "Admin access required"
@@ -0,0 +1,236 @@
+import io
+import zipfile
+
+import numpy as np
+import pytest
+
+from kml_ingest import (
+    InvalidKMLError,
+    KmzReader,
+    PlacemarkStream,
+    decode_coordinates,
+    location_document,
+    parse_placemarks,
+    read_location_batches,
+    summarize_coordinates,
+)
+
+
+KML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <Document>
+    <name>Sites</name>
+    <Folder>
+      <Placemark>
+        <name>Torre 1</name>
+        <description>Ilumina\xc3\xa7\xc3\xa3o</description>
+        <ExtendedData><Data name="ami"><value>123</value></Data></ExtendedData>
+        <Point><coordinates>-38.5,-3.7,0</coordinates></Point>
+      </Placemark>
+      <Placemark>
+        <name>Cabo</name>
+        <LineString><coordinates>-38.0,-3.0 -39.0,-4.0</coordinates></LineString>
+      </Placemark>
+      <Placemark><name>Sem coordenadas</name></Placemark>
+    </Folder>
+  </Document>
+</kml>
+"""
+
+
+class ChunkedFile(io.BytesIO):
+    """Arquivo que entrega no máximo ``chunk`` bytes por leitura."""
+
+    def __init__(self, data, chunk=None):
+        super().__init__(data)
+        self.chunk = chunk
+
+    def read(self, size=-1):
+        return super().read(self.chunk or size)
+
+
+def parse(data, chunk=None, lenient=False, batch_size=1000):
+    batches = list(read_location_batches(ChunkedFile(data, chunk), PlacemarkStream(), lenient, batch_size))
+    return sum(len(batch) for batch in batches), batches
+
+
+def test_placemarks_are_parsed_across_chunk_boundaries():
+    total, batches = parse(KML, chunk=7)
+
+    assert total == 2
+    torre, cabo = batches[0]
+    assert torre["name"] == "Torre 1"
+    assert torre["description"] == "Iluminação\nami: 123"
+    assert (torre["latitude"], torre["longitude"]) == (-3.7, -38.5)
+    assert cabo["coordinate_count"] == 2
+    assert cabo["bbox"] == [-39.0, -4.0, -38.0, -3.0]
+    assert (cabo["latitude"], cabo["longitude"]) == (-3.5, -38.5)
+
+
+def test_locations_are_delivered_in_batches():
+    total, batches = parse(KML, batch_size=1)
+
+    assert total == 2
+    assert [len(batch) for batch in batches] == [1, 1]
+
+
+def test_stream_counts_placemarks_without_coordinates():
+    stream = PlacemarkStream()
+    list(read_location_batches(io.BytesIO(KML), stream))
+
+    assert (stream.placemarks, stream.skipped) == (3, 1)
+
+
+def test_parsed_elements_are_released():
+    stream = PlacemarkStream()
+    stream.feed(KML[:KML.index(b"<Placemark><name>Sem")])
+
+    # Os Placemarks já lidos não ficam pendurados na árvore
+    folder = stream._open[-1]
+    assert len(folder) == 0
+
+
+def test_lenient_mode_fixes_bare_ampersands_and_latin1():
+    data = KML.replace(b"Torre 1", b"Torre A & B").replace(b"Ilumina\xc3\xa7\xc3\xa3o", b"Ilumina\xe7\xe3o")
+
+    with pytest.raises(InvalidKMLError):
+        parse(data)
+
+    total, batches = parse(b"\n  " + data, chunk=5, lenient=True)
+    assert total == 2
+    assert batches[0][0]["name"] == "Torre A & B"
+    assert batches[0][0]["description"].startswith("Iluminação")
+
+
+def test_parse_placemarks_takes_first_value_of_each_field():
+    kml = b"""<kml><Placemark>
+      <name> </name><name>Primeiro</name><name>Segundo</name>
+      <ExtendedData>
+        <Data name="a"><value>1</value><value>2</value></Data>
+        <SchemaData><SimpleData name="b">3</SimpleData></SchemaData>
+      </ExtendedData>
+      <Point><coordinates>1,2</coordinates></Point>
+    </Placemark></kml>"""
+
+    [location] = parse_placemarks([kml[:50], kml[50:]])
+
+    assert location.pop("key").startswith("Primeiro@Point:")
+    assert location == {
+        "name": "Primeiro",
+        "description": "a: 1\nb: 3",
+        "latitude": 2.0,
+        "longitude": 1.0,
+        "point": {"type": "Point", "coordinates": [1.0, 2.0]},
+        "search_terms": ["1", "3", "a", "b", "primeiro"],
+    }
+
+
+def test_lines_and_polygons_keep_full_and_simplified_geometry():
+    kml = b"""<kml>
+      <Placemark><name>Cabo</name><LineString><coordinates>
+        -38.0,-3.0 -38.0000001,-3.5 -38.0,-4.0
+      </coordinates></LineString></Placemark>
+      <Placemark><name>Area</name><MultiGeometry>
+        <Point><coordinates>5,5</coordinates></Point>
+        <Polygon>
+          <outerBoundaryIs><LinearRing><coordinates>0,0 4,0 4,4 0,4</coordinates></LinearRing></outerBoundaryIs>
+          <innerBoundaryIs><LinearRing><coordinates>1,1 2,1 2,2 1,1</coordinates></LinearRing></innerBoundaryIs>
+        </Polygon>
+      </MultiGeometry></Placemark>
+    </kml>"""
+
+    cabo, area = parse_placemarks([kml])
+
+    *simplified, full = cabo["geometry_levels"]
+    assert full == {"type": "LineString", "coordinates": [[-38.0, -3.0], [-38.0000001, -3.5], [-38.0, -4.0]]}
+    # O desvio de ~1cm some em todos os níveis; níveis iguais ao seguinte ficam vazios
+    assert simplified == [None, None, {"type": "LineString", "coordinates": [[-38.0, -3.0], [-38.0, -4.0]]}]
+
+    point, polygon = area["geometry_levels"][-1]["geometries"]
+    assert point == {"type": "Point", "coordinates": [5.0, 5.0]}
+    # Anel externo fechado e anel interno preservado
+    assert polygon["coordinates"][0] == [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]
+    assert polygon["coordinates"][1] == [[1, 1], [2, 1], [2, 2], [1, 1]]
+    assert area["coordinate_count"] == 10
+
+
+def test_decode_coordinates_pads_altitude_and_drops_invalid_vertices():
+    points = decode_coordinates("""
+        -38.5,-3.7 -38.6,-3.8
+        200,10 -38.7,-95
+    """)
+
+    np.testing.assert_array_equal(points, [[-38.5, -3.7, 0], [-38.6, -3.8, 0]])
+
+
+def test_decode_coordinates_handles_mixed_and_malformed_tuples():
+    points = decode_coordinates("-38.5,-3.7,10 abc -38.6,-3.8")
+
+    np.testing.assert_array_equal(points, [[-38.5, -3.7, 10], [-38.6, -3.8, 0]])
+
+
+def test_summarize_coordinates():
+    assert summarize_coordinates(np.array([[-38.5, -3.7, 0]])) == {"latitude": -3.7, "longitude": -38.5}
+
+    summary = summarize_coordinates(np.array([[0, 0, 0], [2, 4, 0]]))
+    assert summary == {"latitude": 2.0, "longitude": 1.0, "coordinate_count": 2, "bbox": [0.0, 0.0, 2.0, 4.0]}
+
+
+def test_location_ids_are_stable_per_file_and_placemark():
+    kml = b"""<kml>
+      <Placemark id="T1"><name>Torre</name><Point><coordinates>1,2</coordinates></Point></Placemark>
+      <Placemark><name>Torre</name><Point><coordinates>3,4</coordinates></Point></Placemark>
+    </kml>"""
+
+    first = [location_document(location, "arquivo") for location in parse_placemarks([kml])]
+    again = [location_document(location, "arquivo") for location in parse_placemarks([kml])]
+    other_file = [location_document(location, "outro") for location in parse_placemarks([kml])]
+
+    assert [doc["id"] for doc in first] == [doc["id"] for doc in again]
+    assert first[0]["id"] != first[1]["id"]
+    assert first[0]["id"] != other_file[0]["id"]
+    assert "key" not in first[0] and first[0]["kml_id"] == "arquivo"
+
+
+def test_colocated_placemarks_of_different_geometry_types_get_distinct_ids():
+    kml = b"""<kml>
+      <Placemark><name>Site A</name><Point><coordinates>1,2</coordinates></Point></Placemark>
+      <Placemark><name>Site A</name><LineString><coordinates>1,2 3,4</coordinates></LineString></Placemark>
+      <Placemark><name>Site A</name><Polygon><outerBoundaryIs><LinearRing>
+        <coordinates>1,2 3,4 3,2 1,2</coordinates>
+      </LinearRing></outerBoundaryIs></Polygon></Placemark>
+      <Placemark><name>Site A</name><LineString><coordinates>1,2 5,6</coordinates></LineString></Placemark>
+    </kml>"""
+
+    ids = [location_document(location, "arquivo")["id"] for location in parse_placemarks([kml])]
+
+    # Mesmo nome e mesmo primeiro vértice: o tipo e as demais coordenadas desempatam
+    assert len(set(ids)) == 4
+
+
+def kmz(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+def test_kmz_main_entry_is_streamed_to_the_parser():
+    reader = KmzReader(kmz([("files/icon.png", b"png"), ("outro.kml", b"<kml/>"), ("doc.kml", KML)]))
+    # Segunda leitura (como no retry tolerante) recomeça do início
+    reader.read(100)
+    reader.seek(0)
+    batches = list(read_location_batches(reader, PlacemarkStream(), batch_size=1))
+    reader.close()
+
+    assert reader.entry == "doc.kml"
+    assert [batch[0]["name"] for batch in batches] == ["Torre 1", "Cabo"]
+
+
+def test_invalid_kmz_is_rejected():
+    with pytest.raises(InvalidKMLError):
+        KmzReader(io.BytesIO(b"not a zip"))
+    with pytest.raises(InvalidKMLError):
+        KmzReader(kmz([("icon.png", b"png")]))
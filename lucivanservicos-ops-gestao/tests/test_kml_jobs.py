@@ -0,0 +1,304 @@
+import asyncio
+import hashlib
+import io
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import mongomock
+import pytest
+
+import kml_jobs
+import server
+from kml_ingest import legacy_location_id, location_document, parse_placemarks
+from kml_jobs import _spool
+from location_search import KML_GENERATION
+
+
+def test_spool_copies_upload_and_hashes_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(kml_jobs, "KML_READ_CHUNK", 7)
+    data = b"<kml>" + b"x" * 100 + b"</kml>"
+    upload = io.BytesIO(data)
+    upload.read(10)  # o upload é copiado desde o início
+
+    size, content_hash = _spool(upload, tmp_path / "upload.kml")
+
+    assert (tmp_path / "upload.kml").read_bytes() == data
+    assert (size, content_hash) == (len(data), hashlib.sha256(data).hexdigest())
+
+
+@pytest.fixture
+def sync_db():
+    """Banco síncrono em memória, como o pymongo usado pelo worker."""
+    db = mongomock.MongoClient()["test"]
+    db.kml_locations.create_index("id", unique=True)
+    return db
+
+
+def run_import(db, tmp_path, kml: bytes, kml_id="arquivo", mode="new"):
+    path = tmp_path / f"{uuid.uuid4()}.kml"
+    path.write_bytes(kml)
+    job = {
+        "id": str(uuid.uuid4()), "kml_id": kml_id, "mode": mode, "filename": "sites.kml",
+        "uploaded_by": "admin", "status": "queued", "path": str(path), "size": len(kml),
+        "content_hash": hashlib.sha256(kml).hexdigest(), "errors": [], "created_at": datetime.now(timezone.utc),
+    }
+    if mode == "new":
+        db.kml_data.insert_one({"id": kml_id, "filename": "sites.kml", "status": "processing"})
+    db.kml_jobs.insert_one(job)
+    status = kml_jobs._run_job(db, job["id"])
+    return status, db.kml_jobs.find_one({"id": job["id"]}, {"_id": 0})
+
+
+def test_colocated_placemarks_are_all_stored_and_repeats_are_reported(sync_db, tmp_path):
+    kml = b"""<kml>
+      <Placemark><name>Site A</name><Point><coordinates>1,2</coordinates></Point></Placemark>
+      <Placemark><name>Site A</name><LineString><coordinates>1,2 3,4</coordinates></LineString></Placemark>
+      <Placemark><name>Site A</name><Polygon><outerBoundaryIs><LinearRing>
+        <coordinates>1,2 3,4 3,2 1,2</coordinates>
+      </LinearRing></outerBoundaryIs></Polygon></Placemark>
+      <Placemark><name>Site A</name><Point><coordinates>1,2</coordinates></Point></Placemark>
+    </kml>"""
+
+    status, job = run_import(sync_db, tmp_path, kml)
+
+    assert status == "done"
+    assert sync_db.kml_locations.count_documents({"kml_id": "arquivo"}) == 3
+    assert (job["locations"], job["duplicates"]) == (3, 1)
+    assert job["errors"] == [kml_jobs.duplicates_message(1)]
+    # Os índices de busca dos workers do servidor veem a alteração
+    assert sync_db.generations.find_one(KML_GENERATION)["value"] == 1
+
+
+def placemark_kml(*placemarks):
+    body = "".join(
+        f"<Placemark><name>{name}</name><description>{description}</description>{geometry}</Placemark>"
+        for name, description, geometry in placemarks
+    )
+    return f"<kml>{body}</kml>".encode()
+
+
+POINT = "<Point><coordinates>1,2</coordinates></Point>"
+LINE = "<LineString><coordinates>1,2 3,4 5,2</coordinates></LineString>"
+POLYGON = (
+    "<Polygon><outerBoundaryIs><LinearRing>"
+    "<coordinates>0,0 4,0 4,4 0,0</coordinates>"
+    "</LinearRing></outerBoundaryIs></Polygon>"
+)
+
+REPLACE_COUNTS = ("locations", "inserted", "changed", "unchanged", "removed", "duplicates")
+
+
+def replace_counts(job):
+    return {name: job[name] for name in REPLACE_COUNTS}
+
+
+def stored_names(db):
+    return sorted(location["name"] for location in db.kml_locations.find({"kml_id": "arquivo"}))
+
+
+def test_replace_writes_only_the_diff(sync_db, tmp_path):
+    run_import(sync_db, tmp_path, placemark_kml(("A", "igual", POINT), ("B", "antes", LINE), ("C", "sai", POLYGON)))
+    ids = {location["name"]: location["id"] for location in sync_db.kml_locations.find()}
+
+    status, job = run_import(
+        sync_db, tmp_path,
+        placemark_kml(("A", "igual", POINT), ("B", "depois", LINE), ("D", "nova", POLYGON)),
+        mode="replace",
+    )
+
+    assert status == "done"
+    assert replace_counts(job) == {
+        "locations": 3, "inserted": 1, "changed": 1, "unchanged": 1, "removed": 1, "duplicates": 0,
+    }
+    assert stored_names(sync_db) == ["A", "B", "D"]
+    # Alterada no lugar: o id continua o mesmo
+    assert sync_db.kml_locations.find_one({"name": "B"})["id"] == ids["B"]
+    assert sync_db.kml_locations.find_one({"name": "B"})["description"] == "depois"
+
+
+def test_replace_with_the_same_content_changes_nothing(sync_db, tmp_path):
+    kml = placemark_kml(("A", "a", POINT), ("B", "b", LINE), ("C", "c", POLYGON))
+    run_import(sync_db, tmp_path, kml)
+    before = list(sync_db.kml_locations.find({}, {"_id": 0}))
+
+    status, job = run_import(sync_db, tmp_path, kml, mode="replace")
+
+    assert status == "done"
+    assert replace_counts(job) == {
+        "locations": 3, "inserted": 0, "changed": 0, "unchanged": 3, "removed": 0, "duplicates": 0,
+    }
+    assert list(sync_db.kml_locations.find({}, {"_id": 0})) == before
+
+
+def test_replace_rekeys_locations_migrated_with_legacy_ids(sync_db, tmp_path):
+    kml = placemark_kml(("Torre", "t", POINT), ("Cabo", "c", LINE), ("Area", "a", POLYGON), ("Torre", "t", POINT))
+    locations = list(parse_placemarks([kml]))
+    # Como migrate_kml_location_ids deixou as localizações antigas: id legado, sem geometria
+    seen = {}
+    for location in locations:
+        sync_db.kml_locations.insert_one({
+            "id": legacy_location_id("arquivo", location, seen), "kml_id": "arquivo",
+            "name": location["name"], "description": location["description"],
+            "latitude": location["latitude"], "longitude": location["longitude"],
+        })
+    sync_db.kml_data.insert_one({"id": "arquivo", "filename": "sites.kml", "status": "active"})
+
+    status, job = run_import(sync_db, tmp_path, kml, mode="replace")
+
+    assert status == "done"
+    # Regravadas no lugar com o id novo, não apagadas e reinseridas; a Torre repetida
+    # (mesmo nome e ponto) fica uma vez só
+    assert replace_counts(job) == {
+        "locations": 3, "inserted": 0, "changed": 3, "unchanged": 0, "removed": 1, "duplicates": 1,
+    }
+    expected_ids = sorted(location_document(location, "arquivo")["id"] for location in locations[:3])
+    assert sorted(location["id"] for location in sync_db.kml_locations.find()) == expected_ids
+
+    status, job = run_import(sync_db, tmp_path, kml, mode="replace")
+    assert (job["changed"], job["unchanged"], job["removed"]) == (0, 3, 0)
+
+
+def test_replace_restart_does_not_double_count(sync_db):
+    sync_db.kml_locations.insert_one(
+        location_document(next(parse_placemarks([placemark_kml(("A", "a", POINT))])), "arquivo")
+    )
+    locations = list(parse_placemarks([placemark_kml(("A", "novo", POINT), ("B", "b", LINE))]))
+    writer = kml_jobs._ReplaceWriter(sync_db, "arquivo")
+    writer.write(locations)
+
+    # Releitura no modo tolerante: as mesmas localizações chegam de novo
+    writer.restart()
+    writer.write(locations)
+    writer.finish()
+
+    assert writer.counts() == {
+        "locations": 2, "inserted": 1, "changed": 1, "unchanged": 0, "removed": 0, "duplicates": 0,
+    }
+
+
+def make_job(tmp_path, owner, heartbeat_at, mode="new", kml_id=None):
+    path = tmp_path / f"{uuid.uuid4()}.kml"
+    path.write_bytes(b"<kml/>")
+    job = {
+        "id": str(uuid.uuid4()), "kml_id": kml_id or str(uuid.uuid4()), "mode": mode, "status": "running",
+        "path": str(path), "errors": [], "owner": owner, "heartbeat_at": heartbeat_at,
+    }
+    if heartbeat_at is None:
+        # Criado antes do heartbeat existir
+        del job["owner"], job["heartbeat_at"]
+    return job
+
+
+def test_recover_only_abandons_jobs_without_a_recent_heartbeat(db, tmp_path):
+    jobs = kml_jobs.KmlJobs(db, "mongodb://localhost:1", "test", on_done=lambda: None)
+    now = datetime.now(timezone.utc)
+    expired = now - timedelta(seconds=kml_jobs.KML_JOB_HEARTBEAT_TIMEOUT + 1)
+    live = make_job(tmp_path, "outro-worker", now)
+    dead = make_job(tmp_path, "worker-morto", expired)
+    legacy = make_job(tmp_path, None, None)
+
+    async def run():
+        await db.kml_jobs.insert_many([dict(job) for job in (live, dead, legacy)])
+        await db.kml_data.insert_many([{"id": job["kml_id"], "status": "processing"} for job in (live, dead, legacy)])
+        abandoned = await jobs.recover()
+        statuses = {job["id"]: job["status"] async for job in db.kml_jobs.find()}
+        files = await db.kml_data.distinct("id")
+        return abandoned, statuses, files
+
+    abandoned, statuses, files = asyncio.run(run())
+
+    assert abandoned == 2
+    assert statuses == {live["id"]: "running", dead["id"]: "failed", legacy["id"]: "failed"}
+    # O arquivo novo do job encerrado é desfeito; o do job vivo continua
+    assert files == [live["kml_id"]]
+    assert Path(live["path"]).exists() and not Path(dead["path"]).exists()
+
+
+def test_abandon_skips_a_job_whose_heartbeat_was_renewed(db, tmp_path):
+    jobs = kml_jobs.KmlJobs(db, "mongodb://localhost:1", "test", on_done=lambda: None)
+    seen = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    job = make_job(tmp_path, "outro-worker", seen)
+
+    async def run():
+        await db.kml_jobs.insert_one(dict(job))
+        # O dono renovou o heartbeat entre a consulta de recover() e o encerramento
+        await db.kml_jobs.update_one({"id": job["id"]}, {"$set": {"heartbeat_at": datetime.now(timezone.utc)}})
+        claimed = await jobs._abandon(job, "interrompido", {"heartbeat_at": seen})
+        return claimed, await db.kml_jobs.find_one({"id": job["id"]})
+
+    claimed, stored = asyncio.run(run())
+
+    assert claimed is False
+    assert stored["status"] == "running"
+
+
+def test_heartbeat_renews_only_this_workers_unfinished_jobs(db, tmp_path):
+    jobs = kml_jobs.KmlJobs(db, "mongodb://localhost:1", "test", on_done=lambda: None)
+    old = datetime(2024, 1, 1)
+    mine = make_job(tmp_path, jobs.worker_id, old)
+    finished = {**make_job(tmp_path, jobs.worker_id, old), "status": "done"}
+    other = make_job(tmp_path, "outro-worker", old)
+
+    async def run():
+        await db.kml_jobs.insert_many([dict(job) for job in (mine, finished, other)])
+        await jobs.heartbeat()
+        return {job["id"]: job["heartbeat_at"] async for job in db.kml_jobs.find()}
+
+    heartbeats = asyncio.run(run())
+
+    assert heartbeats[mine["id"]] > old
+    assert heartbeats[finished["id"]] == old
+    assert heartbeats[other["id"]] == old
+
+
+class KmlUpload:
+    def __init__(self, data: bytes, filename="sites.kml"):
+        self.filename = filename
+        self.file = io.BytesIO(data)
+
+
+def test_concurrent_identical_upload_is_reported_as_duplicate(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(kml_jobs, "KML_SPOOL_DIR", tmp_path)
+    jobs = kml_jobs.KmlJobs(db, "mongodb://localhost:1", "test", on_done=lambda: None)
+    data = placemark_kml(("A", "", POINT))
+    content_hash = hashlib.sha256(data).hexdigest()
+    other = {"id": "outro", "filename": "outro.kml", "uploaded_by": "bia", "uploaded_at": datetime.now(timezone.utc),
+             "content_hash": content_hash, "status": "processing"}
+    checks = []
+    original = jobs._duplicate
+
+    async def racing(content_hash):
+        # O outro upload grava o kml_data logo depois da consulta deste
+        if not checks:
+            checks.append(content_hash)
+            await db.kml_data.insert_one(dict(other))
+            return None
+        return await original(content_hash)
+
+    monkeypatch.setattr(jobs, "_duplicate", racing)
+
+    async def run():
+        # O mongomock não aplica partialFilterExpression; aqui todos têm hash
+        await db.kml_data.create_index("content_hash", unique=True)
+        with pytest.raises(kml_jobs.DuplicateKMLError) as error:
+            await jobs.submit(KmlUpload(data), "ana")
+        return error.value.kml_data, await db.kml_jobs.count_documents({})
+
+    duplicate, job_count = asyncio.run(run())
+
+    assert duplicate["id"] == "outro"
+    assert job_count == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_ensure_indexes_replaces_the_old_content_hash_index(db):
+    async def run():
+        await db.kml_data.create_index("content_hash", name="content_hash")
+        await server.ensure_indexes()
+        return await db.kml_data.index_information()
+
+    indexes = asyncio.run(run())
+
+    assert "content_hash" not in indexes
+    assert indexes["content_hash_unique"]["unique"] is True
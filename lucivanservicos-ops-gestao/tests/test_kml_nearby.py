@@ -0,0 +1,136 @@
+import asyncio
+import math
+
+import pytest
+
+import server
+
+
+EARTH_RADIUS_M = 6378100
+
+
+def haversine_m(lng1, lat1, lng2, lat2):
+    dlat = math.radians(lat2 - lat1)
+    dlng = math.radians(lng2 - lng1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class GeoNearCollection:
+    """kml_locations com o estágio $geoNear emulado (o mongomock não implementa consultas geo).
+
+    Só cobre o que o endpoint usa: $geoNear seguido de $limit e $project de exclusão.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.pipelines = []
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        geo_near = pipeline[0]["$geoNear"]
+        lng, lat = geo_near["near"]["coordinates"]
+        documents = []
+        for document in await self.collection.find(geo_near.get("query", {})).to_list(None):
+            point_lng, point_lat = document[geo_near["key"]]["coordinates"]
+            distance = haversine_m(lng, lat, point_lng, point_lat)
+            if distance <= geo_near["maxDistance"]:
+                documents.append({**document, geo_near["distanceField"]: distance})
+        documents.sort(key=lambda document: document[geo_near["distanceField"]])
+        for stage in pipeline[1:]:
+            if "$limit" in stage:
+                documents = documents[:stage["$limit"]]
+            elif "$project" in stage:
+                excluded = {field for field, value in stage["$project"].items() if not value}
+                documents = [{k: v for k, v in document.items() if k not in excluded} for document in documents]
+        for document in documents:
+            yield document
+
+
+class GeoDatabase:
+    def __init__(self, db):
+        self.db = db
+        self.kml_locations = GeoNearCollection(db.kml_locations)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+@pytest.fixture
+def geo_db(db, monkeypatch):
+    geo = GeoDatabase(db)
+    monkeypatch.setattr(server, "db", geo)
+    return geo
+
+
+def seed_kml(db, kml_id, status, locations):
+    async def run():
+        await db.kml_data.insert_one({"id": kml_id, "filename": f"{kml_id}.kml", "uploaded_by": "admin", "status": status})
+        await db.kml_locations.insert_many([
+            {
+                "id": name, "kml_id": kml_id, "name": name, "latitude": lat, "longitude": lng,
+                "point": server.geo_point(lng, lat), "search_terms": [name.lower()],
+            }
+            for name, lng, lat in locations
+        ])
+    asyncio.run(run())
+
+
+def test_nearby_locations_are_sorted_by_distance(geo_db, api, login):
+    login()
+    # ~1,1 km por 0,01° de latitude no equador
+    seed_kml(geo_db.db, "k1", "active", [("longe", 0, 0.03), ("perto", 0, 0.01), ("meio", 0, -0.02)])
+
+    response = api.get("/api/kml/nearby", params={"lat": 0, "lng": 0, "radius_m": 5000})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [location["name"] for location in body] == ["perto", "meio", "longe"]
+    assert body[0]["distance_m"] == pytest.approx(1113.2, abs=1)
+    assert body[0]["source_file"] == "k1.kml"
+    # Campos internos não vão na resposta
+    assert "point" not in body[0] and "search_terms" not in body[0]
+
+
+def test_nearby_respects_radius_and_limit(geo_db, api, login):
+    login()
+    seed_kml(geo_db.db, "k1", "active", [("a", 0, 0.01), ("b", 0, 0.02), ("c", 0, 0.5)])
+
+    response = api.get("/api/kml/nearby", params={"lat": 0, "lng": 0, "radius_m": 3000})
+    assert [location["name"] for location in response.json()] == ["a", "b"]
+
+    response = api.get("/api/kml/nearby", params={"lat": 0, "lng": 0, "radius_m": 3000, "limit": 1})
+    assert [location["name"] for location in response.json()] == ["a"]
+
+
+def test_nearby_only_searches_active_kml_files(geo_db, api, login):
+    login()
+    seed_kml(geo_db.db, "ativo", "active", [("ativa", 0, 0.02)])
+    seed_kml(geo_db.db, "importando", "processing", [("importando", 0, 0.01)])
+
+    response = api.get("/api/kml/nearby", params={"lat": 0, "lng": 0})
+
+    assert [location["name"] for location in response.json()] == ["ativa"]
+    assert geo_db.kml_locations.pipelines[-1][0]["$geoNear"]["query"] == {"kml_id": {"$in": ["ativo"]}}
+
+
+@pytest.mark.parametrize("params", [
+    {"lat": 91, "lng": 0},
+    {"lat": -91, "lng": 0},
+    {"lat": 0, "lng": 181},
+    {"lat": 0, "lng": -181},
+    {"lat": 0, "lng": 0, "radius_m": 0},
+    {"lat": 0, "lng": 0, "radius_m": server.MAX_NEARBY_RADIUS_M + 1},
+    {"lat": 0, "lng": 0, "limit": 0},
+    {"lat": 0, "lng": 0, "limit": 201},
+    {"lat": "abc", "lng": 0},
+    {"lng": 0},
+])
+def test_nearby_rejects_invalid_parameters(geo_db, api, login, params):
+    login()
+
+    assert api.get("/api/kml/nearby", params=params).status_code == 422
+    assert geo_db.kml_locations.pipelines == []
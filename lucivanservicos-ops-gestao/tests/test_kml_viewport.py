@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+
+import server
+from geometry import GEOMETRY_LEVEL_ZOOMS
+
+
+def seed_locations(db, locations, kml_id="k1", status="active"):
+    async def run():
+        await db.kml_data.insert_one({"id": kml_id, "filename": f"{kml_id}.kml", "uploaded_by": "admin", "status": status})
+        await db.kml_locations.insert_many([
+            {
+                "id": f"{kml_id}-{name}", "kml_id": kml_id, "name": name, "latitude": lat, "longitude": lng,
+                "point": server.geo_point(lng, lat), "search_terms": [name.lower()], **extra,
+            }
+            for name, lng, lat, *rest in locations
+            for extra in [rest[0] if rest else {}]
+        ])
+    asyncio.run(run())
+
+
+def viewport(api, bbox, **params):
+    return api.get("/api/kml/locations", params={"bbox": bbox, **params})
+
+
+def names(body):
+    return sorted(location["name"] for location in body["locations"])
+
+
+def test_bbox_returns_only_locations_inside(db, api, login):
+    login()
+    seed_locations(db, [("dentro", -60.0, -3.0), ("fora", -50.0, -3.0), ("borda", -61.0, -4.0)])
+    seed_locations(db, [("inativo", -60.0, -3.0)], kml_id="k2", status="processing")
+
+    response = viewport(api, "-61,-4,-59,-2")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert names(body) == ["borda", "dentro"]
+    assert body["clusters"] == [] and body["truncated"] is False
+    location = next(location for location in body["locations"] if location["name"] == "dentro")
+    assert location["source_file"] == "k1.kml"
+    assert "point" not in location and "search_terms" not in location
+
+
+def test_bbox_crossing_the_antimeridian(db, api, login):
+    login()
+    seed_locations(db, [("leste", 179.5, 0.0), ("oeste", -179.5, 0.0), ("meio", 0.0, 0.0)])
+
+    body = viewport(api, "179,-1,-179,1").json()
+
+    assert names(body) == ["leste", "oeste"]
+
+
+def test_low_zoom_groups_points_into_clusters(db, api, login):
+    login()
+    seed_locations(db, [("a", -60.0, -3.0), ("b", -60.001, -3.001), ("sozinho", -40.0, -10.0)])
+
+    body = viewport(api, "-70,-20,-30,10", zoom=5).json()
+
+    # Células com um ponto só voltam como localização
+    assert names(body) == ["sozinho"]
+    assert len(body["clusters"]) == 1
+    assert body["clusters"][0]["count"] == 2
+    assert body["clusters"][0]["latitude"] == pytest.approx(-3.0005)
+    assert body["truncated"] is False
+
+
+def test_zoom_at_cluster_threshold_returns_single_points(db, api, login):
+    login()
+    seed_locations(db, [("a", -60.0, -3.0), ("b", -60.001, -3.001)])
+
+    # bbox do tamanho de uma tela nesse zoom: a célula é a do zoom, não a do bbox
+    bbox = "-60.3,-3.3,-59.7,-2.7"
+    below = viewport(api, bbox, zoom=server.KML_CLUSTER_MAX_ZOOM - 1).json()
+    at = viewport(api, bbox, zoom=server.KML_CLUSTER_MAX_ZOOM).json()
+    without_zoom = viewport(api, bbox).json()
+
+    assert below["locations"] == [] and below["clusters"][0]["count"] == 2
+    assert names(at) == names(without_zoom) == ["a", "b"]
+    assert at["clusters"] == []
+
+
+def test_geometry_level_follows_zoom(db, api, login):
+    login()
+    levels = [{"type": "LineString", "coordinates": [[-60, -3], [-59.5, -3]], "zoom": zoom} for zoom in GEOMETRY_LEVEL_ZOOMS]
+    levels.append({"type": "LineString", "coordinates": [[-60, -3], [-59.7, -2.9], [-59.5, -3]]})
+    # Nível do zoom 10 não simplifica: fica None e vale o próximo preenchido
+    levels[1] = None
+    seed_locations(db, [("linha", -60.0, -3.0, {"geometry_levels": levels})])
+
+    def geometry(**params):
+        return viewport(api, "-61,-4,-59,-2", **params).json()["locations"][0]["geometry"]
+
+    assert geometry(zoom=14)["zoom"] == 14
+    assert geometry(zoom=9)["zoom"] == 14
+    assert len(geometry(zoom=18)["coordinates"]) == 3
+    assert len(geometry()["coordinates"]) == 3
+
+
+def test_viewport_is_truncated_at_the_limit(db, api, login, monkeypatch):
+    login()
+    monkeypatch.setattr(server, "MAX_VIEWPORT_LOCATIONS", 2)
+    seed_locations(db, [(f"p{index}", -60.0 + index / 100, -3.0) for index in range(3)])
+
+    body = viewport(api, "-61,-4,-59,-2").json()
+    assert len(body["locations"]) == 2
+    assert body["truncated"] is True
+
+    body = viewport(api, "-59.995,-4,-59,-2").json()
+    assert len(body["locations"]) == 2
+    assert body["truncated"] is False
+
+
+def test_cluster_cell_grows_with_the_bbox(db, api, login):
+    login()
+    # Um ponto por grau: no zoom 12 cada um teria a sua célula
+    seed_locations(db, [(f"p{lng}_{lat}", lng + 0.5, lat + 0.5) for lng in range(-80, -40) for lat in range(-20, 20)])
+
+    body = viewport(api, "-180,-90,180,90", zoom=12).json()
+
+    # Células de 9 graus (360 / 40): 1600 pontos caem em poucas dezenas de clusters
+    assert len(body["clusters"]) + len(body["locations"]) <= 6 * 6
+    assert sum(cluster["count"] for cluster in body["clusters"]) + len(body["locations"]) == 1600
+    assert body["truncated"] is False
+
+
+def test_clusters_are_truncated_at_the_limit(db, api, login, monkeypatch):
+    login()
+    monkeypatch.setattr(server, "MAX_VIEWPORT_LOCATIONS", 2)
+    seed_locations(db, [
+        ("a1", -60.0, -3.0), ("a2", -60.001, -3.001), ("a3", -60.002, -3.002),
+        ("b1", -50.0, -3.0), ("b2", -50.001, -3.001),
+        ("sozinho", -40.0, -10.0),
+    ])
+
+    body = viewport(api, "-70,-20,-30,10", zoom=5).json()
+
+    # Ficam os maiores clusters; o ponto solto é o que sobra
+    assert sorted(cluster["count"] for cluster in body["clusters"]) == [2, 3]
+    assert body["locations"] == []
+    assert body["truncated"] is True
+
+
+def test_single_point_cell_brings_the_full_location(db, api, login):
+    login()
+    seed_locations(db, [("sozinho", -40.0, -10.0, {"description": "Torre"})])
+
+    location = viewport(api, "-70,-20,-30,10", zoom=5).json()["locations"][0]
+
+    assert location["description"] == "Torre"
+    assert location["source_file"] == "k1.kml"
+    assert "point" not in location and "search_terms" not in location
+
+
+@pytest.mark.parametrize("bbox, status_code", [
+    ("-61,-4,-59", 400),
+    ("a,b,c,d", 400),
+    ("-61,-4,-59,-2,0", 400),
+    ("-181,-4,-59,-2", 400),
+    ("-61,-91,-59,-2", 400),
+    ("-61,-2,-59,-4", 400),
+])
+def test_invalid_bbox_is_rejected(db, api, login, bbox, status_code):
+    login()
+
+    assert viewport(api, bbox).status_code == status_code
+
+
+@pytest.mark.parametrize("zoom", [-1, 23, "alto"])
+def test_invalid_zoom_is_rejected(db, api, login, zoom):
+    login()
+
+    assert viewport(api, "-61,-4,-59,-2", zoom=zoom).status_code == 422
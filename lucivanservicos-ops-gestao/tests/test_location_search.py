@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+import server
+from location_search import LocationSearch, LocationSearchIndex
+from search_keys import search_terms
+
+
+def make_index():
+    return LocationSearchIndex([
+        ("a", "Torre Centro", "Rua Principal"),
+        ("b", "Estação Norte", "Próxima à torre de água"),
+        ("c", "BRH Torre", ""),
+        ("d", "Subestação", "ab"),
+    ])
+
+
+def test_results_are_ranked_by_kind_of_match():
+    # Início do nome, início de palavra no nome, depois descrição
+    assert make_index().search("torre", 10) == ["a", "c", "b"]
+
+
+def test_search_is_case_insensitive_and_confirms_substring():
+    index = make_index()
+
+    assert index.search("ESTAÇÃO", 10) == ["b", "d"]
+    assert index.search("norte centro", 10) == []
+
+
+def test_two_character_queries_match_anywhere_in_the_text():
+    index = make_index()
+
+    assert index.search("ab", 10) == ["d"]
+    assert index.search("rh", 10) == ["c"]
+
+
+def test_limit_and_empty_queries():
+    index = make_index()
+
+    assert len(index.search("t", 2)) == 2
+    assert index.search("   ", 10) == []
+    assert LocationSearchIndex().search("torre", 10) == []
+
+
+def test_index_is_rebuilt_when_another_worker_changes_the_locations(db):
+    # Dois workers do servidor sobre o mesmo banco, cada um com o seu índice
+    worker = LocationSearch(db)
+    other_worker = LocationSearch(db)
+
+    async def run():
+        await db.kml_data.insert_one({"id": "k", "status": "active"})
+        await db.kml_locations.insert_one({"id": "a", "kml_id": "k", "name": "Torre Centro"})
+        await worker.rebuild()
+        unchanged = await worker.refresh()
+
+        await db.kml_locations.insert_one({"id": "b", "kml_id": "k", "name": "Torre Norte"})
+        await other_worker.changed()
+        refreshed = await worker.refresh()
+        return unchanged, refreshed, await worker.refresh()
+
+    unchanged, refreshed, again = asyncio.run(run())
+
+    assert (unchanged, refreshed, again) == (False, True, False)
+    assert sorted(worker.search("torre", 10)) == ["a", "b"]
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("19", ["b", "c"]),
+    ("CN19", ["b", "c"]),
+    ("estacao", ["b", "d"]),
+    ("torre cn", ["b", "c"]),
+    ("NORTE estação", ["b"]),
+    ("ua pri", ["a"]),
+    ("xyz", []),
+])
+def test_database_fallback_and_index_match_the_same_locations(db, api, login, monkeypatch, query, expected):
+    login()
+    locations = [
+        ("a", "Torre Centro", "Rua Principal"),
+        ("b", "Estação Norte CN19", "Próxima à torre de água"),
+        ("c", "BRH Torre", "Localizações CN19"),
+        ("d", "Subestação", ""),
+    ]
+    asyncio.run(db.kml_data.insert_one({"id": "k", "filename": "k.kml", "uploaded_by": "admin", "status": "active"}))
+    asyncio.run(db.kml_locations.insert_many([
+        {"id": key, "kml_id": "k", "name": name, "description": description,
+         "search_terms": search_terms(name, description)}
+        for key, name, description in locations
+    ]))
+    search = LocationSearch(db)
+    monkeypatch.setattr(server, "location_search", search)
+
+    def found():
+        response = api.get("/api/kml/search", params={"query": query})
+        return sorted(location["id"] for location in response.json()["locations"])
+
+    # Primeiro pelo Mongo (índice ainda não construído), depois pelo índice em memória
+    assert found() == expected
+    asyncio.run(search.rebuild())
+    assert search.ready
+    assert found() == expected
@@ -0,0 +1,44 @@
+import asyncio
+
+from migrations import (
+    KML_LOCATION_IDS_SCHEMA_VERSION,
+    KML_POINTS_SCHEMA_VERSION,
+    migrate_kml_location_ids,
+    migrate_kml_points,
+)
+
+
+def test_kml_points_migration_runs_once(db):
+    async def run():
+        await db.kml_locations.insert_one({"id": "a", "kml_id": "k", "latitude": -3.1, "longitude": -60.0})
+        first = await migrate_kml_points(db)
+        # Gravada depois da migração: a próxima inicialização não varre a coleção de novo
+        await db.kml_locations.insert_one({"id": "b", "kml_id": "k", "latitude": -3.2, "longitude": -60.1})
+        second = await migrate_kml_points(db)
+        return first, second, await db.schema_versions.find_one({"_id": "kml_points"})
+
+    first, second, version = asyncio.run(run())
+
+    assert first == {"modified": 1, "version": KML_POINTS_SCHEMA_VERSION}
+    assert second == {"modified": 0, "version": KML_POINTS_SCHEMA_VERSION}
+    assert version["version"] == KML_POINTS_SCHEMA_VERSION
+
+
+def test_kml_location_ids_migration_runs_once(db):
+    async def run():
+        await db.kml_locations.insert_many([
+            {"kml_id": "k", "name": "Torre", "latitude": -3.1, "longitude": -60.0},
+            {"kml_id": "k", "name": "Torre", "latitude": -3.1, "longitude": -60.0},
+        ])
+        first = await migrate_kml_location_ids(db)
+        ids = [location["id"] for location in await db.kml_locations.find({}).to_list(None)]
+        await db.kml_locations.insert_one({"kml_id": "k", "name": "Nova", "latitude": 0, "longitude": 0})
+        second = await migrate_kml_location_ids(db)
+        return first, second, ids
+
+    first, second, ids = asyncio.run(run())
+
+    assert first == {"modified": 2, "version": KML_LOCATION_IDS_SCHEMA_VERSION}
+    # Repetições no mesmo arquivo ganham sufixo: ids continuam únicos
+    assert len(set(ids)) == 2
+    assert second == {"modified": 0, "version": KML_LOCATION_IDS_SCHEMA_VERSION}
@@ -0,0 +1,50 @@
+import asyncio
+import hashlib
+
+from password_hasher import PasswordHasher, PasswordHashQueueFull
+
+
+def make_hasher(**kwargs):
+    kwargs.setdefault("rounds", 4)
+    return PasswordHasher(legacy_secret="segredo", **kwargs)
+
+
+def test_bcrypt_round_trip():
+    async def run():
+        hasher = make_hasher()
+        hashed = await hasher.hash("senha123")
+        assert hashed.startswith("$2")
+        assert await hasher.verify("senha123", hashed) == (True, False)
+        assert await hasher.verify("errada", hashed) == (False, False)
+
+    asyncio.run(run())
+
+
+def test_legacy_sha256_hash_is_accepted_and_flagged_for_rehash():
+    legacy = hashlib.sha256(("senha123" + "segredo").encode()).hexdigest()
+
+    async def run():
+        hasher = make_hasher()
+        assert await hasher.verify("senha123", legacy) == (True, True)
+        assert (await hasher.verify("errada", legacy))[0] is False
+
+    asyncio.run(run())
+
+
+def test_hash_with_old_cost_is_flagged_for_rehash():
+    async def run():
+        hashed = await make_hasher(rounds=4).hash("senha123")
+        assert await make_hasher(rounds=5).verify("senha123", hashed) == (True, True)
+
+    asyncio.run(run())
+
+
+def test_full_queue_is_rejected():
+    async def run():
+        hasher = make_hasher(workers=1, max_queue=1)
+        tasks = [asyncio.create_task(hasher.hash("senha")) for _ in range(3)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert any(isinstance(r, PasswordHashQueueFull) for r in results)
+        assert hasher.metrics()["in_flight"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,52 @@
+import asyncio
+
+from server import Pendencia, pendencia_document
+
+
+def seed(db, **photo):
+    pendencia = Pendencia(
+        id="p1", site="ERB-01", tipo="Energia", subtipo="Bateria", observacoes="antes",
+        usuario_criacao="ana", **photo,
+    )
+    asyncio.run(db.pendencias.insert_one(pendencia_document(pendencia)))
+
+
+def edit(api, **changes):
+    body = {"site": "ERB-01", "tipo": "Energia", "subtipo": "Bateria", "observacoes": "depois", **changes}
+    return api.put("/api/pendencias/p1/edit", json=body)
+
+
+def stored(db):
+    return asyncio.run(db.pendencias.find_one({"id": "p1"}))
+
+
+def test_edit_without_new_photo_keeps_the_current_one(db, api, login):
+    login()
+    seed(db, foto_id="abc")
+
+    response = edit(api, foto_base64=None)
+
+    assert response.status_code == 200
+    assert response.json()["observacoes"] == "depois"
+    assert stored(db)["foto_id"] == "abc"
+
+
+def test_remove_photo_clears_the_reference(db, api, login):
+    login()
+    seed(db, foto_id="abc")
+
+    response = edit(api, foto_base64=None, remove_photo=True)
+
+    assert response.status_code == 200
+    assert response.json()["foto_id"] is None
+    assert stored(db)["foto_id"] is None
+
+
+def test_remove_photo_clears_a_legacy_inline_photo(db, api, login):
+    login()
+    seed(db, foto_base64="aW1n")
+
+    edit(api, remove_photo=True)
+
+    assert "foto_base64" not in stored(db)
+    assert stored(db).get("foto_id") is None
@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from server import (
+    PENDENCIA_SUMMARY_PROJECTION, Pendencia, encode_cursor, has_field_expr, pendencia_document,
+)
+
+
+BASE_TIME = datetime(2024, 5, 1, 12, 0)
+
+
+def seed(db, *pendencias):
+    asyncio.run(db.pendencias.insert_many([pendencia_document(p) for p in pendencias]))
+
+
+def pendencia(id, created_at, site="ERB-01"):
+    return Pendencia(
+        id=id, site=site, tipo="Energia", subtipo="Bateria", observacoes="",
+        usuario_criacao="ana", created_at=created_at,
+    )
+
+
+def all_pages(api, limit, **params):
+    pages, cursor = [], None
+    while True:
+        query = {"limit": limit, **params, **({"cursor": cursor} if cursor else {})}
+        response = api.get("/api/pendencias", params=query)
+        assert response.status_code == 200
+        pages.append([item["id"] for item in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return pages
+
+
+def test_pages_follow_created_at_then_id_descending(db, api, login):
+    login()
+    # Três pendências no mesmo instante: o id desempata, sem repetir nem pular itens
+    seed(
+        db,
+        pendencia("a", BASE_TIME),
+        pendencia("c", BASE_TIME),
+        pendencia("b", BASE_TIME),
+        pendencia("d", BASE_TIME + timedelta(minutes=1)),
+        pendencia("e", BASE_TIME - timedelta(minutes=1)),
+    )
+
+    assert all_pages(api, limit=2) == [["d", "c"], ["b", "a"], ["e"]]
+
+
+def test_last_page_has_no_next_cursor(db, api, login):
+    login()
+    seed(db, pendencia("a", BASE_TIME), pendencia("b", BASE_TIME + timedelta(minutes=1)))
+
+    response = api.get("/api/pendencias", params={"limit": 2})
+    assert [item["id"] for item in response.json()] == ["b", "a"]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = api.get("/api/pendencias", params={"limit": 1})
+    assert response.headers["X-Next-Cursor"] == encode_cursor({"created_at": BASE_TIME + timedelta(minutes=1), "id": "b"})
+
+
+def test_cursor_combines_with_filters(db, api, login):
+    login()
+    seed(
+        db,
+        pendencia("a", BASE_TIME, site="ERB-01"),
+        pendencia("b", BASE_TIME + timedelta(minutes=1), site="ERB-02"),
+        pendencia("c", BASE_TIME + timedelta(minutes=2), site="ERB-01"),
+    )
+
+    assert all_pages(api, limit=1, site="ERB-01") == [["c"], ["a"]]
+
+
+@pytest.mark.parametrize("cursor", ["nao-e-base64!", "bm9wZQ", encode_cursor({"created_at": BASE_TIME, "id": "a"})[:-4]])
+def test_malformed_cursor_is_rejected(db, api, login, cursor):
+    login()
+
+    response = api.get("/api/pendencias", params={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Cursor inválido"
+
+
+def test_summary_projection_keeps_card_text_and_drops_inline_photos():
+    # O mongomock não avalia expressões em projeções; confere a projeção enviada ao Mongo
+    assert PENDENCIA_SUMMARY_PROJECTION["observacoes"] == 1
+    assert PENDENCIA_SUMMARY_PROJECTION["informacoes_fechamento"] == 1
+    assert "foto_base64" not in PENDENCIA_SUMMARY_PROJECTION
+    assert "foto_fechamento_base64" not in PENDENCIA_SUMMARY_PROJECTION
+    assert PENDENCIA_SUMMARY_PROJECTION["has_photo"] == has_field_expr("foto_id", "foto_base64")
+
+
+def test_single_pendencia_brings_the_legacy_photo(db, api, login):
+    login()
+    seed(db, pendencia("a", BASE_TIME).model_copy(update={"foto_base64": "aW1n"}))
+
+    assert api.get("/api/pendencias/a").json()["foto_base64"] == "aW1n"
+    assert api.get("/api/pendencias/nao-existe").status_code == 404
+    # A rota por id não pode capturar as exportações
+    assert api.get("/api/pendencias/export").status_code == 403
+
+
+@pytest.mark.parametrize("path", ["/api/pendencias", "/api/admin/pendencias"])
+def test_unknown_view_is_rejected(db, api, login, path):
+    login(role="ADMIN")
+
+    assert api.get(path, params={"view": "sumary"}).status_code == 422
+    assert api.get(path, params={"view": "full"}).status_code == 200
@@ -0,0 +1,294 @@
+import asyncio
+import base64
+import io
+import re
+
+import pytest
+
+from photo_store import InvalidPhotoError, decode_base64_photo, guess_content_type
+
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n" + b"\x00" * 8
+
+
+def test_decode_plain_base64():
+    assert decode_base64_photo(base64.b64encode(b"abc").decode()) == b"abc"
+
+
+def test_decode_data_url():
+    value = "data:image/png;base64," + base64.b64encode(PNG_HEADER).decode()
+    assert decode_base64_photo(value) == PNG_HEADER
+
+
+def test_decode_empty_photo_is_rejected():
+    with pytest.raises(InvalidPhotoError):
+        decode_base64_photo("   ")
+
+
+@pytest.mark.parametrize("head, expected", [
+    (PNG_HEADER, "image/png"),
+    (b"GIF89a" + b"\x00" * 10, "image/gif"),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"\xff\xd8\xff\xe0" + b"\x00" * 12, "image/jpeg"),
+])
+def test_guess_content_type(head, expected):
+    assert guess_content_type(head) == expected
+
+
+class FakeUpload:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        # UploadFile.file: a geração de miniaturas lê o arquivo em uma thread
+        self.file = io.BytesIO(data)
+
+    async def read(self, size):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+    async def seek(self, pos):
+        self.pos = pos
+
+
+def put_upload(upload, max_bytes):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from photo_store import PhotoStore
+
+    async def run():
+        # O cliente só conecta no primeiro comando; os casos abaixo falham antes disso
+        store = PhotoStore(AsyncIOMotorClient("mongodb://localhost:1")["test"])
+        return await store.put_upload(upload, max_bytes)
+
+    return asyncio.run(run())
+
+
+def test_upload_over_limit_is_rejected_while_streaming():
+    from photo_store import PhotoTooLargeError
+
+    upload = FakeUpload(b"\xff\xd8" + b"\x00" * (600 * 1024))
+    with pytest.raises(PhotoTooLargeError):
+        put_upload(upload, max_bytes=300 * 1024)
+    # Parou no segundo chunk, sem ler o arquivo inteiro
+    assert upload.pos < len(upload.data)
+
+
+def test_empty_upload_is_rejected():
+    with pytest.raises(InvalidPhotoError):
+        put_upload(FakeUpload(b""), max_bytes=1024)
+
+
+def test_render_thumbnails_downscales_and_reencodes_as_jpeg():
+    from PIL import Image
+
+    from photo_store import render_thumbnails
+
+    source = io.BytesIO()
+    Image.new("RGBA", (1200, 800), (200, 30, 30, 255)).save(source, "PNG")
+    source.seek(0)
+
+    thumbnails = render_thumbnails(source, (160, 480))
+
+    assert sorted(thumbnails) == [160, 480]
+    for size, data in thumbnails.items():
+        with Image.open(io.BytesIO(data)) as thumb:
+            assert thumb.format == "JPEG"
+            assert max(thumb.size) == size
+
+
+class FakeGridFS:
+    """Bucket GridFS em memória com as mesmas colisões do real (FileExists por _id/chunk)."""
+
+    def __init__(self):
+        self.files = {}
+        self.chunks = {}
+        self.aborted = []
+
+    async def count_documents(self, query, limit=0):
+        return int(query["_id"] in self.files)
+
+    def open_upload_stream_with_id(self, file_id, filename, metadata=None):
+        return FakeGridIn(self, file_id)
+
+    async def upload_from_stream_with_id(self, file_id, filename, data, metadata=None):
+        grid_in = FakeGridIn(self, file_id)
+        await grid_in.write(data)
+        await grid_in.close()
+
+    async def open_download_stream(self, file_id):
+        from gridfs.errors import NoFile
+
+        if file_id not in self.files:
+            raise NoFile(f"no file with _id {file_id!r}")
+        return FakeGridOut(b"".join(self.chunks[(file_id, n)] for n in range(self.files[file_id])))
+
+
+class FakeGridOut:
+    metadata = None
+
+    def __init__(self, data):
+        self.length = len(data)
+        self._pending = [data]
+
+    async def readchunk(self):
+        return self._pending.pop() if self._pending else b""
+
+
+class FakeGridIn:
+    def __init__(self, gridfs, file_id):
+        self.gridfs = gridfs
+        self.file_id = file_id
+        self.chunk_number = 0
+
+    async def write(self, data):
+        from gridfs.errors import FileExists
+
+        # Cede a vez: o outro upload concorrente avança entre dois chunks
+        await asyncio.sleep(0)
+        key = (self.file_id, self.chunk_number)
+        if key in self.gridfs.chunks:
+            raise FileExists(f"file with _id {self.file_id!r} already exists")
+        self.gridfs.chunks[key] = data
+        self.chunk_number += 1
+
+    async def close(self):
+        from gridfs.errors import FileExists
+
+        if self.file_id in self.gridfs.files:
+            raise FileExists(f"file with _id {self.file_id!r} already exists")
+        self.gridfs.files[self.file_id] = self.chunk_number
+
+    async def abort(self):
+        self.gridfs.aborted.append(self.file_id)
+        self.gridfs.files.pop(self.file_id, None)
+        for key in [key for key in self.gridfs.chunks if key[0] == self.file_id]:
+            del self.gridfs.chunks[key]
+
+
+def test_concurrent_identical_uploads_keep_the_stored_photo():
+    from PIL import Image
+
+    from photo_store import PHOTO_CHUNK_SIZE, PhotoStore
+
+    source = io.BytesIO()
+    Image.effect_noise((700, 700), 64).convert("RGB").save(source, "PNG")
+    data = source.getvalue()
+    assert len(data) > PHOTO_CHUNK_SIZE  # mais de um chunk: as gravações se intercalam
+
+    async def run():
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        store = PhotoStore(AsyncIOMotorClient("mongodb://localhost:1")["test"])
+        store.bucket = store.files = gridfs = FakeGridFS()
+        ids = await asyncio.gather(
+            store.put_upload(FakeUpload(data), 10 * 1024 * 1024),
+            store.put_upload(FakeUpload(data), 10 * 1024 * 1024),
+        )
+        return gridfs, ids
+
+    gridfs, ids = asyncio.run(run())
+
+    photo_id = ids[0]
+    assert ids == [photo_id, photo_id]
+    assert gridfs.aborted == []
+    assert photo_id in gridfs.files
+    stored = b"".join(gridfs.chunks[(photo_id, n)] for n in range(gridfs.files[photo_id]))
+    assert stored == data
+
+
+def upload_limited(body, content_length=True):
+    from fastapi import FastAPI, Request
+    from fastapi.testclient import TestClient
+
+    from server import UploadSizeLimitMiddleware
+
+    app = FastAPI()
+    received = []
+
+    @app.post("/api/pendencias/upload")
+    async def upload(request: Request):
+        async for chunk in request.stream():
+            received.append(chunk)
+        return {"ok": True}
+
+    app.add_middleware(UploadSizeLimitMiddleware, max_bytes=1000, paths=re.compile(r"^/api/pendencias/upload$"))
+
+    def chunks():
+        for start in range(0, len(body), 100):
+            yield body[start:start + 100]
+
+    response = TestClient(app).post("/api/pendencias/upload", content=body if content_length else chunks())
+    return response, sum(len(chunk) for chunk in received)
+
+
+def test_upload_size_limit_is_enforced_while_the_body_arrives():
+    response, received = upload_limited(b"x" * 500)
+    assert response.status_code == 200
+
+    # Com Content-Length: recusado sem ler o corpo
+    response, received = upload_limited(b"x" * 5000)
+    assert response.status_code == 413
+    assert received == 0
+
+    # Sem Content-Length (chunked): recusado assim que passa do limite
+    response, received = upload_limited(b"x" * 5000, content_length=False)
+    assert response.status_code == 413
+    assert received <= 1000
+
+
+def test_photo_above_pixel_limit_is_rejected_before_storing():
+    from PIL import Image
+
+    from photo_store import MAX_PHOTO_PIXELS, PhotoStore
+
+    # Poucos KB comprimidos, mas bem acima do limite ao decodificar
+    source = io.BytesIO()
+    Image.new("1", (8000, 8000)).save(source, "PNG")
+    assert 8000 * 8000 > MAX_PHOTO_PIXELS
+
+    async def run():
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        store = PhotoStore(AsyncIOMotorClient("mongodb://localhost:1")["test"])
+        store.bucket = store.files = gridfs = FakeGridFS()
+        with pytest.raises(InvalidPhotoError):
+            await store.put_upload(FakeUpload(source.getvalue()), 10 * 1024 * 1024)
+        return gridfs
+
+    gridfs = asyncio.run(run())
+    # A original não ficou órfã no GridFS
+    assert gridfs.files == {} and gridfs.chunks == {}
+
+
+def test_check_resolution_maps_decompression_bomb_to_invalid_photo():
+    from PIL import Image
+
+    from photo_store import check_resolution
+
+    source = io.BytesIO()
+    Image.new("1", (Image.MAX_IMAGE_PIXELS // 1000, 2100)).save(source, "PNG")
+    with pytest.raises(InvalidPhotoError):
+        check_resolution(source, max_pixels=Image.MAX_IMAGE_PIXELS * 10)
+    assert source.tell() == 0
+
+
+def test_photo_etag_names_the_file_actually_served(api, login, monkeypatch):
+    import server
+    from photo_store import thumbnail_id
+
+    login()
+    gridfs = FakeGridFS()
+    monkeypatch.setattr(server.photo_store, "bucket", gridfs)
+
+    async def store():
+        await gridfs.upload_from_stream_with_id("foto", "foto", b"original")
+        await gridfs.upload_from_stream_with_id(thumbnail_id("foto", 160), thumbnail_id("foto", 160), b"mini")
+
+    asyncio.run(store())
+
+    thumb = api.get("/api/photos/foto", params={"size": 100})
+    assert (thumb.content, thumb.headers["ETag"]) == (b"mini", '"foto_160"')
+    # Sem a miniatura de 480 vale a original
+    original = api.get("/api/photos/foto", params={"size": 300})
+    assert (original.content, original.headers["ETag"]) == (b"original", '"foto"')
+    assert api.get("/api/photos/outra").status_code == 404
@@ -0,0 +1,23 @@
+from search_keys import fold, search_terms, terms_query
+
+
+def test_fold_removes_accents_and_case():
+    assert fold("Iluminação") == "iluminacao"
+    assert fold("LOCALIZAÇÕES CN19") == "localizacoes cn19"
+    assert fold(None) == ""
+
+
+def test_search_terms_are_distinct_folded_words():
+    assert search_terms("Estação Norte", "estacao de energia", None) == ["de", "energia", "estacao", "norte"]
+
+
+def test_terms_query_matches_substrings_of_the_terms():
+    query = terms_query("Ilumin  19")
+
+    assert query == {"$and": [
+        {"search_terms": {"$regex": "ilumin"}},
+        {"search_terms": {"$regex": "19"}},
+    ]}
+    assert terms_query(" -- ") is None
+    # A consulta é escapada antes de virar regex
+    assert terms_query("a.b")["$and"][0]["search_terms"]["$regex"] == "a"
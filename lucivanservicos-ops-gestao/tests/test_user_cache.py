@@ -0,0 +1,43 @@
+from server import User, UserCache
+
+
+def make_user(username, status="APPROVED"):
+    return User(username=username, hashed_password="x", status=status)
+
+
+def test_cached_user_is_returned_until_invalidated():
+    cache = UserCache(maxsize=10, ttl=60)
+    user = make_user("ana")
+    cache.set(user, 0)
+
+    assert cache.get("ana", 0) is user
+    cache.invalidate("ana")
+    assert cache.get("ana", 0) is None
+
+
+def test_expired_entries_are_dropped():
+    cache = UserCache(maxsize=10, ttl=-1)
+    cache.set(make_user("ana"), 0)
+
+    assert cache.get("ana", 0) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = UserCache(maxsize=2, ttl=60)
+    cache.set(make_user("ana"), 0)
+    cache.set(make_user("bia"), 0)
+    cache.get("ana", 0)
+    cache.set(make_user("caio"), 0)
+
+    assert cache.get("bia", 0) is None
+    assert cache.get("ana", 0) is not None
+    assert cache.get("caio", 0) is not None
+
+
+def test_entry_from_an_older_generation_is_dropped():
+    cache = UserCache(maxsize=10, ttl=60)
+    cache.set(make_user("ana"), 0)
+
+    # Outro worker alterou algum usuário: a entrada não vale mais
+    assert cache.get("ana", 1) is None
+    assert cache.get("ana", 0) is None